@@ -5,4 +5,8 @@ home A/V receivers and processors made by Anthem ( http://www.anthemav.com/ )
 """
 from .connection import Connection  # noqa: F401
 from .protocol import AVR  # noqa: F401
-from .device_error import DeviceError  # noqa: F401
+from .device_error import CommandError, DeviceError  # noqa: F401
+from .cache import StateCache  # noqa: F401
+from .events import StateChange  # noqa: F401
+from .reconnect import ReconnectPolicy  # noqa: F401
+from .fleet import AVRFleet  # noqa: F401
@@ -0,0 +1,347 @@
+"""Module containing the end to end benchmarks of the library.
+
+The benchmarks run against the local DeviceEmulator and measure:
+
+- connect: Connection.create() until wait_for_device_initialised() returns
+- refresh: a full refresh_all plus refresh_zone of every zone
+- parse: messages per second through data_received and _parse_message
+- replay: messages per second replaying sessions recorded with a real device
+- fleet_start: AVRFleet.start() until every device of a fleet is initialised
+- fleet_query: a query fanned out to every device of a fleet
+
+Results are written as JSON so two runs can be compared to catch
+regressions, see the anthemav_benchmark command line tool.
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import platform
+import statistics
+import sys
+import time
+from contextlib import AsyncExitStack
+from typing import Any, Dict, List, Sequence
+
+from .connection import Connection
+from .emulator import DeviceEmulator
+from .fleet import AVRFleet
+from .protocol import AVR
+from .recorder import RECEIVED, read_recording, replay
+
+__all__ = ["run_benchmarks", "compare_results", "main"]
+
+# Models used for each zone count
+ZONE_MODELS = {2: "MRX 740", 4: "MDX-8", 8: "MDX-16"}
+
+# Messages a powered on device sends, none of them triggers a refresh
+PARSE_MESSAGES = [
+    "Z1VOL-42",
+    "Z1PVOL53",
+    "Z1MUT1",
+    "Z2VOL-30",
+    "Z1VIR14",
+    "Z1AIC4",
+    "Z1AINDolby Atmos",
+    "Z1ALM03",
+    "Z1BRT640",
+    "IS3INBlu-ray",
+    "IS3ARC1",
+    "IDMMRX 1140",
+    "Z1VOL-43",
+    "Z1MUT0",
+    "Z2VOL-31",
+    "Z1AINDolby Digital",
+]
+
+
+class _NullTransport(asyncio.Transport):
+    """Transport discarding everything written to it."""
+
+    def write(self, data):
+        pass
+
+    def writelines(self, list_of_data):
+        pass
+
+    def pause_reading(self):
+        pass
+
+    def resume_reading(self):
+        pass
+
+    def is_closing(self):
+        return False
+
+
+def _stats(samples: List[float]) -> Dict[str, float]:
+    """Summarize durations in seconds as milliseconds."""
+    ordered = sorted(samples)
+    return {
+        "count": len(ordered),
+        "min": ordered[0] * 1000,
+        "median": statistics.median(ordered) * 1000,
+        "mean": statistics.mean(ordered) * 1000,
+        "p95": ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))] * 1000,
+        "max": ordered[-1] * 1000,
+    }
+
+
+async def _wait_until(condition, timeout: float = 10):
+    """Poll a condition until it is true."""
+    deadline = time.perf_counter() + timeout
+    while not condition():
+        if time.perf_counter() > deadline:
+            raise asyncio.TimeoutError
+        await asyncio.sleep(0.005)
+
+
+async def bench_connect(model: str, latency: float, repeat: int) -> Dict[str, Any]:
+    """Time Connection.create() until the device is initialised."""
+    samples = []
+    async with DeviceEmulator(model=model, latency=latency) as device:
+        for _ in range(repeat):
+            start = time.perf_counter()
+            conn = await Connection.create(port=device.port)
+            await conn.protocol.wait_for_device_initialised(5)
+            samples.append(time.perf_counter() - start)
+            conn.close()
+            await _wait_until(lambda: device.clients == 0)
+    return {
+        "benchmark": "connect",
+        "params": {"model": model, "latency": latency},
+        "unit": "ms",
+        **_stats(samples),
+    }
+
+
+async def bench_refresh(zones: int, latency: float, repeat: int) -> Dict[str, Any]:
+    """Time a full refresh_all and refresh_zone cycle on a powered on device."""
+    model = ZONE_MODELS[zones]
+    samples = []
+    async with DeviceEmulator(model=model, latency=latency, power=True) as device:
+        conn = await Connection.create(port=device.port)
+        avr = conn.protocol
+        await avr.wait_for_device_initialised(5)
+        # let the power on refresh triggered by the connection settle
+        await _wait_until(lambda: avr._poweron_refresh_successful)
+        for _ in range(repeat):
+            start = time.perf_counter()
+            await avr.refresh_all()
+            for zone in list(avr.zones):
+                await avr.refresh_zone(zone)
+            samples.append(time.perf_counter() - start)
+        conn.close()
+    return {
+        "benchmark": "refresh",
+        "params": {"zones": zones, "model": model, "latency": latency},
+        "unit": "ms",
+        **_stats(samples),
+    }
+
+
+def _chunks(messages: List[str], chunk_size: int, pattern: str) -> List[bytes]:
+    """Cut the message stream the way it arrives from the network."""
+    if pattern == "steady":
+        # one datagram per read, like a device reporting changes one by one
+        return [f"{message};".encode() for message in messages]
+    stream = "".join(f"{message};" for message in messages).encode()
+    return [stream[i : i + chunk_size] for i in range(0, len(stream), chunk_size)]
+
+
+async def bench_parse(messages: int, chunk_size: int, pattern: str) -> Dict[str, Any]:
+    """Measure messages per second through data_received and _parse_message."""
+    avr = AVR(loop=asyncio.get_running_loop())
+    avr.transport = _NullTransport()
+    await avr._parse_message("IDMMRX 1140")
+    avr._device_power = True
+    for zone in avr.zones.values():
+        zone.need_refresh = False
+
+    stream = [PARSE_MESSAGES[i % len(PARSE_MESSAGES)] for i in range(messages)]
+    chunks = _chunks(stream, chunk_size, pattern)
+    start = time.perf_counter()
+    for chunk in chunks:
+        avr.data_received(chunk)
+        if pattern == "steady":
+            await asyncio.sleep(0)
+    if avr._assemble_task is not None:
+        await avr._assemble_task
+    elapsed = time.perf_counter() - start
+    return {
+        "benchmark": "parse",
+        "params": {"chunk_size": chunk_size, "pattern": pattern},
+        "unit": "msg/s",
+        "value": messages / elapsed,
+    }
+
+
+async def bench_replay(path: str) -> Dict[str, Any]:
+    """Measure messages per second replaying a recording."""
+    _, records = read_recording(path)
+    messages = sum(r.data.count(b";") for r in records if r.direction == RECEIVED)
+    avr = AVR(loop=asyncio.get_running_loop())
+    start = time.perf_counter()
+    await replay(path, avr)
+    elapsed = time.perf_counter() - start
+    return {
+        "benchmark": "replay",
+        "params": {"recording": os.path.basename(path)},
+        "unit": "msg/s",
+        "value": messages / elapsed,
+    }
+
+
+async def bench_fleet(devices: int, repeat: int) -> List[Dict[str, Any]]:
+    """Time starting a fleet of emulated devices and querying all of them."""
+    start_samples = []
+    query_samples = []
+    async with AsyncExitStack() as stack:
+        emulators = [
+            await stack.enter_async_context(
+                DeviceEmulator(model=ZONE_MODELS[2], power=True)
+            )
+            for _ in range(devices)
+        ]
+        for _ in range(repeat):
+            fleet = AVRFleet()
+            for number, device in enumerate(emulators):
+                fleet.add(f"avr{number}", device.host, device.port)
+            start = time.perf_counter()
+            failed = await fleet.start(timeout=60)
+            start_samples.append(time.perf_counter() - start)
+            if failed:
+                raise RuntimeError(f"{len(failed)} devices not initialised")
+            for _ in range(repeat):
+                start = time.perf_counter()
+                results = await fleet.query("Z1POW", timeout=5)
+                query_samples.append(time.perf_counter() - start)
+                if any(isinstance(result, Exception) for result in results.values()):
+                    raise RuntimeError("Fleet query failed")
+            fleet.close()
+            await _wait_until(lambda: all(d.clients == 0 for d in emulators), 30)
+    params = {"devices": devices}
+    return [
+        {
+            "benchmark": "fleet_start",
+            "params": params,
+            "unit": "ms",
+            **_stats(start_samples),
+        },
+        {
+            "benchmark": "fleet_query",
+            "params": params,
+            "unit": "ms",
+            **_stats(query_samples),
+        },
+    ]
+
+
+async def run_benchmarks(
+    quick: bool = False, recordings: Sequence[str] = ()
+) -> Dict[str, Any]:
+    """Run every benchmark and return the results.
+
+    :param quick:
+        run fewer and smaller iterations, used by the test suite
+    :param recordings:
+        sessions to replay, see anthemav.recorder
+    """
+    repeat = 3 if quick else 20
+    latencies = [0.0] if quick else [0.0, 0.002]
+    zone_counts = [2, 8] if quick else [2, 4, 8]
+    messages = 2000 if quick else 50000
+    fleet_sizes = [20] if quick else [50, 200]
+
+    results = []
+    for latency in latencies:
+        for model in ("MRX 720", "MRX 740", "MDX-16"):
+            results.append(await bench_connect(model, latency, repeat))
+        for zones in zone_counts:
+            results.append(await bench_refresh(zones, latency, repeat))
+    for pattern, chunk_sizes in (("steady", [0]), ("burst", [64, 512, 4096])):
+        for chunk_size in chunk_sizes:
+            results.append(await bench_parse(messages, chunk_size, pattern))
+    for recording in recordings:
+        results.append(await bench_replay(recording))
+    for devices in fleet_sizes:
+        results.extend(await bench_fleet(devices, repeat))
+
+    return {
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "timestamp": time.time(),
+        "quick": quick,
+        "results": results,
+    }
+
+
+def _result_key(result: Dict[str, Any]) -> str:
+    """Identify a result across runs."""
+    params = ",".join(f"{k}={v}" for k, v in sorted(result["params"].items()))
+    return f"{result['benchmark']}[{params}]"
+
+
+def compare_results(
+    baseline: Dict[str, Any], current: Dict[str, Any], threshold: float
+) -> List[str]:
+    """Return the results that regressed by more than threshold (0.2 = 20%)."""
+    previous = {_result_key(r): r for r in baseline["results"]}
+    regressions = []
+    for result in current["results"]:
+        key = _result_key(result)
+        if key not in previous:
+            continue
+        if result["unit"] == "msg/s":
+            old, new = previous[key]["value"], result["value"]
+            change = (old - new) / old
+        else:
+            old, new = previous[key]["median"], result["median"]
+            change = (new - old) / old if old else 0
+        if change > threshold:
+            regressions.append(f"{key}: {old:.2f} -> {new:.2f} {result['unit']}")
+    return regressions
+
+
+def _format(result: Dict[str, Any]) -> str:
+    """Return a one line summary of a result."""
+    if result["unit"] == "msg/s":
+        return f"{_result_key(result):55} {result['value']:12,.0f} msg/s"
+    return (
+        f"{_result_key(result):55} median {result['median']:8.2f} ms"
+        f"  p95 {result['p95']:8.2f} ms"
+    )
+
+
+def main():
+    """Run the benchmarks from the command line."""
+    parser = argparse.ArgumentParser(description="Benchmark the anthemav library")
+    parser.add_argument("--output", "-o", help="Write the results to a JSON file")
+    parser.add_argument("--baseline", help="Compare with a previous JSON result")
+    parser.add_argument(
+        "--threshold", default="0.2", help="Regression tolerance (0.2 = 20%%)"
+    )
+    parser.add_argument("--quick", action="store_true", help="Fewer iterations")
+    parser.add_argument(
+        "--recording", action="append", default=[], help="Replay a recorded session"
+    )
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.ERROR)
+    results = asyncio.run(run_benchmarks(quick=args.quick, recordings=args.recording))
+    for result in results["results"]:
+        print(_format(result))
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+
+    if args.baseline:
+        with open(args.baseline, "r") as f:
+            baseline = json.load(f)
+        regressions = compare_results(baseline, results, float(args.threshold))
+        for regression in regressions:
+            print(f"Regression: {regression}")
+        if regressions:
+            sys.exit(1)
@@ -0,0 +1,141 @@
+"""Module containing the on-disk cache of what was learned about each device."""
+import asyncio
+import json
+import logging
+import os
+import threading
+from typing import Any, Dict, Optional
+
+from .protocol import AVR, EMPTY_MAC
+
+__all__ = ["StateCache"]
+
+CACHE_VERSION = 1
+# Seconds to collect the saves requested by connections before writing once
+SAVE_DELAY = 1.0
+
+
+class StateCache:
+    """JSON file holding the state of devices between runs, keyed by MAC address.
+
+    The model, zones, input names and the commands a device rejected take
+    several seconds to learn after connecting.  A Connection created with a
+    cache restores them before the device answers so the AVR is usable
+    right away, the normal queries then revalidate the restored values.
+    Devices are found by host and port, the last MAC address seen there.
+
+    Connections call save_soon(), which writes the file in a thread once for
+    all the saves requested within SAVE_DELAY, eg: when the devices of a
+    fleet lose their connection at the same time.
+    """
+
+    def __init__(self, path: str):
+        """Instantiate the cache and load the file if it exists.
+
+        :param path:
+            path of the JSON file
+        """
+        self.log = logging.getLogger(__name__)
+        self.path = path
+        self.devices: Dict[str, Dict[str, Any]] = {}
+        self.hosts: Dict[str, str] = {}
+        self._save_timer: asyncio.TimerHandle = None
+        self._saving: asyncio.Task = None
+        self._save_again = False
+        self._write_lock = threading.Lock()
+        self.load()
+
+    def load(self):
+        """Read the file, a missing or unreadable file is an empty cache."""
+        try:
+            with open(self.path, "r") as f:
+                data = json.load(f)
+        except FileNotFoundError:
+            return
+        except (OSError, ValueError) as error:
+            self.log.warning("Ignoring state cache %s: %s", self.path, error)
+            return
+        if not isinstance(data, dict) or data.get("version") != CACHE_VERSION:
+            self.log.warning("Ignoring state cache %s: unknown version", self.path)
+            return
+        self.devices = data.get("devices", {})
+        self.hosts = data.get("hosts", {})
+
+    def save(self):
+        """Write the file, replacing the previous one at once."""
+        self._write(self._dumps())
+
+    def save_soon(self, loop: asyncio.AbstractEventLoop, delay: float = SAVE_DELAY):
+        """Write the file in a thread after delay seconds, unless already planned.
+
+        :param loop:
+            asyncio event loop running the write
+        :param delay:
+            seconds to wait for other saves, a shorter delay than the one
+            already planned writes sooner
+        """
+        timer = self._save_timer
+        if timer is not None:
+            if timer.when() <= loop.time() + delay:
+                return
+            timer.cancel()
+        self._save_timer = loop.call_later(delay, self._start_save, loop)
+
+    async def flush(self):
+        """Write a planned save now and wait until the file is written."""
+        if self._save_timer is not None:
+            self._save_timer.cancel()
+            self._start_save(asyncio.get_running_loop())
+        if self._saving is not None:
+            await asyncio.shield(self._saving)
+
+    def _start_save(self, loop: asyncio.AbstractEventLoop):
+        """Write the current state in a thread, one write at a time."""
+        self._save_timer = None
+        if self._saving is not None:
+            # written again once the current write is done
+            self._save_again = True
+            return
+        self._saving = loop.create_task(self._save(loop))
+
+    async def _save(self, loop: asyncio.AbstractEventLoop):
+        try:
+            while True:
+                self._save_again = False
+                await loop.run_in_executor(None, self._write, self._dumps())
+                if not self._save_again:
+                    return
+        finally:
+            self._saving = None
+
+    def _dumps(self) -> str:
+        """Serialise the cache, on the loop so the devices don't change meanwhile."""
+        data = {"version": CACHE_VERSION, "devices": self.devices, "hosts": self.hosts}
+        return json.dumps(data, indent=2, sort_keys=True)
+
+    def _write(self, text: str):
+        """Replace the file at once, save() may run while a thread writes."""
+        temporary = f"{self.path}.tmp"
+        with self._write_lock:
+            try:
+                with open(temporary, "w") as f:
+                    f.write(text)
+                os.replace(temporary, self.path)
+            except OSError as error:
+                self.log.warning("Unable to write state cache %s: %s", self.path, error)
+
+    def lookup(self, host: str) -> Optional[Dict[str, Any]]:
+        """Return the state of the device last seen at host, eg: 10.0.0.5:14999."""
+        mac = self.hosts.get(host)
+        if mac is None:
+            return None
+        return self.devices.get(mac)
+
+    def store(self, host: str, avr: AVR) -> bool:
+        """Record the state of an initialised device, return False otherwise."""
+        mac = avr.macaddress
+        if mac == EMPTY_MAC or not avr._model_series:
+            return False
+        self.devices[mac] = avr.export_state()
+        self.hosts[host] = mac
+        return True
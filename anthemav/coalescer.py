@@ -0,0 +1,145 @@
+"""Module containing the rate limiter for continuous controls."""
+import asyncio
+import logging
+from typing import Callable, Dict, List
+
+__all__ = ["CommandCoalescer"]
+
+# Zone commands changed continuously by sliders, other commands are sent immediately
+COALESCED_ZONE_COMMANDS = ["VOL", "PVOL"]
+
+
+def _same_value(reported: str, sent: str) -> bool:
+    """Compare values the device may format differently, eg: -40 and -40.0."""
+    if reported == sent:
+        return True
+    try:
+        return float(reported) == float(sent)
+    except ValueError:
+        return False
+
+
+class CommandCoalescer:
+    """Send continuous controls at a maximum rate, keeping only the latest value.
+
+    Each item (eg: Z1VOL) is sent at most once per interval.  A value set
+    while the item is waiting for its slot replaces the previous one, so a
+    volume slider dragged across the whole range results in a handful of
+    commands instead of dozens.  Callers can wait for the device to report
+    the final value.
+    """
+
+    def __init__(
+        self,
+        send: Callable[[str], None],
+        loop: asyncio.AbstractEventLoop,
+        interval: float,
+    ):
+        """Instantiate the coalescer.
+
+        :param send:
+            function sending a raw command to the device
+        :param loop:
+            asyncio event loop
+        :param interval:
+            minimum number of seconds between two commands for the same item
+        """
+        self.log = logging.getLogger(__name__)
+        self.interval = interval
+        self.coalesced = 0
+        self._send = send
+        self._loop = loop
+        self._unsent: Dict[str, str] = {}
+        self._sent: Dict[str, str] = {}
+        self._last_send: Dict[str, float] = {}
+        self._timers: Dict[str, asyncio.TimerHandle] = {}
+        self._waiters: Dict[str, List[asyncio.Future]] = {}
+
+    @property
+    def pending(self) -> int:
+        """Number of items waiting for their slot."""
+        return len(self._unsent)
+
+    def submit(self, key: str, command: str, wait: bool = False) -> asyncio.Future:
+        """Queue the latest command for an item.
+
+        :param key:
+            item changed by the command, eg: Z1VOL
+        :param command:
+            raw command, eg: Z1VOL-40
+        :param wait:
+            return a future resolved with the value the device reports once
+            the latest command for the item has been applied, see
+            submit_and_wait to stop waiting after a timeout
+        """
+        if key in self._unsent:
+            self.coalesced += 1
+            self.log.debug("Replacing %s with %s", self._unsent[key], command)
+        self._unsent[key] = command
+
+        if key not in self._timers:
+            delay = self._last_send.get(key, 0) + self.interval - self._loop.time()
+            if key not in self._last_send or delay <= 0:
+                self._flush(key)
+            else:
+                self._timers[key] = self._loop.call_later(delay, self._flush, key)
+
+        if not wait:
+            return None
+        future = self._loop.create_future()
+        self._waiters.setdefault(key, []).append(future)
+        return future
+
+    async def submit_and_wait(self, key: str, command: str, timeout: float) -> str:
+        """Queue the latest command for an item and wait for the device to apply it.
+
+        Return the value reported by the device, the caller stops waiting
+        after timeout seconds or when cancelled.
+        """
+        future = self.submit(key, command, wait=True)
+        try:
+            return await asyncio.wait_for(future, timeout)
+        finally:
+            waiters = self._waiters.get(key)
+            if waiters is not None and future in waiters:
+                waiters.remove(future)
+                if not waiters:
+                    del self._waiters[key]
+
+    def _flush(self, key: str):
+        """Send the latest command of an item."""
+        self._timers.pop(key, None)
+        command = self._unsent.pop(key, None)
+        if command is None:
+            return
+        self._last_send[key] = self._loop.time()
+        self._sent[key] = command[len(key) :]
+        self._send(command)
+
+    def confirm(self, key: str, value: str):
+        """Handle a value reported by the device for an item."""
+        if key in self._unsent or key not in self._sent:
+            return
+        if not _same_value(value, self._sent[key]):
+            return
+        del self._sent[key]
+        for future in self._waiters.pop(key, []):
+            if not future.done():
+                future.set_result(value)
+
+    def reject(self, key: str, error: Exception):
+        """Fail the callers waiting for an item the device refused to change."""
+        self._sent.pop(key, None)
+        for future in self._waiters.pop(key, []):
+            if not future.done():
+                future.set_exception(error)
+
+    def reset(self, error: Exception):
+        """Drop every unsent command and fail the callers still waiting."""
+        for timer in self._timers.values():
+            timer.cancel()
+        self._timers.clear()
+        self._unsent.clear()
+        self._sent.clear()
+        for key in list(self._waiters):
+            self.reject(key, error)
@@ -1,11 +1,28 @@
 """Module containing the connection wrapper for the AVR interface."""
 import asyncio
 import logging
+import socket
 from typing import Callable
 from .protocol import AVR
+from .cache import SAVE_DELAY, StateCache
+from .reconnect import ReconnectPolicy
+from .device_error import CommandError
 
 __all__ = ["Connection"]
 
+# Query sent by the heartbeat, every device answers it even in standby
+HEARTBEAT_ITEM = "Z1POW"
+# Seconds to wait for the device to answer the heartbeat
+HEARTBEAT_TIMEOUT = 5.0
+# Unanswered heartbeats before the connection is considered dead
+HEARTBEAT_MISSES = 2
+
+# TCP keepalive: idle seconds before the first probe, seconds between probes
+# and unanswered probes before the OS drops the connection
+KEEPALIVE_IDLE = 30
+KEEPALIVE_INTERVAL = 10
+KEEPALIVE_COUNT = 3
+
 
 class Connection:
     """Connection handler to maintain network connection for AVR Protocol."""
@@ -16,11 +33,21 @@ class Connection:
         self.host = ""
         self.port = 0
         self._loop: asyncio.AbstractEventLoop = None
-        self._retry_interval = 1
+        self._retry_interval = 0.0
+        self._failures = 0
+        self._policy = ReconnectPolicy()
+        self._resumed = asyncio.Event()
+        self._resumed.set()
         self._closed = False
         self._closing = False
         self._halted = False
         self._auto_reconnect = False
+        self._cache: StateCache = None
+        self._heartbeat_interval: float = None
+        self._heartbeat_timeout = HEARTBEAT_TIMEOUT
+        self._heartbeat: asyncio.Task = None
+        self._keepalive = False
+        self._nodelay = True
         self.protocol: asyncio.Protocol = None
 
     @classmethod
@@ -32,6 +59,12 @@ class Connection:
         loop: asyncio.AbstractEventLoop = None,
         protocol_class: asyncio.Protocol = AVR,
         update_callback: Callable[[str], None] = None,
+        cache: StateCache = None,
+        heartbeat_interval: float = None,
+        heartbeat_timeout: float = HEARTBEAT_TIMEOUT,
+        keepalive: bool = False,
+        nodelay: bool = True,
+        reconnect_policy: ReconnectPolicy = None,
     ):
         """Initiate a connection to a specific device.
 
@@ -48,6 +81,21 @@ class Connection:
             asyncio.loop for async operation
         :param update_callback"
             This function is called whenever AVR state data changes
+        :param cache:
+            Restore the device state learned by a previous run (optional)
+        :param heartbeat_interval:
+            Seconds without any data from the device before querying it, the
+            connection is dropped and reconnected when it doesn't answer
+            (optional, disabled by default)
+        :param heartbeat_timeout:
+            Seconds to wait for the device to answer the heartbeat
+        :param keepalive:
+            Enable TCP keepalive on the socket
+        :param nodelay:
+            Send commands without waiting to fill a TCP segment (TCP_NODELAY)
+        :param reconnect_policy:
+            Delays between reconnection attempts, share one to limit the
+            attempts of many connections (optional)
 
         :type host:
             str
@@ -59,6 +107,18 @@ class Connection:
             asyncio.loop
         :type update_callback:
             callable
+        :type cache:
+            StateCache
+        :type heartbeat_interval:
+            float
+        :type heartbeat_timeout:
+            float
+        :type keepalive:
+            boolean
+        :type nodelay:
+            boolean
+        :type reconnect_policy:
+            ReconnectPolicy
         """
         assert port >= 0, f"Invalid port value: {port}"
         conn = cls()
@@ -66,14 +126,24 @@ class Connection:
         conn.host = host
         conn.port = port
         conn._loop = loop or asyncio.get_event_loop()
-        conn._retry_interval = 1
+        conn._retry_interval = 0.0
+        conn._failures = 0
+        if reconnect_policy is not None:
+            conn._policy = reconnect_policy
         conn._closed = False
         conn._closing = False
         conn._halted = False
         conn._auto_reconnect = auto_reconnect
+        conn._cache = cache
+        conn._heartbeat_interval = heartbeat_interval
+        conn._heartbeat_timeout = heartbeat_timeout
+        conn._keepalive = keepalive
+        conn._nodelay = nodelay
 
         async def connection_lost():
             """Function callback for Protocoal class when connection is lost."""
+            if not conn._closing:
+                conn.save_state()
             if conn._auto_reconnect and not conn._closing:
                 await conn.reconnect()
 
@@ -83,6 +153,11 @@ class Connection:
             update_callback=update_callback,
         )
 
+        if cache is not None:
+            state = cache.lookup(f"{host}:{port}")
+            if state is not None:
+                conn.protocol.restore_state(state)
+
         if auto_reconnect:
             await conn.reconnect()
 
@@ -97,46 +172,162 @@ class Connection:
         """
         return self.protocol.transport
 
-    def _get_retry_interval(self):
-        return self._retry_interval
+    @property
+    def state(self) -> str:
+        """Return the state of the connection.
 
-    def _reset_retry_interval(self):
-        self._retry_interval = 1
+        One of closing, halted, connected or disconnected (waiting to
+        reconnect).
+        """
+        if self._closing:
+            return "closing"
+        if self._halted:
+            return "halted"
+        if self.protocol is not None and self.protocol.transport is not None:
+            return "connected"
+        return "disconnected"
 
-    def _increase_retry_interval(self):
-        self._retry_interval = min(300, 1.5 * self._retry_interval)
+    @property
+    def retry_interval(self) -> float:
+        """Return the seconds to wait before the next reconnection attempt."""
+        return self._retry_interval
 
     async def reconnect(self):
         """Connect to the host and keep the connection open."""
         while True:
             try:
                 if self._halted:
-                    await asyncio.sleep(2)
+                    await self._resumed.wait()
                 else:
                     self.log.debug(
                         "Connecting to Anthem AVR at %s:%d", self.host, self.port
                     )
-                    await self._loop.create_connection(
-                        lambda: self.protocol, self.host, self.port
-                    )
-                    self._reset_retry_interval()
+                    async with self._policy.attempt():
+                        metrics = getattr(self.protocol, "metrics", None)
+                        if metrics is not None:
+                            metrics.reconnect_attempts += 1
+                        transport, _ = await self._loop.create_connection(
+                            lambda: self.protocol, self.host, self.port
+                        )
+                    self._configure_socket(transport)
+                    self._start_heartbeat(transport)
+                    self._failures = 0
+                    self._retry_interval = 0.0
                     return
 
             except OSError:
-                self._increase_retry_interval()
-                interval = self._get_retry_interval()
-                self.log.warning("Connecting failed, retrying in %i seconds", interval)
+                metrics = getattr(self.protocol, "metrics", None)
+                if metrics is not None:
+                    metrics.reconnect_failures += 1
+                self._failures += 1
+                self._retry_interval = self._policy.delay(self._failures)
+                self.log.warning(
+                    "Connecting failed, retrying in %.1f seconds", self._retry_interval
+                )
                 if not self._auto_reconnect or self._closing:
                     raise
-                await asyncio.sleep(interval)
+                await asyncio.sleep(self._retry_interval)
 
             if not self._auto_reconnect or self._closing:
                 break
 
+    def _configure_socket(self, transport: asyncio.Transport):
+        """Apply the TCP_NODELAY and keepalive options to the socket."""
+        sock = transport.get_extra_info("socket")
+        if sock is None:
+            return
+        try:
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, int(self._nodelay))
+            if self._keepalive:
+                sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+                # the timings are only tunable on some platforms (eg: Linux)
+                for option, value in (
+                    ("TCP_KEEPIDLE", KEEPALIVE_IDLE),
+                    ("TCP_KEEPINTVL", KEEPALIVE_INTERVAL),
+                    ("TCP_KEEPCNT", KEEPALIVE_COUNT),
+                ):
+                    if hasattr(socket, option):
+                        sock.setsockopt(
+                            socket.IPPROTO_TCP, getattr(socket, option), value
+                        )
+        except OSError as error:
+            self.log.warning("Unable to set socket options: %s", error)
+
+    def _start_heartbeat(self, transport: asyncio.Transport):
+        """Start checking that the device answers on a new connection."""
+        self._stop_heartbeat()
+        if self._heartbeat_interval:
+            self._heartbeat = self._loop.create_task(self._run_heartbeat(transport))
+
+    def _stop_heartbeat(self):
+        if self._heartbeat is not None:
+            self._heartbeat.cancel()
+            self._heartbeat = None
+
+    async def _run_heartbeat(self, transport: asyncio.Transport):
+        """Query the device when it's quiet and drop the connection if it's dead.
+
+        A device that disappears from the network without closing the
+        connection is otherwise only noticed when the OS gives up on the
+        socket, which can take many minutes.  Any data received from the
+        device counts as an answer, so the query is only sent when the
+        device has been quiet for heartbeat_interval seconds.
+        """
+        missed = 0
+        received = self.protocol.frames_received
+        while self.protocol.transport is transport:
+            await asyncio.sleep(self._heartbeat_interval)
+            if self.protocol.transport is not transport:
+                return
+            if self.protocol.frames_received != received:
+                received = self.protocol.frames_received
+                missed = 0
+                continue
+            try:
+                await self.protocol.async_query(
+                    HEARTBEAT_ITEM, timeout=self._heartbeat_timeout
+                )
+                missed = 0
+            except CommandError:
+                # an error message is still an answer
+                missed = 0
+            except ConnectionError:
+                return
+            except asyncio.TimeoutError:
+                missed += 1
+                self.log.warning(
+                    "No answer to heartbeat from %s (%d/%d)",
+                    self.host,
+                    missed,
+                    HEARTBEAT_MISSES,
+                )
+                if missed >= HEARTBEAT_MISSES:
+                    self.log.warning("Dropping dead connection to %s", self.host)
+                    transport.abort()
+                    return
+            received = self.protocol.frames_received
+
+    def save_state(self, delay: float = SAVE_DELAY):
+        """Record the state of the device in the cache, if one was given.
+
+        The file is written in a thread after delay seconds, once for every
+        connection sharing the cache, see StateCache.save_soon().
+        """
+        if self._cache is not None and self._cache.store(
+            f"{self.host}:{self.port}", self.protocol
+        ):
+            if self._loop is None or self._loop.is_closed():
+                self._cache.save()
+            else:
+                self._cache.save_soon(self._loop, delay)
+
     def close(self):
         """Close the AVR device connection and don't try to reconnect."""
         self.log.debug("Closing connection to AVR")
         self._closing = True
+        self._resumed.set()
+        self._stop_heartbeat()
+        self.save_state(delay=0)
         if self.protocol.transport:
             self.protocol.transport.close()
 
@@ -144,6 +335,8 @@ class Connection:
         """Close the AVR device connection and wait for a resume() request."""
         self.log.warning("Halting connection to AVR")
         self._halted = True
+        self._resumed.clear()
+        self._stop_heartbeat()
         if self.protocol.transport:
             self.protocol.transport.close()
 
@@ -151,6 +344,7 @@ class Connection:
         """Resume the AVR device connection if we have been halted."""
         self.log.warning("Resuming connection to AVR")
         self._halted = False
+        self._resumed.set()
 
     @property
     def dump_conndata(self):
@@ -1,2 +1,10 @@
 class DeviceError(Exception):
     """Error triggered when the device couldn't initialised by receiving the basic information"""
+
+
+class CommandError(Exception):
+    """Error triggered when the device answers a command or query with an error message"""
+
+    def __init__(self, message: str, command: str):
+        super().__init__(message)
+        self.command = command
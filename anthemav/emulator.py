@@ -0,0 +1,383 @@
+"""Module containing an emulator of the Anthem network protocol.
+
+The emulator is an asyncio TCP server answering like an Anthem receiver.  It
+is used by the test suite and the benchmarks and lets you develop without
+any hardware, see the anthemav_emulator command line tool.
+"""
+import asyncio
+import logging
+from collections import deque
+from typing import Callable, Deque, Dict, List, Optional, Set, Tuple
+
+from .parser import parse_message
+from .protocol import (
+    ATTR_POWERED_ON,
+    LOOKUP_INDEX,
+    MODEL_MDX,
+    MODEL_X20,
+    MODEL_X40,
+    ZONELOOKUP_INDEX,
+    model_series,
+)
+
+__all__ = ["DeviceEmulator"]
+
+DEFAULT_INPUTS = [
+    "Blu-ray",
+    "Game",
+    "Media Player",
+    "TV",
+    "Turntable",
+    "CD",
+    "Tuner",
+    "Aux",
+    "Phono",
+    "Streamer",
+    "Network",
+    "USB",
+]
+
+DEFAULT_MAC = "00:11:22:33:44:55"
+
+# Attributes of the main zone, only available while it is powered on
+MAIN_ZONE_STATE = {
+    "Z1VIR": "14",
+    "Z1IRH": "3840",
+    "Z1IRV": "2160",
+    "Z1AIC": "4",
+    "Z1AIF": "3",
+    "Z1BRT": "640",
+    "Z1SRT": "48",
+    "Z1AIN": "Dolby Digital",
+    "Z1AIR": "48 kHz",
+    "Z1ALM": "00",
+    "Z1DYN": "0",
+    "Z1DIA": "-27",
+}
+
+# Input numbers of the MDX 8, which are not consecutive
+MDX8_INPUT_NUMBERS = [1, 2, 3, 4, 9]
+
+
+def _choice(*values: str) -> Callable[[str], bool]:
+    """Validate a value from a fixed list."""
+    return lambda value: value in values
+
+
+def _range(low: int, high: int) -> Callable[[str], bool]:
+    """Validate an integer value within bounds."""
+
+    def check(value: str) -> bool:
+        try:
+            return low <= int(value) <= high
+        except ValueError:
+            return False
+
+    return check
+
+
+def _zone_of(key: str) -> Optional[int]:
+    """Return the zone an item belongs to, eg: 2 for Z2VOL."""
+    if key.startswith("Z") and key[1:2].isdigit():
+        return int(key[1])
+    return None
+
+
+class DeviceEmulator:
+    """Emulate an Anthem receiver of the x20, x40 or MDX series on a TCP port.
+
+    The behavior follows the model series the same way AVR.set_model_command
+    does: an MRX 740 reports its MAC address with EMAC/WMAC and the volume in
+    percent with PVOL, an MRX 720 uses IDN and attenuation only, an MDX 16
+    has 8 zones, a fixed list of input names and no audio information.
+    Commands a series doesn't know are answered with an error message.
+
+    Every command is answered after latency seconds, one at a time for each
+    client, which models the limited throughput of a real device.  Changes
+    are reported to every connected client, and push() sends unsolicited
+    changes like someone using the remote control.
+    """
+
+    def __init__(
+        self,
+        model: str = "MRX 740",
+        host: str = "127.0.0.1",
+        port: int = 0,
+        latency: float = 0.0,
+        boot_time: float = 0.0,
+        power: bool = False,
+        inputs: List[str] = None,
+    ):
+        """Instantiate the emulator.
+
+        :param model:
+            model name reported by IDM, which selects the behavior
+        :param host:
+            address to listen on
+        :param port:
+            TCP port to listen on, 0 picks a free port
+        :param latency:
+            seconds before answering each command
+        :param boot_time:
+            seconds after power on during which input names can't be queried
+        :param power:
+            initial power state of every zone
+        :param inputs:
+            names of the configured inputs
+        """
+        self.log = logging.getLogger(__name__)
+        self.model = model
+        self.series = model_series(model)
+        self.host = host
+        self.port = port
+        self.latency = latency
+        self.boot_time = boot_time
+        self.messages_received = 0
+        self.history: Deque[str] = deque(maxlen=1000)
+        self.state: Dict[str, str] = {}
+        self._validators: Dict[str, Callable[[str], bool]] = {}
+        self._ack_only: Set[str] = set()
+        self._clients: Set[asyncio.StreamWriter] = set()
+        self._handlers: Set[asyncio.Task] = set()
+        self._server: asyncio.AbstractServer = None
+        self._ready_at = 0.0
+
+        if self.series == MODEL_MDX:
+            self.zones = 8 if "16" in model else 4
+        else:
+            self.zones = 2
+        self._build_state(inputs or DEFAULT_INPUTS, power)
+
+    def _build_state(self, inputs: List[str], power: bool):
+        """Set the initial state and the writable items for the model series."""
+        state = self.state
+        state.update(
+            IDM=self.model, IDS="1.0.0", IDB="Jan 01 2022", IDH="1.0", IDR="US"
+        )
+        onoff = _choice("0", "1")
+        if self.series == MODEL_MDX:
+            del state["IDR"]
+            state["MAC"] = DEFAULT_MAC
+            numbers = MDX8_INPUT_NUMBERS if self.zones == 4 else range(1, 13)
+        else:
+            numbers = range(1, len(inputs) + 1)
+            state["ICN"] = str(len(inputs))
+            state.update(MAIN_ZONE_STATE)
+            self._validators.update(Z1ALM=_range(0, 16), Z1DYN=_range(0, 2))
+
+        for number in numbers:
+            name = inputs[(number - 1) % len(inputs)]
+            if self.series == MODEL_X40:
+                state[f"IS{number}IN"] = name
+                state[f"IS{number}ARC"] = "1"
+                self._validators[f"IS{number}ARC"] = onoff
+            else:
+                state[f"ISN{number:02d}"] = name
+
+        if self.series == MODEL_X20:
+            state.update(IDN=DEFAULT_MAC, ECH="1", SIP="1", FPB="2", Z1ARC="1")
+            self._validators.update(ECH=onoff, SIP=onoff, Z1ARC=onoff, FPB=_range(0, 3))
+        elif self.series == MODEL_X40:
+            state.update(EMAC=DEFAULT_MAC, WMAC=DEFAULT_MAC, GCFPB="2", GCTXS="1")
+            self._validators.update(GCFPB=_range(0, 3), GCTXS=_range(0, 2))
+
+        for zone in range(1, self.zones + 1):
+            prefix = f"Z{zone}"
+            state[prefix + "POW"] = "1" if power else "0"
+            state[prefix + "INP"] = "1"
+            state[prefix + "MUT"] = "0"
+            self._validators[prefix + "POW"] = onoff
+            self._validators[prefix + "MUT"] = onoff
+            self._validators[prefix + "INP"] = _range(1, max(numbers))
+            if self.series == MODEL_MDX:
+                state[prefix + "VOL"] = "50"
+                self._validators[prefix + "VOL"] = _range(0, 100)
+            else:
+                state[prefix + "VOL"] = "-40"
+                self._validators[prefix + "VOL"] = _range(-90, 0)
+            if self.series == MODEL_X40:
+                state[prefix + "PVOL"] = "56"
+                self._validators[prefix + "PVOL"] = _range(0, 100)
+                # x40 models only acknowledge mute changes with a bare semicolon
+                self._ack_only.add(prefix + "MUT")
+
+    #
+    # Server lifecycle
+    #
+
+    async def start(self):
+        """Start listening, the port is updated when it was picked by the system."""
+        self._server = await asyncio.start_server(
+            self._handle_client, self.host, self.port
+        )
+        self.port = self._server.sockets[0].getsockname()[1]
+        self.log.debug("Emulating %s on %s:%d", self.model, self.host, self.port)
+
+    async def stop(self):
+        """Stop listening and disconnect every client."""
+        if self._server is not None:
+            self._server.close()
+        for writer in list(self._clients):
+            writer.close()
+        if self._handlers:
+            # closing the writers ends the handlers as their reader reaches EOF
+            await asyncio.wait(self._handlers, timeout=1)
+        if self._server is not None:
+            await self._server.wait_closed()
+            self._server = None
+
+    async def __aenter__(self):
+        await self.start()
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.stop()
+
+    @property
+    def clients(self) -> int:
+        """Number of connected clients."""
+        return len(self._clients)
+
+    async def _handle_client(
+        self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter
+    ):
+        """Answer the commands of one client in order."""
+        handler = asyncio.current_task()
+        self._handlers.add(handler)
+        self._clients.add(writer)
+        try:
+            while True:
+                try:
+                    data = await reader.readuntil(b";")
+                except (asyncio.IncompleteReadError, ConnectionError):
+                    break
+                except asyncio.LimitOverrunError as error:
+                    self.log.warning("Dropping oversized command")
+                    await reader.readexactly(error.consumed)
+                    continue
+                message = data[:-1].decode(errors="replace")
+                self.messages_received += 1
+                self.history.append(message)
+                if self.latency:
+                    await asyncio.sleep(self.latency)
+                if writer.is_closing():
+                    break
+                self._process(writer, message)
+        finally:
+            self._clients.discard(writer)
+            self._handlers.discard(handler)
+            writer.close()
+
+    def _process(self, writer: asyncio.StreamWriter, message: str):
+        """Answer a command and report the changes it made."""
+        if message.endswith("?"):
+            response = self._query(message)
+            changes: List[str] = []
+        else:
+            response, changes = self._set(message)
+        if response is not None:
+            writer.write(f"{response};".encode())
+        if changes:
+            self._broadcast(changes, exclude=writer if response is not None else None)
+
+    def _broadcast(self, changes: List[str], exclude=None):
+        """Report changes to every client."""
+        if self.state.get("ECH", "1") == "0" or self.state.get("GCTXS", "1") == "0":
+            return
+        data = "".join(f"{change};" for change in changes).encode()
+        for client in self._clients:
+            if client is not exclude and not client.is_closing():
+                client.write(data)
+
+    #
+    # Protocol behavior
+    #
+
+    def _available(self, key: str, message: str) -> Optional[str]:
+        """Return the error for an item that can't be used right now."""
+        zone = _zone_of(key)
+        if zone is not None and not key.endswith("POW"):
+            if self.state.get(f"Z{zone}POW", "1") != "1":
+                return "!Z" + message
+        if key == "ICN" or key.startswith("IS"):
+            if asyncio.get_event_loop().time() < self._ready_at:
+                return "!E" + message
+        return None
+
+    def _query(self, message: str) -> str:
+        """Answer a query, eg: Z1VOL? answers Z1VOL-40."""
+        key = message[:-1]
+        if key not in self.state:
+            return "!I" + message
+        error = self._available(key, message)
+        if error is not None:
+            return error
+        return key + self.state[key]
+
+    def _split(self, message: str) -> Tuple[Optional[str], str]:
+        """Split a command between the item it changes and the new value."""
+        key = None
+        if _zone_of(message) is not None:
+            zone_command = ZONELOOKUP_INDEX.match(message[2:])
+            if zone_command is not None:
+                key = message[:2] + zone_command
+        if key is None:
+            key = LOOKUP_INDEX.match(message)
+        if key is None:
+            parsed_message = parse_message(message)
+            if parsed_message is not None:
+                key = parsed_message.command
+        if key is None:
+            return None, message
+        return key, message[len(key) :]
+
+    def _set(self, message: str) -> Tuple[Optional[str], List[str]]:
+        """Apply a command, return the answer and the changes to report."""
+        key, value = self._split(message)
+        validator = self._validators.get(key)
+        if validator is None:
+            return "!I" + message, []
+        if not validator(value):
+            return "!R" + message, []
+        error = self._available(key, message)
+        if error is not None:
+            return error, []
+
+        changes = self._apply(key, value)
+        if key in self._ack_only:
+            return "", changes
+        return None, changes
+
+    def _apply(self, key: str, value: str) -> List[str]:
+        """Update the state and return the changes to report."""
+        if key.endswith("ALM"):
+            value = value.zfill(2)
+        oldvalue = self.state.get(key)
+        self.state[key] = value
+        changes = [key + value]
+        if key.endswith("POW") and value == "1" and oldvalue != "1":
+            self._ready_at = asyncio.get_event_loop().time() + self.boot_time
+            if key == "Z1POW" and self.series != MODEL_MDX:
+                # the main zone reports its audio and video format when it powers on
+                changes += [k + self.state[k] for k in ATTR_POWERED_ON]
+        elif key.endswith("PVOL"):
+            volume_key = key[:2] + "VOL"
+            self.state[volume_key] = str(round(int(value) / 100 * 90) - 90)
+            changes.append(volume_key + self.state[volume_key])
+        elif key.endswith("VOL") and self.series == MODEL_X40:
+            percent_key = key[:2] + "PVOL"
+            self.state[percent_key] = str(round((90 + int(value)) / 90 * 100))
+            changes.append(percent_key + self.state[percent_key])
+        return changes
+
+    def push(self, message: str):
+        """Change an item as if done on the device and report it to every client.
+
+        :Example:
+
+        >>> push('Z1VOL-35')
+        """
+        key, value = self._split(message)
+        if key is None:
+            raise ValueError(f"Unknown item in {message}")
+        self._broadcast(self._apply(key, value))
@@ -0,0 +1,328 @@
+"""Module containing the structured change events of the AVR state."""
+import asyncio
+import logging
+import time
+from collections import deque
+from typing import (
+    Callable,
+    Deque,
+    Dict,
+    Hashable,
+    Iterable,
+    List,
+    NamedTuple,
+    Optional,
+)
+
+__all__ = ["StateChange", "ChangeStream"]
+
+# What a ChangeStream does with a new change when it is full
+OVERFLOW_POLICIES = ["drop_oldest", "coalesce", "block"]
+
+
+class StateChange(NamedTuple):
+    """A value of the device that changed.
+
+    key is the item as sent by the device, eg: Z1VOL, IDM or IS3IN, and
+    zone the zone number for Z<n> items, None otherwise.  old is None the
+    first time an item is received.
+    """
+
+    zone: Optional[int]
+    key: str
+    old: Optional[str]
+    new: str
+    timestamp: float
+
+
+ChangeCallback = Callable[[List[StateChange]], None]
+KeyCallback = Callable[[StateChange], None]
+
+
+def zone_of(key: str) -> Optional[int]:
+    """Return the zone of an item, eg: 2 for Z2VOL, None for IDM."""
+    if key.startswith("Z") and key[1:2].isdigit():
+        return int(key[1])
+    return None
+
+
+class _Subscriber:
+    """A callback and the changes waiting to be delivered to it."""
+
+    def __init__(self, callback: ChangeCallback, interval: Optional[float]):
+        self.callback = callback
+        self.interval = interval
+        self.changes: List[StateChange] = []
+        self.timer: asyncio.TimerHandle = None
+
+
+class ChangeDispatcher:
+    """Collect the changes of a batch of messages and hand them to subscribers.
+
+    The AVR records the changes while it parses the messages it received
+    together and calls flush() once they are all parsed.  Subscribers get a
+    list of changes either at every flush or at most once per interval.
+    Key subscribers are indexed by item and called once per change of that
+    item, changes of other items cost a dict lookup.
+    """
+
+    def __init__(self, loop: Callable[[], asyncio.AbstractEventLoop]):
+        """Instantiate the dispatcher.
+
+        :param loop:
+            function returning the event loop, used for the interval timers
+        """
+        self.log = logging.getLogger(__name__)
+        self._get_loop = loop
+        self._subscribers: List[_Subscriber] = []
+        self._batch: List[StateChange] = []
+        self._by_key: Dict[str, List[KeyCallback]] = {}
+        self._keyed: List[StateChange] = []
+
+    def __bool__(self) -> bool:
+        """Return True if anybody is subscribed."""
+        return bool(self._subscribers) or bool(self._by_key)
+
+    def subscribe(
+        self, callback: ChangeCallback, interval: Optional[float] = None
+    ) -> Callable[[], None]:
+        """Register a callback, return a function removing it."""
+        subscriber = _Subscriber(callback, interval)
+        self._subscribers.append(subscriber)
+
+        def unsubscribe():
+            if subscriber in self._subscribers:
+                self._subscribers.remove(subscriber)
+            if subscriber.timer is not None:
+                subscriber.timer.cancel()
+
+        return unsubscribe
+
+    def on_change(self, key: str, callback: KeyCallback) -> Callable[[], None]:
+        """Register a callback for an item, return a function removing it."""
+        # replaced rather than appended so flush() can iterate safely
+        self._by_key[key] = self._by_key.get(key, []) + [callback]
+
+        def unsubscribe():
+            callbacks = [c for c in self._by_key.get(key, []) if c is not callback]
+            if callbacks:
+                self._by_key[key] = callbacks
+            else:
+                self._by_key.pop(key, None)
+
+        return unsubscribe
+
+    def record(self, key: str, old: Optional[str], new: str):
+        """Add a change to the current batch."""
+        keyed = key in self._by_key
+        if not keyed and not self._subscribers:
+            return
+        change = StateChange(zone_of(key), key, old, new, time.time())
+        if keyed:
+            self._keyed.append(change)
+        if self._subscribers:
+            self._batch.append(change)
+
+    def flush(self):
+        """Deliver the current batch."""
+        if self._keyed:
+            keyed, self._keyed = self._keyed, []
+            for change in keyed:
+                for callback in self._by_key.get(change.key, ()):
+                    self._deliver(callback, change)
+        if not self._batch:
+            return
+        batch, self._batch = self._batch, []
+        for subscriber in list(self._subscribers):
+            if subscriber.interval is None:
+                self._deliver(subscriber.callback, batch)
+                continue
+            subscriber.changes.extend(batch)
+            if subscriber.timer is None:
+                subscriber.timer = self._get_loop().call_later(
+                    subscriber.interval, self._tick, subscriber
+                )
+
+    def _tick(self, subscriber: _Subscriber):
+        """Deliver the changes collected during an interval."""
+        subscriber.timer = None
+        changes, subscriber.changes = subscriber.changes, []
+        if changes and subscriber in self._subscribers:
+            self._deliver(subscriber.callback, changes)
+
+    def _deliver(self, callback: Callable, changes):
+        """Call a subscriber, its errors don't affect the others."""
+        try:
+            callback(changes)
+        except Exception:
+            self.log.exception("Error in change subscriber %s", callback)
+
+
+class ChangeStream:
+    """Asynchronous iterator over the changes of the device state.
+
+    Every stream has its own queue of at most maxsize changes, so a slow
+    consumer doesn't delay the others.  When the queue is full:
+
+    - drop_oldest: the oldest change is dropped
+    - coalesce: a change replaces the queued change of the same key, keeping
+      the first old value, otherwise the oldest change is dropped
+    - block: nothing is dropped and reading from the device is paused until
+      the consumer catches up.  Messages already received are still parsed,
+      so the queue may grow past maxsize by one read.  Every consumer of the
+      device is delayed, use it only when no change may be lost.
+
+    Streams are created by AVR.changes() and stop when closed.
+    """
+
+    def __init__(
+        self,
+        keys: Optional[Iterable[str]] = None,
+        zone: Optional[int] = None,
+        maxsize: int = 256,
+        overflow: str = "drop_oldest",
+        pause: Callable[[], None] = None,
+        resume: Callable[[], None] = None,
+    ):
+        """Instantiate the stream.
+
+        :param keys:
+            items to receive, eg: Z1VOL or IDM, or VOL when a zone is given.
+            Every item when None.
+        :param zone:
+            only receive the items of this zone
+        :param maxsize:
+            number of changes queued before the overflow policy applies
+        :param overflow:
+            one of drop_oldest, coalesce or block
+        :param pause:
+            called when a blocking stream is full
+        :param resume:
+            called when a blocking stream has room again
+        """
+        if overflow not in OVERFLOW_POLICIES:
+            raise ValueError(f"Unknown overflow policy {overflow}")
+        if maxsize < 1:
+            raise ValueError("maxsize must be at least 1")
+        self.keys = frozenset(keys) if keys is not None else None
+        self.zone = zone
+        self.maxsize = maxsize
+        self.overflow = overflow
+        self.dropped = 0
+        self._pause = pause
+        self._resume = resume
+        self._paused = False
+        self._queue: Deque[StateChange] = deque()
+        self._latest: Dict[Hashable, StateChange] = {}
+        self._waiter: asyncio.Future = None
+        self._closed = False
+        self.unsubscribe: Callable[[], None] = None
+
+    def __len__(self) -> int:
+        """Number of changes waiting to be read."""
+        if self.overflow == "coalesce":
+            return len(self._latest)
+        return len(self._queue)
+
+    def _wants(self, change: StateChange) -> bool:
+        """Return True if the change matches the filters of the stream."""
+        if self.zone is not None:
+            if change.zone != self.zone:
+                return False
+            return self.keys is None or change.key[2:] in self.keys
+        return self.keys is None or change.key in self.keys
+
+    def put(self, changes: Iterable[StateChange]):
+        """Queue the changes the stream is interested in."""
+        if self._closed:
+            return
+        added = False
+        for change in changes:
+            if self._wants(change):
+                self._add(change)
+                added = True
+        if added and self._waiter is not None and not self._waiter.done():
+            self._waiter.set_result(None)
+
+    def _key(self, change: StateChange) -> Hashable:
+        """Return the item of a change, a coalescing stream keeps one per item."""
+        return change.key
+
+    def _merge(self, queued: StateChange, change: StateChange) -> StateChange:
+        """Return the change replacing a queued one of the same item."""
+        return change._replace(old=queued.old)
+
+    def put_change(self, change: StateChange):
+        """Queue a single change, used when subscribed to specific items."""
+        self.put((change,))
+
+    def _add(self, change: StateChange):
+        """Queue a change, applying the overflow policy."""
+        if self.overflow == "coalesce":
+            key = self._key(change)
+            queued = self._latest.get(key)
+            if queued is not None:
+                self._latest[key] = self._merge(queued, change)
+                return
+            if len(self._latest) >= self.maxsize:
+                del self._latest[next(iter(self._latest))]
+                self.dropped += 1
+            self._latest[key] = change
+            return
+
+        if len(self._queue) >= self.maxsize:
+            if self.overflow == "drop_oldest":
+                self._queue.popleft()
+                self.dropped += 1
+            elif not self._paused and self._pause is not None:
+                self._paused = True
+                self._pause()
+        self._queue.append(change)
+
+    def _pop(self) -> StateChange:
+        """Remove the oldest queued change."""
+        if self.overflow == "coalesce":
+            key = next(iter(self._latest))
+            return self._latest.pop(key)
+        change = self._queue.popleft()
+        if self._paused and len(self._queue) <= self.maxsize // 2:
+            self._unpause()
+        return change
+
+    def _unpause(self):
+        """Let the device be read again."""
+        if self._paused:
+            self._paused = False
+            if self._resume is not None:
+                self._resume()
+
+    def close(self):
+        """Stop the stream, the consumer gets the changes already queued."""
+        if self._closed:
+            return
+        self._closed = True
+        if self.unsubscribe is not None:
+            self.unsubscribe()
+        self._unpause()
+        if self._waiter is not None and not self._waiter.done():
+            self._waiter.set_result(None)
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self) -> StateChange:
+        while not len(self):
+            if self._closed:
+                raise StopAsyncIteration
+            self._waiter = asyncio.get_running_loop().create_future()
+            try:
+                await self._waiter
+            finally:
+                self._waiter = None
+        return self._pop()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        self.close()
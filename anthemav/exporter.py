@@ -0,0 +1,318 @@
+"""Module exporting the health of AVR connections in the Prometheus text format.
+
+render_metrics() returns the text for a set of connections and
+MetricsExporter serves it over HTTP with asyncio, without any dependency.
+Counters and histograms from AVR.metrics are included for the devices where
+AVR.enable_metrics() was called.
+"""
+import asyncio
+import logging
+from typing import Dict, List, Mapping, Optional, Tuple
+
+from .connection import Connection
+
+__all__ = ["render_metrics", "MetricsExporter"]
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+CONNECTION_STATES = ["connected", "disconnected", "halted", "closing"]
+
+# name: (type, help) of every metric family, in the order they are rendered
+FAMILIES = {
+    "anthemav_device_info": ("gauge", "Model and MAC address of the device"),
+    "anthemav_connection_state": ("gauge", "Current state of the connection"),
+    "anthemav_reconnect_interval_seconds": (
+        "gauge",
+        "Delay before the next reconnection attempt",
+    ),
+    "anthemav_frames_received_total": ("counter", "Messages received"),
+    "anthemav_frames_sent_total": ("counter", "Messages sent"),
+    "anthemav_bytes_received_total": ("counter", "Bytes received"),
+    "anthemav_bytes_sent_total": ("counter", "Bytes sent"),
+    "anthemav_error_frames_total": ("counter", "Error messages received"),
+    "anthemav_connections_total": ("counter", "Connections established"),
+    "anthemav_reconnect_attempts_total": ("counter", "Connection attempts"),
+    "anthemav_reconnect_failures_total": ("counter", "Failed connection attempts"),
+    "anthemav_frame_queue_depth": ("gauge", "Messages received and not parsed"),
+    "anthemav_pending_requests": ("gauge", "Callers waiting for an answer"),
+    "anthemav_coalesced_commands": ("gauge", "Commands waiting for their slot"),
+    "anthemav_commands_in_flight": ("gauge", "Items sent and not reported yet"),
+    "anthemav_queued_commands": ("gauge", "Commands waiting to be sent"),
+    "anthemav_queued_commands_sent_total": ("counter", "Commands sent by the queue"),
+    "anthemav_queued_commands_dropped_total": (
+        "counter",
+        "Commands dropped because the queue was full",
+    ),
+    "anthemav_queued_commands_joined_total": (
+        "counter",
+        "Queries joined to an identical one instead of being sent",
+    ),
+    "anthemav_unacknowledged_commands": (
+        "gauge",
+        "Commands sent and not acknowledged by the device",
+    ),
+    "anthemav_unacknowledged_commands_expired_total": (
+        "counter",
+        "Commands the device didn't acknowledge in time",
+    ),
+    "anthemav_queue_wait_seconds_total": (
+        "counter",
+        "Time commands spent waiting to be sent",
+    ),
+    "anthemav_write_paused": ("gauge", "Writing is paused by the transport"),
+    "anthemav_write_paused_seconds_total": (
+        "counter",
+        "Time writing was paused by the transport",
+    ),
+    "anthemav_time_to_initialised_seconds": (
+        "gauge",
+        "Time from connecting to receiving the device information",
+    ),
+    "anthemav_parse_duration_seconds": ("histogram", "Time to parse a message"),
+    "anthemav_callback_duration_seconds": (
+        "histogram",
+        "Time spent in update_callback",
+    ),
+    "anthemav_command_round_trip_seconds": (
+        "histogram",
+        "Time from sending a command to the device reporting the item",
+    ),
+}
+
+Sample = Tuple[str, Dict[str, str], float]
+
+
+def _escape(value: str) -> str:
+    """Escape a label value."""
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_value(value: float) -> str:
+    """Format a sample value."""
+    if value == float("inf"):
+        return "+Inf"
+    if isinstance(value, int) or float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+def _histogram(
+    samples: List[Sample], name: str, labels: Dict[str, str], snapshot: Dict
+):
+    """Add the samples of a histogram snapshot from anthemav.metrics."""
+    for bound, count in snapshot["buckets"].items():
+        samples.append(
+            (f"{name}_bucket", {**labels, "le": _format_value(bound)}, count)
+        )
+    samples.append((f"{name}_sum", labels, snapshot["sum"]))
+    samples.append((f"{name}_count", labels, snapshot["count"]))
+
+
+def _collect(name: str, conn: Connection) -> Dict[str, List[Sample]]:
+    """Return the samples of a connection grouped by metric family."""
+    families: Dict[str, List[Sample]] = {family: [] for family in FAMILIES}
+    labels = {"device": name}
+    avr = conn.protocol
+
+    def add(family: str, value: float, **extra: str):
+        families[family].append((family, {**labels, **extra}, value))
+
+    state = conn.state
+    for known_state in CONNECTION_STATES:
+        add("anthemav_connection_state", int(state == known_state), state=known_state)
+    add("anthemav_reconnect_interval_seconds", conn.retry_interval)
+    if avr is None:
+        return families
+
+    add(
+        "anthemav_device_info",
+        1,
+        model=avr.model,
+        mac=avr.macaddress,
+    )
+    add("anthemav_frames_received_total", avr.frames_received)
+    add("anthemav_frame_queue_depth", avr.frame_queue_depth)
+    add("anthemav_pending_requests", avr.pending_requests)
+    add("anthemav_coalesced_commands", avr.coalesced_commands)
+    for priority, stats in avr.command_stats.items():
+        add("anthemav_queued_commands", stats["queued"], priority=priority)
+        add("anthemav_queued_commands_sent_total", stats["sent"], priority=priority)
+        add(
+            "anthemav_queued_commands_dropped_total",
+            stats["dropped"],
+            priority=priority,
+        )
+        add(
+            "anthemav_queued_commands_joined_total",
+            stats["joined"],
+            priority=priority,
+        )
+        add(
+            "anthemav_unacknowledged_commands",
+            stats["in_flight"],
+            priority=priority,
+        )
+        add(
+            "anthemav_unacknowledged_commands_expired_total",
+            stats["expired"],
+            priority=priority,
+        )
+        add("anthemav_queue_wait_seconds_total", stats["wait"], priority=priority)
+    add("anthemav_write_paused", int(avr.write_paused))
+    add("anthemav_write_paused_seconds_total", avr.write_paused_time)
+
+    metrics = avr.metrics
+    if metrics is None:
+        return families
+    snapshot = metrics.snapshot()
+    add("anthemav_frames_sent_total", snapshot["frames_out"])
+    add("anthemav_bytes_received_total", snapshot["bytes_in"])
+    add("anthemav_bytes_sent_total", snapshot["bytes_out"])
+    for kind, count in sorted(snapshot["error_frames"].items()):
+        add("anthemav_error_frames_total", count, kind=kind)
+    add("anthemav_connections_total", snapshot["connections"])
+    add("anthemav_reconnect_attempts_total", snapshot["reconnect_attempts"])
+    add("anthemav_reconnect_failures_total", snapshot["reconnect_failures"])
+    add("anthemav_commands_in_flight", snapshot["in_flight"])
+    if snapshot["time_to_initialised"] is not None:
+        add("anthemav_time_to_initialised_seconds", snapshot["time_to_initialised"])
+    _histogram(
+        families["anthemav_parse_duration_seconds"],
+        "anthemav_parse_duration_seconds",
+        labels,
+        snapshot["parse_duration"],
+    )
+    _histogram(
+        families["anthemav_callback_duration_seconds"],
+        "anthemav_callback_duration_seconds",
+        labels,
+        snapshot["callback_duration"],
+    )
+    for item, histogram in sorted(snapshot["round_trip"].items()):
+        _histogram(
+            families["anthemav_command_round_trip_seconds"],
+            "anthemav_command_round_trip_seconds",
+            {**labels, "item": item},
+            histogram,
+        )
+    return families
+
+
+def _format_samples(family: str, samples: List[Sample]) -> List[str]:
+    """Return the lines of a metric family."""
+    kind, description = FAMILIES[family]
+    lines = [f"# HELP {family} {description}", f"# TYPE {family} {kind}"]
+    for name, labels, value in samples:
+        label_text = ",".join(f'{k}="{_escape(str(v))}"' for k, v in labels.items())
+        lines.append(f"{name}{{{label_text}}} {_format_value(value)}")
+    return lines
+
+
+async def render_metrics(connections: Mapping[str, Connection]) -> str:
+    """Render the metrics of every connection in the Prometheus text format.
+
+    :param connections:
+        connections by device name, used as the device label
+
+    The event loop gets a chance to run between two devices so rendering
+    many receivers doesn't delay their messages.
+    """
+    families: Dict[str, List[Sample]] = {family: [] for family in FAMILIES}
+    for name, conn in list(connections.items()):
+        for family, samples in _collect(name, conn).items():
+            families[family].extend(samples)
+        await asyncio.sleep(0)
+
+    lines = []
+    for family, samples in families.items():
+        if samples:
+            lines.extend(_format_samples(family, samples))
+    return "\n".join(lines) + "\n"
+
+
+class MetricsExporter:
+    """Serve the metrics of AVR connections over HTTP on /metrics."""
+
+    def __init__(
+        self,
+        connections: Optional[Mapping[str, Connection]] = None,
+        host: str = "0.0.0.0",
+        port: int = 9300,
+    ):
+        """Instantiate the exporter.
+
+        :param connections:
+            connections by device name, more can be added with add()
+        :param host:
+            IP Address to listen on
+        :param port:
+            TCP port number to listen on, 0 picks a free port
+        """
+        self.log = logging.getLogger(__name__)
+        self.host = host
+        self.port = port
+        self.connections: Dict[str, Connection] = dict(connections or {})
+        self._server: asyncio.AbstractServer = None
+
+    def add(self, name: str, conn: Connection):
+        """Export the metrics of a connection."""
+        self.connections[name] = conn
+
+    def remove(self, name: str):
+        """Stop exporting the metrics of a connection."""
+        self.connections.pop(name, None)
+
+    async def start(self):
+        """Start listening, the port is updated when it was picked by the system."""
+        self._server = await asyncio.start_server(
+            self._handle_client, self.host, self.port
+        )
+        self.port = self._server.sockets[0].getsockname()[1]
+        self.log.debug("Exporting metrics on %s:%d", self.host, self.port)
+
+    async def stop(self):
+        """Stop listening."""
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+            self._server = None
+
+    async def __aenter__(self):
+        await self.start()
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.stop()
+
+    async def _handle_client(
+        self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter
+    ):
+        """Answer a single HTTP request."""
+        try:
+            request = await asyncio.wait_for(reader.readuntil(b"\r\n\r\n"), 5)
+            method, path = request.split(b" ", 2)[:2]
+            if method != b"GET":
+                status, body = "405 Method Not Allowed", ""
+            elif path.split(b"?")[0] != b"/metrics":
+                status, body = "404 Not Found", ""
+            else:
+                status, body = "200 OK", await render_metrics(self.connections)
+            payload = body.encode()
+            writer.write(
+                f"HTTP/1.1 {status}\r\n"
+                f"Content-Type: {CONTENT_TYPE}\r\n"
+                f"Content-Length: {len(payload)}\r\n"
+                "Connection: close\r\n\r\n".encode() + payload
+            )
+            await writer.drain()
+        except (
+            asyncio.TimeoutError,
+            asyncio.IncompleteReadError,
+            asyncio.LimitOverrunError,
+            ValueError,
+        ):
+            self.log.debug("Invalid metrics request")
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
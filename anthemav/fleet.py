@@ -0,0 +1,375 @@
+"""Module containing the manager of many devices sharing an event loop."""
+import asyncio
+import logging
+from typing import (
+    Awaitable,
+    Callable,
+    Dict,
+    Hashable,
+    Iterable,
+    List,
+    NamedTuple,
+    Optional,
+    Tuple,
+    Union,
+)
+
+from .cache import StateCache
+from .connection import Connection
+from .events import ChangeStream, StateChange
+from .protocol import AVR, COMMAND_TIMEOUT
+from .reconnect import ReconnectPolicy
+
+__all__ = ["AVRFleet", "DeviceChange", "FleetChangeStream"]
+
+# Connection attempts at the same time when the fleet creates its policy
+FLEET_CONCURRENCY = 16
+# Default time to wait for every device to be initialised by start()
+FLEET_START_TIMEOUT = 30.0
+
+FleetCallback = Callable[[str, List[StateChange]], None]
+Result = Union[str, Exception]
+
+
+class DeviceChange(NamedTuple):
+    """A change of the state of one device of a fleet."""
+
+    device: str
+    change: StateChange
+
+
+class FleetChangeStream(ChangeStream):
+    """Asynchronous iterator over the changes of every device of a fleet.
+
+    A ChangeStream of DeviceChange, the changes of the devices tagged with
+    their name.  It can't use the block overflow policy, a slow consumer
+    would pause every device of the fleet.
+    """
+
+    def __init__(
+        self,
+        keys: Optional[Iterable[str]] = None,
+        zone: Optional[int] = None,
+        maxsize: int = 1024,
+        overflow: str = "drop_oldest",
+    ):
+        """Instantiate the stream, see AVRFleet.changes()."""
+        if overflow == "block":
+            raise ValueError("A fleet stream can't block the devices")
+        super().__init__(keys, zone, maxsize, overflow)
+
+    def _wants(self, change: DeviceChange) -> bool:
+        return super()._wants(change.change)
+
+    def _key(self, change: DeviceChange) -> Hashable:
+        return change.device, change.change.key
+
+    def _merge(self, queued: DeviceChange, change: DeviceChange) -> DeviceChange:
+        return change._replace(change=super()._merge(queued.change, change.change))
+
+
+class AVRFleet:
+    """Manage the connections to many devices on one event loop.
+
+    Devices are added by name and connected by start().  They share a
+    reconnect policy, so at most concurrency of them try to connect at the
+    same time, at startup like after a network outage, and the others wait
+    their turn.  Every connection reconnects on its own once started.
+
+    The state of the devices is aggregated by name, their changes are
+    delivered to subscribers and streams with the name of the device, and
+    queries or commands can be sent to every device at once.  connections
+    can be handed to anthemav.exporter to export the health of the fleet.
+
+    :Example:
+
+    >>> fleet = AVRFleet()
+    >>> fleet.add("living", "192.168.1.20")
+    >>> fleet.add("bedroom", "192.168.1.21")
+    >>> await fleet.start()
+    >>> await fleet.query("Z1POW")
+    {'living': '1', 'bedroom': '0'}
+    """
+
+    def __init__(
+        self,
+        reconnect_policy: ReconnectPolicy = None,
+        concurrency: int = FLEET_CONCURRENCY,
+        loop: asyncio.AbstractEventLoop = None,
+        cache: StateCache = None,
+        heartbeat_interval: float = None,
+    ):
+        """Instantiate the fleet.
+
+        :param reconnect_policy:
+            policy shared by every connection (optional, one limited to
+            concurrency attempts is created by default)
+        :param concurrency:
+            connection attempts at the same time for the default policy
+        :param loop:
+            asyncio event loop (optional)
+        :param cache:
+            state cache shared by every device (optional)
+        :param heartbeat_interval:
+            heartbeat of every connection, see Connection.create (optional)
+        """
+        self.log = logging.getLogger(__name__)
+        self.policy = reconnect_policy or ReconnectPolicy(concurrency=concurrency)
+        self.connections: Dict[str, Connection] = {}
+        self.protocols: Dict[str, AVR] = {}
+        self._loop = loop
+        self._cache = cache
+        self._heartbeat_interval = heartbeat_interval
+        self._devices: Dict[str, Tuple[str, int]] = {}
+        self._tasks: Dict[str, asyncio.Task] = {}
+        self._unsubscribes: Dict[str, Callable[[], None]] = {}
+        self._subscribers: List[FleetCallback] = []
+        self._streams: List[FleetChangeStream] = []
+
+    def __len__(self) -> int:
+        """Return the number of devices."""
+        return len(self._devices)
+
+    def add(self, name: str, host: str, port: int = 14999):
+        """Add a device, it's connected by the next start()."""
+        if name in self._devices:
+            raise ValueError(f"Device {name} already exists")
+        self._devices[name] = (host, port)
+
+    def remove(self, name: str):
+        """Disconnect a device and forget it."""
+        self._devices.pop(name)
+        task = self._tasks.pop(name, None)
+        if task is not None and not task.done():
+            task.cancel()
+        unsubscribe = self._unsubscribes.pop(name, None)
+        if unsubscribe is not None:
+            unsubscribe()
+        self.protocols.pop(name, None)
+        conn = self.connections.pop(name, None)
+        if conn is not None:
+            conn.close()
+
+    async def start(self, timeout: float = FLEET_START_TIMEOUT) -> List[str]:
+        """Connect the devices added since the last start.
+
+        Wait until every device is initialised, at most timeout seconds, and
+        return the names of those that aren't.  They keep trying to connect
+        in the background.
+        """
+        loop = self._loop or asyncio.get_running_loop()
+        for name in self._devices:
+            if name not in self._tasks:
+                self._tasks[name] = loop.create_task(self._connect(name))
+        deadline = loop.time() + timeout
+        names = list(self._devices)
+        ready = await asyncio.gather(
+            *(self._wait_initialised(name, deadline) for name in names)
+        )
+        return [name for name, initialised in zip(names, ready) if not initialised]
+
+    async def _connect(self, name: str):
+        host, port = self._devices[name]
+
+        def create_protocol(**kwargs) -> AVR:
+            avr = AVR(**kwargs)
+            self._attach(name, avr)
+            return avr
+
+        self.connections[name] = await Connection.create(
+            host=host,
+            port=port,
+            loop=self._loop,
+            protocol_class=create_protocol,
+            cache=self._cache,
+            heartbeat_interval=self._heartbeat_interval,
+            reconnect_policy=self.policy,
+        )
+
+    def _attach(self, name: str, avr: AVR):
+        """Forward the changes of a new device, before it's connected."""
+        self.protocols[name] = avr
+        self._unsubscribes[name] = avr.subscribe(
+            lambda changes: self._dispatch(name, changes)
+        )
+
+    async def _wait_initialised(self, name: str, deadline: float) -> bool:
+        loop = asyncio.get_running_loop()
+        try:
+            await asyncio.wait_for(
+                asyncio.shield(self._tasks[name]), deadline - loop.time()
+            )
+            await self.connections[name].protocol.wait_for_device_initialised(
+                max(0.0, deadline - loop.time())
+            )
+        except asyncio.TimeoutError:
+            self.log.warning("%s wasn't initialised in time", name)
+            return False
+        except Exception as error:
+            self.log.warning("%s wasn't initialised: %r", name, error)
+            return False
+        return True
+
+    def close(self):
+        """Disconnect every device."""
+        for task in self._tasks.values():
+            if not task.done():
+                task.cancel()
+        self._tasks.clear()
+        for conn in self.connections.values():
+            conn.close()
+        for stream in list(self._streams):
+            stream.close()
+
+    async def __aenter__(self):
+        await self.start()
+        return self
+
+    async def __aexit__(self, *exc_info):
+        self.close()
+
+    #
+    # Aggregated state
+    #
+
+    def state(self, name: str) -> str:
+        """Return the state of the connection to a device, see Connection.state."""
+        conn = self.connections.get(name)
+        if conn is not None:
+            return conn.state
+        return "connecting" if name in self._tasks else "stopped"
+
+    def states(self) -> Dict[str, str]:
+        """Return the state of the connection to every device."""
+        return {name: self.state(name) for name in self._devices}
+
+    def summary(self) -> Dict[str, int]:
+        """Return the number of devices in each connection state."""
+        counts: Dict[str, int] = {}
+        for state in self.states().values():
+            counts[state] = counts.get(state, 0) + 1
+        return counts
+
+    def status(self) -> Dict[str, Dict]:
+        """Return the connection state, model and power of the zones of every device."""
+        status = {}
+        for name in self._devices:
+            status[name] = {"state": self.state(name), "model": "", "power": {}}
+            avr = self.protocols.get(name)
+            if avr is not None:
+                status[name]["model"] = avr.model
+                status[name]["power"] = {
+                    number: zone.power for number, zone in avr.zones.items()
+                }
+        return status
+
+    #
+    # Changes
+    #
+
+    def _dispatch(self, name: str, changes: List[StateChange]):
+        for callback in list(self._subscribers):
+            try:
+                callback(name, changes)
+            except Exception:
+                self.log.exception("Error in fleet change callback")
+        if self._streams:
+            device_changes = [DeviceChange(name, change) for change in changes]
+            for stream in self._streams:
+                stream.put(device_changes)
+
+    def subscribe(self, callback: FleetCallback) -> Callable[[], None]:
+        """Call back with the name of a device and its changes, see AVR.subscribe().
+
+        :param callback: called with the device name and a list of StateChange
+        :return: function cancelling the subscription
+        """
+        self._subscribers.append(callback)
+
+        def unsubscribe():
+            if callback in self._subscribers:
+                self._subscribers.remove(callback)
+
+        return unsubscribe
+
+    def changes(
+        self,
+        keys: Optional[Iterable[str]] = None,
+        zone: Optional[int] = None,
+        maxsize: int = 1024,
+        overflow: str = "drop_oldest",
+    ) -> FleetChangeStream:
+        """Return an asynchronous iterator over the changes of every device.
+
+        The changes are filtered and queued like by AVR.changes(), with the
+        name of their device.  overflow is drop_oldest or coalesce.
+
+        :Example:
+
+        >>> async with fleet.changes() as changes:
+        ...     async for device, change in changes:
+        ...         print(device, change.key, change.new)
+        """
+        stream = FleetChangeStream(keys, zone, maxsize, overflow)
+        stream.unsubscribe = lambda: self._streams.remove(stream)
+        self._streams.append(stream)
+        return stream
+
+    #
+    # Bulk operations
+    #
+
+    async def _fan_out(
+        self, call: Callable[[AVR], Awaitable[str]], names: Iterable[str] = None
+    ) -> Dict[str, Result]:
+        """Run a request on every device concurrently, return the result of each.
+
+        A device that fails gets its exception as result, eg: a CommandError
+        or asyncio.TimeoutError, and ConnectionError when it isn't connected.
+        """
+        names = list(self._devices if names is None else names)
+
+        async def run(name: str) -> str:
+            conn = self.connections.get(name)
+            if conn is None or conn.protocol.transport is None:
+                raise ConnectionError(f"{name} isn't connected")
+            return await call(conn.protocol)
+
+        results = await asyncio.gather(
+            *(run(name) for name in names), return_exceptions=True
+        )
+        return dict(zip(names, results))
+
+    async def query(
+        self,
+        item: str,
+        timeout: float = COMMAND_TIMEOUT,
+        names: Iterable[str] = None,
+    ) -> Dict[str, Result]:
+        """Query an item on every device at once, see AVR.async_query().
+
+        :param item: Any of the data items from the API, eg: Z1POW
+        :param timeout: seconds to wait for each answer
+        :param names: devices to query (optional, all by default)
+        :return: value, or exception, by device name
+        """
+        return await self._fan_out(
+            lambda avr: avr.async_query(item, timeout=timeout), names
+        )
+
+    async def command(
+        self,
+        command: str,
+        timeout: float = COMMAND_TIMEOUT,
+        names: Iterable[str] = None,
+    ) -> Dict[str, Result]:
+        """Send a command to every device at once, see AVR.async_command().
+
+        :param command: Any command as documented in the Anthem API
+        :param timeout: seconds to wait for each confirmation
+        :param names: devices to command (optional, all by default)
+        :return: value confirmed, or exception, by device name
+        """
+        return await self._fan_out(
+            lambda avr: avr.async_command(command, timeout=timeout), names
+        )
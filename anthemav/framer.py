@@ -0,0 +1,118 @@
+"""Module containing the datagram framer for the Anthem network stream."""
+import logging
+from typing import List
+
+__all__ = ["DatagramFramer"]
+
+DELIMITER = b";"
+
+# Longest datagram we are willing to buffer while waiting for its delimiter.
+# Input names are the longest messages the device sends, well below this.
+DEFAULT_MAX_FRAME_SIZE = 1024
+# A decoded UTF-8 character is at most 4 bytes, datagrams of fewer than
+# max_frame_size / 4 characters are never too large
+MAX_BYTES_PER_CHAR = 4
+
+
+class DatagramFramer:
+    """Split the byte stream received from the device into datagrams.
+
+    The device terminates every datagram with a semicolon, but TCP does not
+    preserve those boundaries: one chunk can carry a burst of datagrams and a
+    single datagram can straddle two chunks.  The framer keeps the bytes that
+    follow the last semicolon until the rest of the datagram arrives.
+
+    Datagrams are only decoded once complete.  The delimiter is plain ASCII
+    and can never appear inside a multibyte UTF-8 sequence, so a character
+    split across chunks is always reassembled before it is decoded.
+    """
+
+    def __init__(
+        self, max_frame_size: int = DEFAULT_MAX_FRAME_SIZE, encoding: str = "utf-8"
+    ):
+        """Instantiate the framer.
+
+        :param max_frame_size:
+            Number of bytes after which a datagram is dropped
+        :param encoding:
+            Text encoding used by the device
+        """
+        self.log = logging.getLogger(__name__)
+        self.max_frame_size = max_frame_size
+        self.discarded_frames = 0
+        self._encoding = encoding
+        self._pending = bytearray()
+        self._discarding = False
+
+    @property
+    def pending(self) -> int:
+        """Number of bytes held back waiting for a delimiter."""
+        return len(self._pending)
+
+    def reset(self):
+        """Forget any partial datagram, eg: after the connection was lost."""
+        self._pending.clear()
+        self._discarding = False
+
+    def feed(self, data: bytes) -> List[str]:
+        """Add received bytes and return the datagrams they complete.
+
+        A bare semicolon from the device results in an empty string, which
+        the device uses to acknowledge some commands.
+        """
+        end = data.rfind(DELIMITER)
+        if end < 0:
+            self._hold(data)
+            return []
+
+        pending = self._pending
+        if pending:
+            pending += memoryview(data)[:end]
+            block = bytes(pending)
+            pending.clear()
+        else:
+            block = data[:end]
+
+        frames = str(block, self._encoding, "replace").split(";")
+        if (
+            len(block) > self.max_frame_size
+            and max(map(len, frames)) * MAX_BYTES_PER_CHAR > self.max_frame_size
+        ):
+            # a datagram may be too large, check the size of each one in bytes
+            frames = self._split_checked(block)
+        elif self._discarding:
+            # tail end of an oversized datagram that was already dropped
+            self._discarding = False
+            del frames[0]
+
+        if end + 1 < len(data):
+            self._hold(memoryview(data)[end + 1 :])
+        return frames
+
+    def _split_checked(self, block: bytes) -> List[str]:
+        """Split complete datagrams and drop those larger than the limit."""
+        parts = block.split(DELIMITER)
+        if self._discarding:
+            self._discarding = False
+            del parts[0]
+        frames = []
+        for part in parts:
+            if len(part) > self.max_frame_size:
+                self._discard()
+            else:
+                frames.append(str(part, self._encoding, "replace"))
+        return frames
+
+    def _discard(self):
+        self.log.warning("Dropping datagram larger than %d bytes", self.max_frame_size)
+        self.discarded_frames += 1
+
+    def _hold(self, data):
+        """Keep the start of an unterminated datagram."""
+        if self._discarding or not data:
+            return
+        self._pending += data
+        if len(self._pending) > self.max_frame_size:
+            self._discard()
+            self._pending.clear()
+            self._discarding = True
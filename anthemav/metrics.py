@@ -0,0 +1,153 @@
+"""Module containing the optional instrumentation of the AVR protocol."""
+from bisect import bisect_left
+from time import perf_counter
+from typing import Any, Dict, List, Optional
+
+__all__ = ["Histogram", "ProtocolMetrics"]
+
+# Upper bounds in seconds of the histogram buckets, the last one catches the rest
+DEFAULT_BUCKETS = (
+    0.0005,
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+    2.5,
+    5.0,
+    float("inf"),
+)
+
+# Answers arriving later than this are considered unsolicited updates
+MAX_ROUND_TRIP = 30.0
+
+
+class Histogram:
+    """Count durations in fixed buckets."""
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        """Instantiate an empty histogram."""
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value: float):
+        """Add a duration in seconds."""
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def snapshot(self) -> Dict[str, Any]:
+        """Return the cumulative count for each bucket upper bound."""
+        cumulative: List[int] = []
+        total = 0
+        for count in self.counts:
+            total += count
+            cumulative.append(total)
+        return {
+            "buckets": dict(zip(self.buckets, cumulative)),
+            "count": self.count,
+            "sum": self.sum,
+        }
+
+
+class ProtocolMetrics:
+    """Counters and latency histograms of an AVR protocol handler.
+
+    An instance only exists once AVR.enable_metrics() was called, every hook
+    in the protocol is skipped otherwise.
+    """
+
+    def __init__(self):
+        """Instantiate the metrics with every counter at zero."""
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.frames_in = 0
+        self.frames_out = 0
+        self.error_frames: Dict[str, int] = {}
+        self.connections = 0
+        self.reconnect_attempts = 0
+        self.reconnect_failures = 0
+        self.time_to_initialised: Optional[float] = None
+        self.round_trip: Dict[str, Histogram] = {}
+        self.parse_duration = Histogram()
+        self.callback_duration = Histogram()
+        self._connected_at: Optional[float] = None
+        self._sent: Dict[str, float] = {}
+
+    def connected(self):
+        """Record a new connection to the device."""
+        self.connections += 1
+        self._connected_at = perf_counter()
+        self.time_to_initialised = None
+        self._sent.clear()
+
+    def initialised(self):
+        """Record the device information being received after connecting."""
+        if self.time_to_initialised is None and self._connected_at is not None:
+            self.time_to_initialised = perf_counter() - self._connected_at
+
+    def sent(self, key: Optional[str], size: int):
+        """Record a command sent for an item."""
+        self.frames_out += 1
+        self.bytes_out += size
+        if key is not None and key not in self._sent:
+            self._sent[key] = perf_counter()
+
+    def answered(self, key: Optional[str]):
+        """Record the device reporting an item, closing its round trip if any."""
+        sent = self._sent.pop(key, None)
+        if sent is None:
+            return
+        elapsed = perf_counter() - sent
+        if elapsed > MAX_ROUND_TRIP:
+            return
+        histogram = self.round_trip.get(key)
+        if histogram is None:
+            histogram = self.round_trip[key] = Histogram()
+        histogram.observe(elapsed)
+
+    def expired(self, key: Optional[str]):
+        """Forget a command the device didn't answer in time, without a sample."""
+        self._sent.pop(key, None)
+
+    def error(self, kind: str):
+        """Record an error message, eg: !I."""
+        self.error_frames[kind] = self.error_frames.get(kind, 0) + 1
+
+    @property
+    def reconnects(self) -> int:
+        """Number of connections made after the first one."""
+        return max(0, self.connections - 1)
+
+    @property
+    def in_flight(self) -> int:
+        """Number of items sent and not reported by the device yet."""
+        return len(self._sent)
+
+    def snapshot(self) -> Dict[str, Any]:
+        """Return a copy of every counter and histogram."""
+        return {
+            "bytes_in": self.bytes_in,
+            "bytes_out": self.bytes_out,
+            "frames_in": self.frames_in,
+            "frames_out": self.frames_out,
+            "error_frames": dict(self.error_frames),
+            "connections": self.connections,
+            "reconnects": self.reconnects,
+            "reconnect_attempts": self.reconnect_attempts,
+            "reconnect_failures": self.reconnect_failures,
+            "time_to_initialised": self.time_to_initialised,
+            "in_flight": self.in_flight,
+            "round_trip": {
+                key: histogram.snapshot() for key, histogram in self.round_trip.items()
+            },
+            "parse_duration": self.parse_duration.snapshot(),
+            "callback_duration": self.callback_duration.snapshot(),
+        }
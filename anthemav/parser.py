@@ -1,36 +1,106 @@
 """Module containing the parser for Anthem command."""
+from typing import Dict, Iterable, Optional
 
 
 class ParsedMessage:
     """Class containing parsed message information."""
 
+    __slots__ = ("command", "value", "input_number", "input_command")
+
     command: str
     value: str
     input_number: int
+    # command without the input number, eg: ARC
+    input_command: str
+
+
+class PrefixIndex:
+    """Find which command of a fixed set a message starts with.
+
+    Commands are grouped by length so a lookup costs one dict probe per
+    distinct command length instead of a scan over every command.  Longer
+    commands are tried first, so the most specific command always wins when
+    one command is a prefix of another.
+    """
+
+    def __init__(self, commands: Iterable[str]):
+        """Build the index once for a set of commands."""
+        by_length: Dict[int, set] = {}
+        for command in commands:
+            by_length.setdefault(len(command), set()).add(command)
+        self._tables = [
+            (length, frozenset(by_length[length]))
+            for length in sorted(by_length, reverse=True)
+        ]
+
+    def match(self, message: str) -> Optional[str]:
+        """Return the command the message starts with, if any."""
+        for length, commands in self._tables:
+            prefix = message[:length]
+            if prefix in commands:
+                return prefix
+        return None
+
+
+# Commands reported per input by the x40 models, eg: IS3INTurntable or IS2ARC1
+X40_INPUT_COMMANDS = ["IN", "ARC"]
+X40_INPUT_INDEX = PrefixIndex(X40_INPUT_COMMANDS)
+
+# Commands reporting the name of an input
+INPUT_NAME_COMMANDS = ["IN", "ISN"]
 
 
 def parse_message(message: str) -> ParsedMessage:
     """Try to parse a message to a ParsedMessage object."""
+    if message.startswith("IS"):
+        return parse_input_message(message)
+    return None
+
+
+def parse_input_message(message: str) -> ParsedMessage:
+    """Try to parse a message associated to a specific input for any model."""
+    if message.startswith("ISN"):
+        return parse_x20_input_name(message)
     return parse_x40_message(message)
 
 
+def parse_x20_input_name(message: str) -> ParsedMessage:
+    """Try to parse an input name for the x20 and MDX models, eg: ISN01Turntable."""
+    if len(message) > 5 and message[3:5].isdigit():
+        parsed_message = ParsedMessage()
+        parsed_message.command = message[0:5]
+        parsed_message.input_command = "ISN"
+        parsed_message.input_number = int(message[3:5])
+        parsed_message.value = message[5:]
+        return parsed_message
+    return None
+
+
 def parse_x40_message(message: str) -> ParsedMessage:
     """Try to parse a message for the x40 models."""
-    return parse_x40_input_message(message, "ARC")
+    position = 2
+    while position < len(message) and message[position].isdigit():
+        position += 1
+    if position == 2 or not message.startswith("IS"):
+        return None
+    command = X40_INPUT_INDEX.match(message[position:])
+    if command is None or len(message) == position + len(command):
+        return None
+    parsed_message = ParsedMessage()
+    parsed_message.command = message[0 : position + len(command)]
+    parsed_message.input_command = command
+    parsed_message.input_number = int(message[2:position])
+    parsed_message.value = message[position + len(command) :]
+    return parsed_message
 
 
 def parse_x40_input_message(message: str, command: str) -> ParsedMessage:
-    """Try to parse a message associated to a specific input for the x40 models."""
-    if (
-        message.startswith("IS")
-        and command in message
-        and len(message) >= len(command) + 4
-    ):
-        parsed_message = ParsedMessage()
-        command_position = message.index(command)
-        parsed_message.command = message[0 : command_position + len(command)]
-        parsed_message.input_number = int(message[2:command_position])
-        parsed_message.value = message[command_position + len(command) :]
+    """Try to parse a message of a specific input command for the x40 models.
+
+    Kept for compatibility, see parse_x40_message.
+    """
+    parsed_message = parse_x40_message(message)
+    if parsed_message is not None and parsed_message.input_command == command:
         return parsed_message
     return None
 
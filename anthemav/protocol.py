@@ -1,16 +1,64 @@
 """Module to maintain AVR state information and network interface."""
 import asyncio
 import logging
-from typing import Awaitable, Callable, Dict
-
-from anthemav.device_error import DeviceError
-from anthemav.parser import parse_message
+from collections import deque
+from contextlib import contextmanager
+from time import monotonic, perf_counter
+from typing import (
+    Any,
+    Awaitable,
+    Callable,
+    Deque,
+    Dict,
+    Hashable,
+    Iterable,
+    List,
+    Optional,
+    Set,
+)
+
+from anthemav.coalescer import COALESCED_ZONE_COMMANDS, CommandCoalescer
+from anthemav.device_error import CommandError, DeviceError
+from anthemav.events import (
+    ChangeCallback,
+    ChangeDispatcher,
+    ChangeStream,
+    KeyCallback,
+)
+from anthemav.framer import DatagramFramer
+from anthemav.metrics import ProtocolMetrics
+from anthemav.parser import INPUT_NAME_COMMANDS, PrefixIndex, parse_message
+from anthemav.recorder import TrafficRecorder
+from anthemav.scheduler import BACKGROUND, INTERACTIVE, CommandScheduler
+from anthemav.refresh import PowerOnRefresh, RefreshPhase
+from anthemav.state import (
+    StateStore,
+    decode_boolean,
+    decode_integer,
+    decode_text,
+    slot_decoders,
+    slot_index,
+)
 
 __all__ = ["AVR"]
 
 # These properties apply even when the AVR is powered off
 ATTR_CORE = ["IDM"]
 
+# These properties identify the device and don't change while it runs
+ATTR_IDENTITY = ["IDM", "IDR", "IDS", "IDB", "IDH", "IDN", "EMAC", "WMAC", "MAC"]
+
+# Seconds a received value is trusted by refresh_all(stale_only=True), zone
+# attributes use the zone command (eg: VOL).  The device pushes every change
+# while Tx status (ECH/GCTXS) is on, so values only expire to catch a missed
+# update.  Timestamps are cleared on reconnect and power on except for ATTR_IDENTITY.
+DEFAULT_TTL = 300.0
+# Invalid command errors to a query before it's no longer sent, outside of
+# the power on refresh since a booting device rejects valid items
+UNSUPPORTED_REJECTIONS = 2
+ATTRIBUTE_TTL: Dict[str, float] = {key: float("inf") for key in ATTR_IDENTITY}
+ATTRIBUTE_TTL.update({"ICN": 3600.0, "GCTXS": 60.0, "ECH": 60.0})
+
 # These properties are sent when the device is powered on
 # This is used to force refresh the power state of the device if POW command isn't sent
 ATTR_POWERED_ON = ["Z1ALM", "Z1AIC", "Z1VIR"]
@@ -170,6 +218,48 @@ LOOKUP["GCTXS"] = {
 # MDX
 LOOKUP["MAC"] = {"description": "MAC address"}
 
+# Compiled once to find which command an incoming message carries
+LOOKUP_INDEX = PrefixIndex(LOOKUP)
+ZONELOOKUP_INDEX = PrefixIndex(ZONELOOKUP)
+
+# Position of each command in the StateStore of a device and of a zone
+# Power on refresh phases: device settings, then the audio/video details of zone 1
+ATTR_DEVICE = [key for key in LOOKUP if not key.startswith("Z") and key != "ICN"]
+ATTR_EXTRAS = [key for key in LOOKUP if key.startswith("Z")]
+
+LOOKUP_SLOTS = slot_index(LOOKUP)
+ZONELOOKUP_SLOTS = slot_index(ZONELOOKUP)
+
+# Typed form of the values read by the properties, decoded when received
+LOOKUP_DECODERS = slot_decoders(
+    LOOKUP_SLOTS,
+    {
+        **{key: decode_boolean for key in ["ECH", "SIP", "Z1ARC"]},
+        **{
+            key: decode_integer for key in ["Z1DIA", "Z1IRH", "Z1IRV", "Z1BRT", "Z1SRT"]
+        },
+        **{
+            key: decode_text(LOOKUP[key])
+            for key in ["FPB", "Z1ALM", "Z1DYN", "Z1VIR", "Z1AIC", "Z1AIF"]
+        },
+    },
+)
+ZONELOOKUP_DECODERS = slot_decoders(
+    ZONELOOKUP_SLOTS,
+    {
+        **{key: decode_boolean for key in ["POW", "MUT"]},
+        **{key: decode_integer for key in ["VOL", "PVOL", "INP"]},
+    },
+)
+
+# Error messages sent by the device, the command follows the two characters prefix
+ERROR_MESSAGES = {
+    "!I": (logging.WARNING, "Invalid command: %s"),
+    "!R": (logging.WARNING, "Out-of-range command: %s"),
+    "!E": (logging.DEBUG, "Cannot execute recognized command: %s"),
+    "!Z": (logging.DEBUG, "Ignoring command for powered-off zone: %s"),
+}
+
 COMMANDS_X20 = ["IDN", "ECH", "SIP", "Z1ARC", "FPB"]
 COMMANDS_X40 = ["PVOL", "WMAC", "EMAC", "IS1ARC", "GCFPB", "GCTXS"]
 COMMANDS_MDX_IGNORE = [
@@ -195,6 +285,33 @@ MODEL_X40 = "x40"
 MODEL_X20 = "x20"
 MODEL_MDX = "mdx"
 
+# Stop reading from the device while this many datagrams are waiting to be parsed
+FRAME_BACKLOG_HIGH = 512
+
+# Maximum number of commands waiting for the device to acknowledge them
+COMMAND_WINDOW = 8
+# Seconds to wait for the device to acknowledge a command before freeing its slot
+ACK_TIMEOUT = 0.5
+
+# Bytes buffered by the transport before it asks to pause writing, about 100
+# commands.  Commands wait in the scheduler instead where they can be dropped.
+WRITE_BUFFER_HIGH = 1024
+WRITE_BUFFER_LOW = 256
+# Maximum number of commands waiting to be sent
+MAX_QUEUED_COMMANDS = 256
+
+# Default time to wait for the device to confirm a command or answer a query
+COMMAND_TIMEOUT = 2.0
+
+
+def model_series(model: str) -> str:
+    """Return the series (x20, x40 or mdx) of a model name."""
+    if "40" in model or "70" in model or "90" in model:
+        return MODEL_X40
+    elif "MDX" in model or "MDA" in model:
+        return MODEL_MDX
+    return MODEL_X20
+
 
 # pylint: disable=too-many-instance-attributes, too-many-public-methods
 class AVR(asyncio.Protocol):
@@ -229,24 +346,106 @@ class AVR(asyncio.Protocol):
         self.log = logging.getLogger(__name__)
         self._connection_lost_callback = connection_lost_callback
         self._update_callback = update_callback
-        self.buffer = ""
+        self._framer = DatagramFramer()
+        self._frames: Deque[str] = deque()
+        self._assemble_task: asyncio.Task = None
+        self._read_pauses: Set[Hashable] = set()
+        self._frames_received = 0
+        self._write_batch: List[bytes] = None
+        self._scheduler = CommandScheduler(
+            self._transmit,
+            lambda: self._loop or asyncio.get_event_loop(),
+            window=COMMAND_WINDOW,
+            timeout=ACK_TIMEOUT,
+            max_queued=MAX_QUEUED_COMMANDS,
+            key=lambda command: self._command_key(command.decode()),
+            on_expire=self._command_expired,
+        )
+        self._pending: Dict[str, List[asyncio.Future]] = {}
+        self._coalescer: CommandCoalescer = None
+        self.metrics: ProtocolMetrics = None
+        self.recorder: TrafficRecorder = None
+        self._events = ChangeDispatcher(lambda: self._loop or asyncio.get_event_loop())
         self._input_names = {}
         self._input_numbers = {}
         self._device_power = False
-        self._poweron_refresh_successful = False
+        self._poweron = PowerOnRefresh(
+            self._query_batched,
+            [
+                RefreshPhase("core", lambda: self._stale_queries(ATTR_DEVICE)),
+                RefreshPhase("zones", self._missing_zone_queries),
+                RefreshPhase("inputs", self._missing_input_queries, required=True),
+                RefreshPhase("extras", lambda: self._stale_queries(ATTR_EXTRAS)),
+            ],
+            lambda: self._loop,
+        )
         self.transport: asyncio.Transport = None
         self._ignored_commands = []
+        self._unsupported_commands: List[str] = []
+        self._rejections: Dict[str, int] = {}
+        self._restored = False
+        # restored MAC address items, checked against the first one answered
+        self._restored_mac: Dict[str, str] = {}
+        self._last_seen: Dict[str, float] = {}
+        # shared by every device, assign a new dict to change it for one device
+        self.attribute_ttl: Dict[str, float] = ATTRIBUTE_TTL
         self._force_refresh = False
+        self._input_refresh: asyncio.TimerHandle = None
+        # zones powered on are refreshed outside of the parsing of messages
+        self._zone_refreshes: Dict[int, asyncio.Task] = {}
         self._model_series = ""
-        self._last_command = ""
         self._deviceinfo_received = asyncio.Event()
         self._alm_number = {"None": 0}
         self._available_input_numbers = []
         self.zones: Dict[int, Zone] = {1: Zone(self, 1)}
-        self.values: Dict[str, str] = {}
+        # LOOKUP commands have a slot, the other items (eg: IS3ARC) are in values
+        self._state = StateStore(LOOKUP_SLOTS, LOOKUP_DECODERS)
+        self.values: Dict[str, str] = self._state.overflow
 
-        for key in LOOKUP:
-            setattr(self, f"_{key}", "")
+    @property
+    def frames_received(self) -> int:
+        """Return the number of datagrams received from the device."""
+        return self._frames_received
+
+    @property
+    def frame_queue_depth(self) -> int:
+        """Return the number of messages received and not parsed yet."""
+        return len(self._frames)
+
+    @property
+    def pending_requests(self) -> int:
+        """Return the number of callers waiting for an answer."""
+        return sum(len(futures) for futures in self._pending.values())
+
+    @property
+    def coalesced_commands(self) -> int:
+        """Return the number of coalesced commands waiting to be sent."""
+        return self._coalescer.pending if self._coalescer is not None else 0
+
+    @property
+    def command_stats(self) -> Dict[str, Dict[str, float]]:
+        """Return the statistics of the command queues, see CommandScheduler.stats()."""
+        return self._scheduler.stats()
+
+    @property
+    def write_paused(self) -> bool:
+        """Return True while the transport asked to stop writing."""
+        return self._scheduler.paused
+
+    @property
+    def write_paused_time(self) -> float:
+        """Return the seconds spent with writing paused."""
+        return self._scheduler.paused_time
+
+    async def wait_until_idle(self):
+        """Wait until the messages received so far are parsed.
+
+        Refreshes triggered by the messages, eg: of a zone powered on, keep
+        waiting for the answers of the device in the background.
+        """
+        task = self._assemble_task
+        if task is not None and not task.done():
+            await asyncio.shield(task)
 
     async def wait_for_device_initialised(self, timeout: float):
         """Wait to receive the model and mac address for the device."""
@@ -264,6 +463,8 @@ class AVR(asyncio.Protocol):
         """Indicate if the model and mac address have been received."""
         if self._model_series and self.macaddress != EMPTY_MAC:
             self._deviceinfo_received.set()
+            if self.metrics is not None:
+                self.metrics.initialised()
 
     async def refresh_core(self):
         """Query device for all attributes that exist regardless of power state.
@@ -275,32 +476,30 @@ class AVR(asyncio.Protocol):
         This does not return any data, it just issues the queries.
         """
         self.log.debug("Sending out core query for all attributes")
-        for key in ATTR_CORE:
-            if self.transport is None:
-                self.log.warning("Lost connection to receiver while refreshing device")
-                break
-            self.query(key)
-            # small delay between command
-            await asyncio.sleep(0.01)
+        await self._query_batched(ATTR_CORE)
+
+    @property
+    def _poweron_refresh_successful(self) -> bool:
+        """Return True once the input names were received after power on."""
+        return self._poweron.complete
 
     async def poweron_refresh(self):
-        """Keep requesting all attributes until it works.
+        """Refresh the device after power on until the input names are received.
 
         Immediately after a power on event (POW1) the AVR is inconsistent with
-        which attributes can be successfully queried.  When we detect that
-        power has just been turned on, we loop every second making a bulk
-        query for every known attribute.  This continues until we detect that
-        values have been returned for at least one input name (this seems to
-        be the laggiest of all the attributes)
+        which attributes can be successfully queried.  The refresh goes
+        through the device settings, the zones, the inputs and the zone 1
+        audio/video details, and keeps querying what is missing until values
+        have been returned for every input name (this seems to be the laggiest
+        of all the attributes).  It runs in the background after power on, this
+        starts it immediately if it isn't running and waits for it to stop.
         """
-        if self._poweron_refresh_successful or self.transport is None:
+        if self.transport is None:
             return
-        else:
-            await self.refresh_all()
-            await asyncio.sleep(5)
-            await self.poweron_refresh()
+        self._poweron.start(0)
+        await self._poweron.wait()
 
-    async def refresh_all(self):
+    async def refresh_all(self, stale_only: bool = False):
         """Query device for all attributes that are known.
 
         This will force a refresh for all device queries that the module is
@@ -308,10 +507,13 @@ class AVR(asyncio.Protocol):
         table for all attributes.
 
         This does not return any data, it just issues the queries.
+
+            :param stale_only: skip the attributes received within their TTL
+            :type stale_only: bool
         """
         self.log.debug("refresh_all")
         # refresh main attribues
-        await self.query_commands(LOOKUP)
+        await self.query_commands(LOOKUP, stale_only=stale_only)
         if self._model_series == MODEL_MDX:
             # MDX receivers don't returns the list of available input numbers and have a fixed list
             self._populate_inputs(12)
@@ -319,30 +521,202 @@ class AVR(asyncio.Protocol):
     async def refresh_power(self):
         """Refresh power of all zones."""
         self.log.debug("refresh_power")
-        for zone in self.zones:
-            self.query(f"Z{zone}POW")
-            await asyncio.sleep(0.02)
+        with self._corked():
+            for zone in self.zones:
+                self.query(f"Z{zone}POW")
 
-    async def refresh_zone(self, zone: int):
+    async def refresh_zone(self, zone: int, stale_only: bool = False):
         """Query all zones for all attributes."""
         self.log.debug(f"refresh_zone: {zone}")
-        await self.query_commands(ZONELOOKUP, zone)
+        await self.query_commands(ZONELOOKUP, zone, stale_only=stale_only)
 
-    async def query_commands(self, commands: Dict[str, Dict[str, str]], zone: int = 0):
+    async def query_commands(
+        self,
+        commands: Dict[str, Dict[str, str]],
+        zone: int = 0,
+        stale_only: bool = False,
+    ):
         """Query a list of commands."""
-        for key in commands:
-            if key not in self._ignored_commands:
-                if self.transport is None:
-                    self.log.warning(
-                        "Lost connection to receiver while refreshing device"
-                    )
-                    break
-                if zone > 0:
-                    self.log.debug(f"Add zone to command {key} for zone {zone}")
-                    key = f"Z{zone}{key}"
+        keys = [
+            key
+            for key in commands
+            if key not in self._ignored_commands
+            and key not in self._unsupported_commands
+        ]
+        prefix = f"Z{zone}" if zone > 0 else ""
+        if stale_only:
+            now = monotonic()
+            keys = [key for key in keys if not self._is_fresh(prefix + key, key, now)]
+        await self._query_batched([prefix + key for key in keys])
+
+    def _stale_queries(self, commands: Iterable[str], zone: int = 0) -> List[str]:
+        """Return the queries for the attributes not received within their TTL."""
+        prefix = f"Z{zone}" if zone > 0 else ""
+        now = monotonic()
+        return [
+            prefix + key
+            for key in commands
+            if key not in self._ignored_commands
+            and key not in self._unsupported_commands
+            and not self._is_fresh(prefix + key, key, now)
+        ]
+
+    def _missing_zone_queries(self) -> List[str]:
+        """Return the queries for the zone attributes missing since power on.
+
+        Zones that are off only report their power.
+        """
+        queries = []
+        for number, zone in self.zones.items():
+            commands = ZONELOOKUP if zone.power else ["POW"]
+            queries.extend(self._stale_queries(commands, number))
+        return queries
+
+    def _missing_input_queries(self) -> List[str]:
+        """Return the queries for the input count and names missing since power on."""
+        if self._model_series == MODEL_MDX:
+            # MDX receivers don't returns the list of available input numbers and have a fixed list
+            total = 12
+        elif self._model_series:
+            missing = self._stale_queries(["ICN"])
+            if missing or "ICN" not in self._state:
+                return missing
+            try:
+                total = int(self._state["ICN"])
+            except ValueError:
+                return []
+        else:
+            # the model tells which commands return the input names
+            return []
+
+        now = monotonic()
+        queries = []
+        for input_number in range(1, total + 1):
+            if self._model_series == MODEL_X40:
+                keys = [f"IS{input_number}IN", f"IS{input_number}ARC"]
+            elif (
+                len(self._available_input_numbers) == 0
+                or input_number in self._available_input_numbers
+            ):
+                keys = [f"ISN{input_number:02d}"]
+            else:
+                continue
+            queries.extend(
+                key
+                for key in keys
+                if key not in self._unsupported_commands
+                and not self._is_fresh(key, key, now)
+            )
+        return queries
+
+    def _is_fresh(self, key: str, command: str, now: float) -> bool:
+        """Return True if the attribute was received within its TTL."""
+        last_seen = self._last_seen.get(key)
+        if last_seen is None:
+            return False
+        return now - last_seen < self.attribute_ttl.get(command, DEFAULT_TTL)
+
+    def attribute_age(self, key: str) -> Optional[float]:
+        """Return the seconds since an attribute was received, eg: Z1VOL."""
+        last_seen = self._last_seen.get(key)
+        if last_seen is None:
+            return None
+        return monotonic() - last_seen
+
+    def _expire_attributes(self):
+        """Forget when the attributes were received, except the identity."""
+        self._last_seen = {
+            key: value for key, value in self._last_seen.items() if key in ATTR_IDENTITY
+        }
+
+    async def _query_batched(self, keys: Iterable[str]):
+        """Query many items as fast as the device acknowledges them.
+
+        The queries are queued at once as background traffic and the
+        scheduler keeps at most COMMAND_WINDOW of them waiting for an answer,
+        so a refresh completes as fast as the device can answer without
+        flooding it.  Return when every background query was answered or
+        timed out.
+        """
+        if self.transport is None:
+            self.log.warning("Lost connection to receiver while refreshing device")
+            return
+        with self._corked() as batch:
+            for key in keys:
                 self.query(key)
-                # small delay between command
-                await asyncio.sleep(0.02)
+        if batch:
+            await self._scheduler.drain(BACKGROUND)
+
+    def _command_key(self, command: str) -> str:
+        """Return the item acknowledged by a message, eg: Z1VOL for Z1VOL?;."""
+        command = command.rstrip(";?")
+        return self._message_key(command) or command
+
+    def _command_expired(self, command: bytes):
+        """Forget the round trip of a command the device didn't answer."""
+        if self.metrics is not None:
+            self.metrics.expired(self._message_key(command.decode().rstrip(";?")))
+
+    def _answered_key(self, message: str) -> Optional[str]:
+        """Return the item a message answers, None for a bare ; confirmation."""
+        if message == "":
+            return None
+        if message.startswith("!"):
+            # error messages repeat the command, eg: !IZ1FOO?
+            message = message[2:]
+        return self._command_key(message)
+
+    def _acknowledge(self, frames: List[str]):
+        """Free the slots of the commands answered by the received datagrams.
+
+        This runs as the data is received, not when it's parsed, because the
+        parser can be waiting for a refresh to be answered.  The receiver
+        only sends ; to confirm some commands, the confirmation is replaced
+        by the command so it's parsed as if the device reported the value.
+        """
+        keys = [self._answered_key(message) for message in frames]
+        acknowledged = self._scheduler.acknowledge_many(keys)
+        for index, command in enumerate(acknowledged):
+            if frames[index] == "" and command is not None and b"INP" not in command:
+                frames[index] = command.decode()[:-1]
+                self.log.debug("%s confirmed by the device", frames[index])
+
+    @contextmanager
+    def _corked(self):
+        """Send the commands of the block as background traffic, at once.
+
+        They are queued behind the interactive commands by the scheduler and
+        written together as far as the free slots allow.
+        """
+        if self._write_batch is not None:
+            yield []
+            return
+        self._write_batch = batch = []
+        try:
+            yield batch
+        finally:
+            self._write_batch = None
+            if batch:
+                self._scheduler.submit_many(batch, BACKGROUND)
+
+    def _transmit(self, batch: List[bytes]):
+        """Write commands released by the scheduler to the transport."""
+        if self.metrics is not None:
+            for command in batch:
+                key = self._message_key(command.decode().rstrip(";?"))
+                self.metrics.sent(key, len(command))
+        if self.recorder is not None:
+            for command in batch:
+                self.recorder.sent(command)
+        try:
+            if len(batch) == 1:
+                self.transport.write(batch[0])
+            else:
+                self.transport.writelines(batch)
+        except Exception as error:
+            self.log.warning(
+                "No transport found, unable to send command. error: %s", str(error)
+            )
 
     #
     # asyncio network functions
@@ -352,24 +726,56 @@ class AVR(asyncio.Protocol):
         """Called when asyncio.Protocol establishes the network connection."""
         self.log.debug("Connection established to AVR")
         self.transport = transport
+        self._framer.reset()
+        self._scheduler.reset()
+        self._read_pauses.clear()
+        if self.metrics is not None:
+            self.metrics.connected()
 
-        # self.transport.set_write_buffer_limits(0)
+        self.transport.set_write_buffer_limits(WRITE_BUFFER_HIGH, WRITE_BUFFER_LOW)
         limit_low, limit_high = self.transport.get_write_buffer_limits()
         self.log.debug("Write buffer limits %d to %d", limit_low, limit_high)
-        self._poweron_refresh_successful = False
+        self._poweron.cancel()
         self._device_power = False
+        self._expire_attributes()
         for zone in self.zones.values():
             zone.need_refresh = True
         asyncio.run_coroutine_threadsafe(self.refresh_core(), self._loop)
 
+    def pause_writing(self):
+        """Called when the transport buffer goes over the high water mark."""
+        self._scheduler.pause()
+
+    def resume_writing(self):
+        """Called when the transport buffer drains below the low water mark."""
+        self._scheduler.resume()
+
     def data_received(self, data):
         """Called when asyncio.Protocol detects received data from network."""
-        self.buffer += data.decode()
-        self.log.debug("Received %d bytes from AVR: %s", len(self.buffer), self.buffer)
-        try:
-            self._loop.create_task(self._assemble_buffer())
-        except Exception as error:
-            self.log.warning("Unable to parse message. Error: %s", error)
+        self.log.debug("Received %d bytes from AVR: %s", len(data), data)
+        if self.recorder is not None:
+            self.recorder.received(data)
+        frames = self._framer.feed(data)
+        metrics = self.metrics
+        if metrics is not None:
+            metrics.bytes_in += len(data)
+            metrics.frames_in += len(frames)
+        if not frames:
+            return
+        if self._scheduler.in_flight:
+            self._acknowledge(frames)
+        self._frames.extend(frames)
+        self._frames_received += len(frames)
+
+        if (
+            len(self._frames) > FRAME_BACKLOG_HIGH
+            and "backlog" not in self._read_pauses
+        ):
+            self.log.debug("Too many pending messages, pause reading")
+            self._pause_reading("backlog")
+
+        if self._assemble_task is None or self._assemble_task.done():
+            self._assemble_task = self._loop.create_task(self._assemble_buffer())
 
     def connection_lost(self, exc):
         """Called when asyncio.Protocol loses the network connection."""
@@ -379,6 +785,11 @@ class AVR(asyncio.Protocol):
             self.log.debug(exc)
 
         self.transport = None
+        self._framer.reset()
+        self._poweron.cancel()
+        self._cancel_zone_refreshes()
+        self._scheduler.reset()
+        self._cancel_pending()
 
         if self._connection_lost_callback:
             asyncio.run_coroutine_threadsafe(
@@ -386,31 +797,51 @@ class AVR(asyncio.Protocol):
             )
 
     async def _assemble_buffer(self):
-        """Split up received data from device into individual commands.
+        """Interpret the datagrams received from the device in order.
 
         Data sent by the device is a sequence of datagrams separated by
         semicolons.  It's common to receive a burst of them all in one
-        submission when there's a lot of device activity.  This function
-        disassembles the chain of datagrams into individual messages which
-        are then passed on for interpretation.
+        submission when there's a lot of device activity.  The framer
+        disassembles the stream into individual messages in data_received and
+        this function passes them on for interpretation.  A single instance
+        runs at a time and keeps going until every pending message is parsed.
         """
-        self.transport.pause_reading()
-
-        for message in self.buffer.split(";"):
-            if message != "":
-                self.log.debug("assembled message %s", message)
-                await self._parse_message(message)
-            elif self._last_command != "":
-                # For some case the receiver only send ; to confirm receiving previous command.
-                last_command = self._last_command
-                self._last_command = ""
-                self.log.debug("send last command %s", last_command)
-                await self._parse_message(last_command)
-
-        self.buffer = ""
-
-        self.transport.resume_reading()
-        return
+        frames = self._frames
+        while frames:
+            message = frames.popleft()
+            metrics = self.metrics
+            if metrics is not None:
+                start = perf_counter()
+            try:
+                if message != "":
+                    self.log.debug("assembled message %s", message)
+                    await self._parse_message(message)
+            except Exception as error:
+                self.log.warning(
+                    "Unable to parse message %s. Error: %s", message, error
+                )
+            if metrics is not None:
+                metrics.parse_duration.observe(perf_counter() - start)
+
+        if self._events:
+            self._events.flush()
+        self._poweron.progress()
+
+        self._resume_reading("backlog")
+
+    def _pause_reading(self, reason: Hashable):
+        """Stop reading from the device until every reason is resumed."""
+        if not self._read_pauses and self.transport is not None:
+            self.transport.pause_reading()
+        self._read_pauses.add(reason)
+
+    def _resume_reading(self, reason: Hashable):
+        """Resume reading from the device if nothing else paused it."""
+        if reason not in self._read_pauses:
+            return
+        self._read_pauses.discard(reason)
+        if not self._read_pauses and self.transport is not None:
+            self.transport.resume_reading()
 
     def _populate_inputs(self, total):
         """Request the names for all active, configured inputs on the device.
@@ -419,16 +850,17 @@ class AVR(asyncio.Protocol):
         which will ask for the name of each active input.
         """
         total = total + 1
-        for input_number in range(1, total):
-            if self._model_series == MODEL_X40:
-                self.query(f"IS{input_number}IN")
-                self.query(f"IS{input_number}ARC")
-            else:
-                if (
-                    len(self._available_input_numbers) == 0
-                    or input_number in self._available_input_numbers
-                ):
-                    self.query(f"ISN{input_number:02d}")
+        with self._corked():
+            for input_number in range(1, total):
+                if self._model_series == MODEL_X40:
+                    self.query(f"IS{input_number}IN")
+                    self.query(f"IS{input_number}ARC")
+                else:
+                    if (
+                        len(self._available_input_numbers) == 0
+                        or input_number in self._available_input_numbers
+                    ):
+                        self.query(f"ISN{input_number:02d}")
 
     async def _parse_message(self, data: str):
         """Interpret each message datagram from device and do the needful.
@@ -441,127 +873,68 @@ class AVR(asyncio.Protocol):
         recognized = False
         newdata = False
 
-        if data.startswith("!I"):
-            self.log.warning("Invalid command: %s", data[2:])
-            recognized = True
-        elif data.startswith("!R"):
-            self.log.warning("Out-of-range command: %s", data[2:])
-            recognized = True
-        elif data.startswith("!E"):
-            self.log.debug("Cannot execute recognized command: %s", data[2:])
-            recognized = True
-        elif data.startswith("!Z"):
-            self.log.debug("Ignoring command for powered-off zone: %s", data[2:])
-            recognized = True
+        if data.startswith("!"):
+            if self.metrics is not None:
+                self.metrics.error(data[:2])
+                # an error answers the command it repeats, eg: !IZ1FOO?
+                self.metrics.answered(self._answered_key(data))
+            if data.startswith("!I"):
+                self._learn_unsupported(data[2:])
+            error = ERROR_MESSAGES.get(data[:2])
+            if error is not None:
+                recognized = True
+                self.log.log(error[0], error[1], data[2:])
+                if self._pending or self._coalescer is not None:
+                    self._reject_pending(data[2:], error[1] % data[2:])
         else:
-            for key, commands in LOOKUP.items():
-                if data.startswith(key):
-                    recognized = True
-
-                    value = data[len(key) :]
-                    oldvalue = getattr(self, "_" + key)
-                    if oldvalue != value:
-                        changeindicator = "New Value"
-                        newdata = True
-                    else:
-                        changeindicator = "Unchanged"
-
-                    if "description" in commands:
-                        if value in commands:
-                            self.log.debug(
-                                "%s: %s (%s) -> %s (%s)",
-                                changeindicator,
-                                commands["description"],
-                                key,
-                                commands[value],
-                                value,
-                            )
-                        else:
-                            self.log.debug(
-                                "%s: %s (%s) -> %s",
-                                changeindicator,
-                                commands["description"],
-                                key,
-                                value,
-                            )
-
-                    setattr(self, "_" + key, value)
-
-                    if key == "IDM" and value != oldvalue:
-                        # receiving model number, we can initialize the device and request all attributes
-                        self.set_model_command(value)
-                        self.set_zones(value)
-                        await self.refresh_power()
-                    elif key == "IDM" and self._poweron_refresh_successful is False:
-                        # Could be because of reconnection
-                        await self.refresh_power()
-
-                    if (
-                        key == "IDM"
-                        or key == "IDN"
-                        or key == "EMAC"
-                        or key == "WMAC"
-                        or key == "MAC"
-                    ):
-                        self._set_device_initialised()
-
-                    await self.force_refresh_power(key)
-
-                    if key == "GCTXS" and value == "0":
-                        # tx status is disabled but required for this library. Set it back on again
-                        self.command("GCTXS1")
-
-                    break
+            key = LOOKUP_INDEX.match(data)
+            if key is not None:
+                recognized = True
+                self._last_seen[key] = monotonic()
+                value = data[len(key) :]
+                newdata = await self._parse_lookup_message(key, value)
 
             if data.startswith("Z"):
                 self.log.debug("Zone command received: %s", data)
                 newdata = (await self.parse_zone_command(data)) or newdata
                 recognized = True
-            elif data.startswith("ICN"):
+            elif key == "ICN":
                 self.log.debug("ICN update received")
-                self._poweron_refresh_successful = True
-                recognized = True
                 self._populate_inputs(int(value))
-            elif (
-                data.startswith("ISN") and len(data) > 5
-            ):  # parse x20 and mdx inputs: eg: ISN01Turntable
-                recognized = True
-                self._poweron_refresh_successful = True
-                input_number = int(data[3:5])
-                value = data[5:]
-                oldname = self._input_names.get(input_number, "")
-                if oldname != value:
-                    self._input_numbers[value] = input_number
-                    self._input_names[input_number] = value
-                    self.log.debug(
-                        "New Value: Input %d is called %s", input_number, value
-                    )
-                    newdata = True
-            elif (
-                data.startswith("IS") and "IN" in data and len(data) > 5
-            ):  # parse x40 inputs, eg: IS3INTurntable
-                recognized = True
-                self._poweron_refresh_successful = True
-                in_position = data.index("IN")
-                input_number = int(data[2:in_position])
-                value = data[in_position + 2 :]
-                oldname = self._input_names.get(input_number, "")
-                if oldname != value:
-                    self._input_numbers[value] = input_number
-                    self._input_names[input_number] = value
-                    self.log.debug(
-                        "New Value: Input %d is called %s", input_number, value
-                    )
-                    newdata = True
             else:
-                # use parser for other commands
+                # use parser for input and other commands
                 parsed_message = parse_message(data)
-                if parsed_message is not None:
+                if parsed_message is None:
+                    pass
+                elif parsed_message.input_command in INPUT_NAME_COMMANDS:
+                    # x20 and mdx inputs eg: ISN01Turntable, x40 inputs eg: IS3INTurntable
+                    recognized = True
+                    self._last_seen[parsed_message.command] = monotonic()
+                    input_number = parsed_message.input_number
+                    value = parsed_message.value
+                    oldname = self._input_names.get(input_number, "")
+                    if oldname != value:
+                        self._input_numbers[value] = input_number
+                        self._input_names[input_number] = value
+                        if self._events:
+                            self._events.record(
+                                parsed_message.command, oldname or None, value
+                            )
+                        self.log.debug(
+                            "New Value: Input %d is called %s", input_number, value
+                        )
+                        newdata = True
+                else:
                     recognized = True
+                    self._last_seen[parsed_message.command] = monotonic()
                     oldvalue = self.values.get(parsed_message.command)
                     if parsed_message.value != oldvalue:
                         newdata = True
                         self.values[parsed_message.command] = parsed_message.value
+                        if self._events:
+                            self._events.record(
+                                parsed_message.command, oldvalue, parsed_message.value
+                            )
                         self.log.debug(
                             "New value - command:%s value:%s input_number:%s",
                             parsed_message.command,
@@ -571,12 +944,178 @@ class AVR(asyncio.Protocol):
 
         if newdata:
             if self._update_callback:
-                self._loop.call_soon(self._update_callback, data)
+                if self.metrics is not None:
+                    self._loop.call_soon(self._timed_update_callback, data)
+                else:
+                    self._loop.call_soon(self._update_callback, data)
         else:
             self.log.debug("no new data encountered")
 
         if not recognized:
             self.log.debug("Unrecognized response: %s", data)
+        elif self._pending or self.metrics is not None:
+            key = self._message_key(data)
+            if self.metrics is not None:
+                self.metrics.answered(key)
+            if self._pending:
+                self._resolve_pending(key, data)
+
+    def _timed_update_callback(self, data: str):
+        """Call update_callback and record how long it took."""
+        start = perf_counter()
+        try:
+            self._update_callback(data)
+        finally:
+            if self.metrics is not None:
+                self.metrics.callback_duration.observe(perf_counter() - start)
+
+    def _learn_unsupported(self, command: str):
+        """Stop querying an attribute the device reported as invalid."""
+        key = command[:-1]
+        if not command.endswith("?") or self._poweron.running:
+            return
+        # input items, eg: IS2ARC, aren't in LOOKUP
+        if key not in LOOKUP and not key.startswith("IS"):
+            return
+        if key in self._unsupported_commands:
+            return
+        rejections = self._rejections.get(key, 0) + 1
+        if rejections < UNSUPPORTED_REJECTIONS:
+            self._rejections[key] = rejections
+            return
+        self._rejections.pop(key, None)
+        self.log.debug("%s isn't supported by the device", key)
+        self._unsupported_commands.append(key)
+
+    def _message_key(self, message: str) -> Optional[str]:
+        """Return the item a message or command refers to, eg: Z1VOL for Z1VOL-40."""
+        if message.startswith("Z") and message[1:2].isdigit():
+            zone_command = ZONELOOKUP_INDEX.match(message[2:])
+            if zone_command is not None:
+                return message[:2] + zone_command
+        key = LOOKUP_INDEX.match(message)
+        if key is not None:
+            return key
+        parsed_message = parse_message(message)
+        if parsed_message is not None:
+            return parsed_message.command
+        return None
+
+    def _resolve_pending(self, key: str, data: str):
+        """Hand the value of a message to the callers waiting for it."""
+        futures = self._pending.pop(key, None)
+        if futures:
+            value = data[len(key) :]
+            for future in futures:
+                if not future.done():
+                    future.set_result(value)
+
+    def _reject_pending(self, command: str, message: str):
+        """Fail the callers waiting for a command rejected by the device."""
+        key = self._message_key(command)
+        futures = self._pending.pop(key, None)
+        if futures:
+            for future in futures:
+                if not future.done():
+                    future.set_exception(CommandError(message, command))
+        if self._coalescer is not None:
+            self._coalescer.reject(key, CommandError(message, command))
+
+    def _cancel_pending(self):
+        """Fail every caller still waiting for the device."""
+        pending, self._pending = self._pending, {}
+        for futures in pending.values():
+            for future in futures:
+                if not future.done():
+                    future.set_exception(ConnectionError("Lost connection to receiver"))
+        if self._coalescer is not None:
+            self._coalescer.reset(ConnectionError("Lost connection to receiver"))
+
+    async def _wait_for_response(
+        self, key: str, send: Callable[[], None], timeout: float
+    ) -> str:
+        """Send something to the device and wait for the next value of key."""
+        future = asyncio.get_running_loop().create_future()
+        self._pending.setdefault(key, []).append(future)
+        try:
+            send()
+            return await asyncio.wait_for(future, timeout)
+        finally:
+            futures = self._pending.get(key)
+            if futures and future in futures:
+                futures.remove(future)
+                if not futures:
+                    del self._pending[key]
+
+    async def _parse_lookup_message(self, key: str, value: str) -> bool:
+        """Update the state of a command from LOOKUP, return True if it changed."""
+        newdata = False
+        commands = LOOKUP[key]
+        oldvalue = self._state.get(key, "")
+        if oldvalue != value:
+            changeindicator = "New Value"
+            newdata = True
+            if self._events:
+                self._events.record(key, oldvalue or None, value)
+        else:
+            changeindicator = "Unchanged"
+
+        if "description" in commands:
+            if value in commands:
+                self.log.debug(
+                    "%s: %s (%s) -> %s (%s)",
+                    changeindicator,
+                    commands["description"],
+                    key,
+                    commands[value],
+                    value,
+                )
+            else:
+                self.log.debug(
+                    "%s: %s (%s) -> %s",
+                    changeindicator,
+                    commands["description"],
+                    key,
+                    value,
+                )
+
+        self._state[key] = value
+
+        if key == "IDM" and (value != oldvalue or self._restored):
+            # receiving model number, we can initialize the device and request all attributes
+            if self._restored and value != oldvalue:
+                self.log.debug("Cached state was for %s, discarding it", oldvalue)
+                self._discard_restored_state()
+            self._restored = False
+            self.set_model_command(value)
+            self.set_zones(value)
+            await self.refresh_power()
+        elif key == "IDM" and self._poweron_refresh_successful is False:
+            # Could be because of reconnection
+            await self.refresh_power()
+
+        if key in ("IDM", "IDN", "EMAC", "WMAC", "MAC"):
+            restored_mac = self._restored_mac.pop(key, None)
+            if restored_mac is not None:
+                self._restored_mac.clear()
+                if value != restored_mac:
+                    self.log.debug(
+                        "Cached state was for %s, discarding it", restored_mac
+                    )
+                    self._discard_restored_state()
+            self._set_device_initialised()
+        elif key == "IDS" and oldvalue and value != oldvalue:
+            # new firmware, the commands it rejected may be supported now
+            self._unsupported_commands = []
+            self._rejections.clear()
+
+        await self.force_refresh_power(key)
+
+        if key == "GCTXS" and value == "0":
+            # tx status is disabled but required for this library. Set it back on again
+            self.command("GCTXS1")
+
+        return newdata
 
     async def parse_zone_command(self, data: str) -> bool:
         """Parse command specifically for zones."""
@@ -584,54 +1123,83 @@ class AVR(asyncio.Protocol):
         zone: int = int(data[1])
         if zone not in self.zones:
             self.log.error(f"Zone {zone} isn't registered for this amplifier.")
+            return newdata
         # remove zone (Z1, Z2 ....) from the data
         zone_data = data[2:]
-        for zoneCommand in ZONELOOKUP:
-            if zone_data.startswith(zoneCommand):
-                self.log.debug(f"Parse message {zone_data} for zone {zone}")
-                value = zone_data[len(zoneCommand) :]
-                oldvalue = self.zones[zone].values.get(zoneCommand, "")
-                self.zones[zone].values[zoneCommand] = value
-                if oldvalue != value:
-                    newdata = True
-                if zoneCommand == "POW" and (newdata or self.zones[zone].need_refresh):
-                    self.zones[zone].need_refresh = False
-                    if value == "1":
-                        await self.refresh_zone(zone)
-                        if self._device_power is False:
-                            self.power_on_device()
-                    elif value == "0" and oldvalue == "1":
-                        if all(zone.power is False for zone in self.zones.values()):
-                            # all zone are off, switch off device
-                            self.power_off_device()
-                if newdata and zoneCommand == "INP":
-                    self._loop.call_later(
-                        2,
-                        asyncio.run_coroutine_threadsafe,
-                        self.refresh_input(),
-                        self._loop,
-                    )
-                break
+        zoneCommand = ZONELOOKUP_INDEX.match(zone_data)
+        if zoneCommand is None:
+            return newdata
+        self.log.debug(f"Parse message {zone_data} for zone {zone}")
+        self._last_seen[data[:2] + zoneCommand] = monotonic()
+        value = zone_data[len(zoneCommand) :]
+        oldvalue = self.zones[zone].values.get(zoneCommand, "")
+        self.zones[zone].values[zoneCommand] = value
+        if oldvalue != value:
+            newdata = True
+            if self._events:
+                self._events.record(data[:2] + zoneCommand, oldvalue or None, value)
+        if self._coalescer is not None:
+            self._coalescer.confirm(data[:2] + zoneCommand, value)
+        if zoneCommand == "POW" and (newdata or self.zones[zone].need_refresh):
+            self.zones[zone].need_refresh = False
+            if value == "1":
+                self._start_zone_refresh(zone)
+                if self._device_power is False:
+                    self.power_on_device()
+            elif value == "0" and oldvalue == "1":
+                self._cancel_zone_refreshes([zone])
+                if all(zone.power is False for zone in self.zones.values()):
+                    # all zone are off, switch off device
+                    self.power_off_device()
+        if newdata and zoneCommand == "INP":
+            # refresh once after a burst of input changes
+            if self._input_refresh is not None:
+                self._input_refresh.cancel()
+            self._input_refresh = self._loop.call_later(
+                2, self._spawn, self.refresh_input
+            )
 
         return newdata
 
     def power_off_device(self):
         """Set device as powered off."""
         self.log.debug("Power off device")
-        self._poweron_refresh_successful = False
+        self._poweron.cancel()
         self._device_power = False
 
     def power_on_device(self):
         """Set device as powered on."""
         self.log.debug("Powered on device detected refresh all attributes")
         self._device_power = True
-        self._poweron_refresh_successful = False
-        self._loop.call_later(
-            1,
-            asyncio.run_coroutine_threadsafe,
-            self.poweron_refresh(),
-            self._loop,
-        )
+        self._poweron.cancel()
+        self._expire_attributes()
+        self._poweron.start()
+
+    def _start_zone_refresh(self, zone: int):
+        """Refresh a zone in a task, parsing doesn't wait for the answers."""
+        self._cancel_zone_refreshes([zone])
+        task = self._loop.create_task(self.refresh_zone(zone))
+        self._zone_refreshes[zone] = task
+        task.add_done_callback(lambda task: self._zone_refresh_done(zone, task))
+
+    def _zone_refresh_done(self, zone: int, task: asyncio.Task):
+        if self._zone_refreshes.get(zone) is task:
+            del self._zone_refreshes[zone]
+        if not task.cancelled() and task.exception() is not None:
+            self.log.warning(
+                "Unable to refresh zone %d. Error: %s", zone, task.exception()
+            )
+
+    def _cancel_zone_refreshes(self, zones: Iterable[int] = None):
+        """Stop the refresh of some zones, all of them by default."""
+        for zone in list(self._zone_refreshes if zones is None else zones):
+            task = self._zone_refreshes.pop(zone, None)
+            if task is not None:
+                task.cancel()
+
+    def _spawn(self, coroutine_function: Callable[[], Awaitable[None]]):
+        """Run a coroutine function as a task, used by timers."""
+        self._loop.create_task(coroutine_function())
 
     async def refresh_input(self):
         """Refresh specific input commands."""
@@ -677,28 +1245,298 @@ class AVR(asyncio.Protocol):
         item = item + "?"
         self.command(item)
 
+    async def async_query(self, item: str, timeout: float = COMMAND_TIMEOUT) -> str:
+        """Query the device for an item and return its value.
+
+        This is the awaitable version of query.  It completes when the device
+        answers, raises CommandError if the device answers with an error
+        message and asyncio.TimeoutError if it doesn't answer within timeout
+        seconds.
+
+            :param item: Any of the data items from the API
+            :type item: str
+            :param timeout: seconds to wait for the answer
+            :type timeout: float
+
+        :Example:
+
+        >>> await async_query('Z1VOL')
+        '-50'
+        """
+        return await self._wait_for_response(item, lambda: self.query(item), timeout)
+
+    async def async_command(
+        self, command: str, timeout: float = COMMAND_TIMEOUT, query: bool = False
+    ) -> str:
+        """Issue a command to the device and return the value it confirms.
+
+        This is the awaitable version of command.  It completes when the
+        device reports the new value of the item changed by the command,
+        raises CommandError if the device rejects the command and
+        asyncio.TimeoutError if it doesn't confirm within timeout seconds.
+
+            :param command: Any command as documented in the Anthem API
+            :type command: str
+            :param timeout: seconds to wait for the confirmation
+            :type timeout: float
+            :param query: also query the item, for commands the device doesn't always echo
+            :type query: bool
+
+        :Example:
+
+        >>> await async_command('Z1VOL-50')
+        '-50'
+        """
+        key = self._message_key(command)
+        if key is None:
+            raise ValueError(f"Unable to find the item changed by command {command}")
+
+        def send():
+            self.command(command)
+            if query:
+                self.query(key)
+
+        return await self._wait_for_response(key, send, timeout)
+
+    def set_coalescing(self, interval: Optional[float]):
+        """Limit the rate of continuous controls like the zone volume.
+
+        When enabled, volume and attenuation changes are sent at most once
+        every interval seconds per zone and only the latest value is kept, so
+        a volume slider doesn't flood the device.  Toggles like mute and
+        power are always sent immediately.  None disables the coalescing.
+
+            :param interval: minimum seconds between two volume commands
+            :type interval: float
+        """
+        if self._coalescer is not None:
+            self._coalescer.reset(CommandError("Coalescing disabled", ""))
+            self._coalescer = None
+        if interval is not None:
+            self._coalescer = CommandCoalescer(
+                self.command, self._loop or asyncio.get_event_loop(), interval
+            )
+
+    def set_command_window(
+        self, window: int = COMMAND_WINDOW, timeout: float = ACK_TIMEOUT
+    ):
+        """Limit the number of commands waiting for the device to answer.
+
+        At most window commands are sent and not acknowledged yet, the
+        others wait in the queue.  A command that isn't acknowledged within
+        timeout seconds frees its slot.  A larger window speeds up the
+        refreshes of a device that answers quickly, a smaller one keeps a
+        slow device from falling behind.
+
+            :param window: maximum number of commands waiting for an answer
+            :param timeout: seconds to wait for an acknowledgement
+            :type window: int
+            :type timeout: float
+        """
+        self._scheduler.set_window(window, timeout)
+
+    def subscribe(
+        self, callback: ChangeCallback, interval: Optional[float] = None
+    ) -> Callable[[], None]:
+        """Receive the changes of the device state as lists of StateChange.
+
+        Unlike update_callback, which is called with the raw message for
+        every change, the callback is called once with every change found in
+        the messages received together, or at most once every interval
+        seconds when one is given.
+
+            :param callback: called with a list of anthemav.events.StateChange
+            :param interval: seconds to collect changes before calling back
+            :return: function cancelling the subscription
+        """
+        return self._events.subscribe(callback, interval)
+
+    def changes(
+        self,
+        keys: Optional[Iterable[str]] = None,
+        zone: Optional[int] = None,
+        maxsize: int = 256,
+        overflow: str = "drop_oldest",
+    ) -> ChangeStream:
+        """Return an asynchronous iterator over the changes of the device state.
+
+        The consumer reads the changes in its own task, at its own pace.  See
+        anthemav.events.ChangeStream for the overflow policies, only block
+        can delay the other consumers.
+
+        :Example:
+
+        >>> async with avr.changes(keys=["POW", "VOL"], zone=1) as changes:
+        ...     async for change in changes:
+        ...         print(change.key, change.new)
+        """
+        stream = ChangeStream(
+            keys,
+            zone,
+            maxsize,
+            overflow,
+            pause=lambda: self._pause_reading(stream),
+            resume=lambda: self._resume_reading(stream),
+        )
+        if keys is None:
+            stream.unsubscribe = self._events.subscribe(stream.put)
+            return stream
+
+        prefix = f"Z{zone}" if zone is not None else ""
+        unsubscribes = [
+            self._events.on_change(prefix + key, stream.put_change) for key in keys
+        ]
+
+        def unsubscribe():
+            for function in unsubscribes:
+                function()
+
+        stream.unsubscribe = unsubscribe
+        return stream
+
+    def on_change(self, key: str, callback: KeyCallback) -> Callable[[], None]:
+        """Call back with a StateChange whenever an item changes.
+
+        Callbacks are indexed by item so changes of other items don't reach
+        them.  They are called once the messages received together are
+        parsed.
+
+            :param key: item, eg: IDM, Z1VOL or IS3IN
+            :param callback: called with an anthemav.events.StateChange
+            :return: function cancelling the subscription
+
+        :Example:
+
+        >>> avr.on_change("Z1POW", lambda change: print(change.new))
+        """
+        return self._events.on_change(key, callback)
+
+    def enable_metrics(self) -> ProtocolMetrics:
+        """Start collecting counters and latency histograms.
+
+        Round trips are measured from the command being written to the
+        transport to the device reporting the same item, or rejecting it.  Read the values with
+        metrics.snapshot().  Nothing is measured until this is called.
+        """
+        if self.metrics is None:
+            self.metrics = ProtocolMetrics()
+            if self.transport is not None:
+                self.metrics.connected()
+        return self.metrics
+
+    def start_recording(self, file) -> TrafficRecorder:
+        """Save the raw traffic with the device to a file.
+
+        The recording can be fed to another AVR with anthemav.recorder.replay
+        to reproduce a session without the device.
+
+            :param file: path of the recording (.gz to compress) or a text file
+            :type file: str
+        """
+        self.stop_recording()
+        self.recorder = TrafficRecorder(file, model=self._state.get("IDM", ""))
+        return self.recorder
+
+    def stop_recording(self):
+        """Stop saving the traffic with the device and close the recording."""
+        if self.recorder is not None:
+            self.recorder.close()
+            self.recorder = None
+
+    def disable_metrics(self):
+        """Stop collecting metrics and drop the values collected so far."""
+        self.metrics = None
+
     def set_model_command(self, model: str):
         """Add the commands to the model."""
-        if "40" in model or "70" in model or "90" in model:
-            self.log.debug("Set Command to Model x40")
-            self._ignored_commands = COMMANDS_X20 + COMMANDS_MDX
-            self._model_series = MODEL_X40
+        self._set_model_series(model)
+        if self._model_series == MODEL_X40:
             self.query("GCTXS")
             self.query("EMAC")
             self.query("WMAC")
+        elif self._model_series == MODEL_MDX:
+            self.query("MAC")
+        else:
+            self.command("ECH1")
+            self.query("IDN")
+
+    def _set_model_series(self, model: str):
+        """Select the commands of the model without querying the device."""
+        series = model_series(model)
+        if series == MODEL_X40:
+            self.log.debug("Set Command to Model x40")
+            self._ignored_commands = COMMANDS_X20 + COMMANDS_MDX
+            self._model_series = MODEL_X40
             self._alm_number = ALM_NUMBER_x40
-        elif "MDX" in model or "MDA" in model:
+        elif series == MODEL_MDX:
             self.log.debug("Set Command to Model MDX")
             self._ignored_commands = COMMANDS_X20 + COMMANDS_X40 + COMMANDS_MDX_IGNORE
             self._model_series = MODEL_MDX
-            self.query("MAC")
         else:
             self.log.debug("Set Command to Model x20")
             self._ignored_commands = COMMANDS_X40 + COMMANDS_MDX
             self._model_series = MODEL_X20
             self._alm_number = ALM_NUMBER_x20
-            self.command("ECH1")
-            self.query("IDN")
+
+    def export_state(self) -> Dict[str, Any]:
+        """Return what was learned about the device, see restore_state()."""
+        return {
+            "model_series": self._model_series,
+            "identity": {
+                key: self._state[key] for key in ATTR_IDENTITY if self._state.get(key)
+            },
+            "zones": len(self.zones),
+            "inputs": {str(number): name for number, name in self._input_names.items()},
+            "unsupported_commands": list(self._unsupported_commands),
+            # the commands were rejected by this firmware
+            "unsupported_firmware": self._state.get("IDS") or "",
+        }
+
+    def restore_state(self, state: Dict[str, Any]) -> bool:
+        """Pre-populate the device from a previous export_state().
+
+        The model, zones and input names are usable right away and the
+        device is considered initialised.  Everything is queried again once
+        connected and the restored values are replaced, or discarded if the
+        device turns out to be another model or to have another MAC address.
+        The unsupported commands are only restored for the same firmware.
+        """
+        identity = state.get("identity", {})
+        model = identity.get("IDM")
+        if not model:
+            return False
+        for key in ATTR_IDENTITY:
+            if key in identity:
+                self._state[key] = identity[key]
+        self._restored_mac = {
+            key: identity[key]
+            for key in ("IDN", "EMAC", "WMAC", "MAC")
+            if identity.get(key)
+        }
+        self._set_model_series(model)
+        self.set_zones(model)
+        for zone in range(1, state.get("zones", 0) + 1):
+            if zone not in self.zones:
+                self.zones[zone] = Zone(self, zone)
+        for number, name in state.get("inputs", {}).items():
+            self._input_names[int(number)] = name
+            self._input_numbers[name] = int(number)
+        if state.get("unsupported_firmware") == identity.get("IDS", ""):
+            self._unsupported_commands = list(state.get("unsupported_commands", []))
+        else:
+            self.log.debug("Discarding the unsupported commands of another firmware")
+        self._restored = True
+        self._set_device_initialised()
+        self.log.debug("Restored the state of %s", model)
+        return True
+
+    def _discard_restored_state(self):
+        """Forget the input names and unsupported commands of another device."""
+        self._input_names.clear()
+        self._input_numbers.clear()
+        self._unsupported_commands = []
+        self._rejections.clear()
+        self._restored_mac.clear()
 
     def set_zones(self, model: str):
         """Set zones for the appropriate objects."""
@@ -734,8 +1572,6 @@ class AVR(asyncio.Protocol):
 
         >>> command('Z1VOL-50')
         """
-        if "?" not in command and "INP" not in command:
-            self._last_command = command
         command = command + ";"
         self.formatted_command(command)
 
@@ -756,14 +1592,11 @@ class AVR(asyncio.Protocol):
         >>> formatted_command('Z1VOL-50')
         """
         command = command.encode()
-
         self.log.debug("> %s", command)
-        try:
-            self.transport.write(command)
-        except Exception as error:
-            self.log.warning(
-                "No transport found, unable to send command. error: %s", str(error)
-            )
+        if self._write_batch is not None:
+            self._write_batch.append(command)
+            return
+        self._scheduler.submit(command, INTERACTIVE)
 
     @property
     def support_audio_listening_mode(self) -> bool:
@@ -840,14 +1673,7 @@ class AVR(asyncio.Protocol):
     #
 
     def _get_boolean(self, key):
-        keyname = "_" + key
-        try:
-            value = getattr(self, keyname)
-            return bool(int(value))
-        except ValueError:
-            return False
-        except AttributeError:
-            return False
+        return self._state.decoded(key, False)
 
     def _convert_to_boolean(self, value: str) -> bool:
         if value == "1":
@@ -942,55 +1768,56 @@ class AVR(asyncio.Protocol):
     @property
     def model(self):
         """Device Model Name (read-only)."""
-        return self._IDM or UNKNOWN_MODEL
+        return self._state.get("IDM") or UNKNOWN_MODEL
 
     @property
     def swversion(self):
         """Software version (read-only)."""
-        return self._IDS or "Unknown Version"
+        return self._state.get("IDS") or "Unknown Version"
 
     @property
     def region(self):
         """Region (read-only)."""
-        return self._IDR or "Unknown Region"
+        return self._state.get("IDR") or "Unknown Region"
 
     @property
     def build_date(self):
         """Software build date (read-only)."""
-        return self._IDB or "Unknown Build Date"
+        return self._state.get("IDB") or "Unknown Build Date"
 
     @property
     def hwversion(self):
         """Hardware version (read-only)."""
-        return self._IDH or "Unknown Version"
+        return self._state.get("IDH") or "Unknown Version"
 
     @property
     def macaddress(self):
         """Network MCU MAC address (read-only)."""
-        return self._IDN or self._EMAC or self._WMAC or self._MAC or EMPTY_MAC
+        state = self._state
+        return (
+            state.get("IDN")
+            or state.get("EMAC")
+            or state.get("WMAC")
+            or state.get("MAC")
+            or EMPTY_MAC
+        )
 
     @property
     def audio_input_name(self):
         """Current audio input format short description (read-only)."""
-        return self._Z1AIN or ""
+        return self._state.get("Z1AIN") or ""
 
     @property
     def audio_input_ratename(self):
         """Current audio input format sample or bit rate (read-only)."""
-        return self._Z1AIR or ""
+        return self._state.get("Z1AIR") or ""
 
     #
     # Read-only raw numeric properties
     #
 
     def _get_integer(self, key):
-        keyname = "_" + key
-        if hasattr(self, keyname):
-            value = getattr(self, keyname)
-        try:
-            return int(value)
-        except ValueError:
-            return
+        return self._state.decoded(key)
 
     @property
     def dolby_dialog_normalization(self):
@@ -1029,22 +1856,12 @@ class AVR(asyncio.Protocol):
     #
     #
     def _get_multiprop(self, key, mode="raw"):
-        keyname = "_" + key
-
-        if hasattr(self, keyname):
-            rawvalue = getattr(self, keyname)
-            value = rawvalue
-
-            if key in LOOKUP:
-                if rawvalue in LOOKUP[key]:
-                    value = LOOKUP[key][rawvalue]
-
-            if mode == "raw":
-                return rawvalue
-            else:
-                return value
-        else:
+        if key not in LOOKUP_SLOTS:
             return
+        if mode == "raw":
+            return self._state.get(key, "")
+        # the text from LOOKUP was looked up when the value was received
+        return self._state.decoded(key, "")
 
     #
     # Read/write properties with raw and text options
@@ -1207,11 +2024,13 @@ class AVR(asyncio.Protocol):
 class Zone:
     """Control of a specific Zone of the amplifier."""
 
+    __slots__ = ("_zone", "_avr", "need_refresh", "values")
+
     def __init__(self, avr: AVR, zone: int) -> None:
         self._zone = zone
         self._avr = avr
         self.need_refresh = True
-        self.values = {}
+        self.values = StateStore(ZONELOOKUP_SLOTS, ZONELOOKUP_DECODERS)
 
     def command(self, command: str) -> None:
         self._avr.command(f"Z{self._zone}{command}")
@@ -1219,23 +2038,28 @@ class Zone:
     def query(self, command: str) -> None:
         self._avr.query(f"Z{self._zone}{command}")
 
+    def on_change(self, command: str, callback: KeyCallback) -> Callable[[], None]:
+        """Call back with a StateChange whenever a zone item changes, eg: VOL."""
+        return self._avr.on_change(f"Z{self._zone}{command}", callback)
+
+    async def async_command(
+        self, command: str, timeout: float = COMMAND_TIMEOUT, query: bool = False
+    ) -> str:
+        """Issue a command to the zone and return the value confirmed by the device."""
+        return await self._avr.async_command(
+            f"Z{self._zone}{command}", timeout=timeout, query=query
+        )
+
+    async def async_query(self, command: str, timeout: float = COMMAND_TIMEOUT) -> str:
+        """Query an item of the zone and return its value."""
+        return await self._avr.async_query(f"Z{self._zone}{command}", timeout=timeout)
+
     def _get_integer(self, key, default: int = 0) -> int:
-        if key not in self.values:
-            return default
-        try:
-            return int(self.values[key])
-        except ValueError:
-            return 0
+        value = self.values.decoded(key, default)
+        return 0 if value is None else value
 
     def _get_boolean(self, key) -> bool:
-        if key not in self.values:
-            return False
-        try:
-            return bool(int(self.values[key]))
-        except ValueError:
-            return False
-        except AttributeError:
-            return False
+        return self.values.decoded(key, False)
 
     def _set_boolean(self, key: str, value: bool):
         if value is True:
@@ -1310,6 +2134,13 @@ class Zone:
         self._set_boolean("POW", value)
         self.query("POW")
 
+    async def async_set_power(
+        self, value: bool, timeout: float = COMMAND_TIMEOUT
+    ) -> bool:
+        """Switch the zone on or off and wait for the device to confirm it."""
+        command = "POW1" if value is True else "POW0"
+        return await self.async_command(command, timeout, query=True) == "1"
+
     @property
     def volume(self) -> int:
         """Current volume level (read/write).
@@ -1332,12 +2163,42 @@ class Zone:
     @volume.setter
     def volume(self, value: int):
         if 0 <= value <= 100:
-            if self._avr._model_series == MODEL_X40:
-                self.command(f"PVOL{value}")
-            elif self._avr._model_series == MODEL_MDX:
-                self.command(f"VOL{value}")
-            else:
-                self.attenuation = self.volume_to_attenuation(value)
+            self._continuous_command(self._volume_command(value))
+
+    def _continuous_command(self, command: str):
+        """Send a volume command through the coalescer if it is enabled."""
+        coalescer = self._avr._coalescer
+        zone_command = ZONELOOKUP_INDEX.match(command)
+        if coalescer is None or zone_command not in COALESCED_ZONE_COMMANDS:
+            self.command(command)
+            return
+        coalescer.submit(f"Z{self._zone}{zone_command}", f"Z{self._zone}{command}")
+
+    async def _async_continuous_command(self, command: str, timeout: float) -> str:
+        """Send a volume command and wait for the device to report the final value."""
+        coalescer = self._avr._coalescer
+        zone_command = ZONELOOKUP_INDEX.match(command)
+        if coalescer is None or zone_command not in COALESCED_ZONE_COMMANDS:
+            return await self.async_command(command, timeout)
+        return await coalescer.submit_and_wait(
+            f"Z{self._zone}{zone_command}", f"Z{self._zone}{command}", timeout
+        )
+
+    def _volume_command(self, value: int) -> str:
+        """Return the command setting the volume for the model."""
+        if self._avr._model_series == MODEL_X40:
+            return f"PVOL{value}"
+        elif self._avr._model_series == MODEL_MDX:
+            return f"VOL{value}"
+        attenuation = self.volume_to_attenuation(value)
+        self._avr.log.debug("Setting attenuation to %s", str(attenuation))
+        return f"VOL{attenuation}"
+
+    async def async_set_volume(self, value: int, timeout: float = COMMAND_TIMEOUT):
+        """Set the volume (0-100) and wait for the device to confirm it."""
+        if not 0 <= value <= 100:
+            raise ValueError(f"Invalid volume: {value}")
+        await self._async_continuous_command(self._volume_command(value), timeout)
 
     @property
     def volume_as_percentage(self) -> float:
@@ -1360,6 +2221,14 @@ class Zone:
             value = round(value * 100)
             self.volume = value
 
+    async def async_set_volume_as_percentage(
+        self, value: float, timeout: float = COMMAND_TIMEOUT
+    ):
+        """Set the volume (0-1) and wait for the device to confirm it."""
+        if not 0 <= value <= 1:
+            raise ValueError(f"Invalid volume percentage: {value}")
+        await self.async_set_volume(round(value * 100), timeout)
+
     @property
     def attenuation(self) -> int:
         """Current volume attenuation in dB (read/write).
@@ -1378,7 +2247,15 @@ class Zone:
     def attenuation(self, value: int):
         if -90 <= value <= 0:
             self._avr.log.debug("Setting attenuation to %s", str(value))
-            self.command(f"VOL{value}")
+            self._continuous_command(f"VOL{value}")
+
+    async def async_set_attenuation(
+        self, value: int, timeout: float = COMMAND_TIMEOUT
+    ) -> int:
+        """Set the attenuation (-90 to 0) and return the value confirmed by the device."""
+        if not -90 <= value <= 0:
+            raise ValueError(f"Invalid attenuation: {value}")
+        return int(await self._async_continuous_command(f"VOL{value}", timeout))
 
     @property
     def mute(self) -> bool:
@@ -1392,6 +2269,13 @@ class Zone:
         # (eg: after power on without changing the volume first)
         self.query("MUT")
 
+    async def async_set_mute(
+        self, value: bool, timeout: float = COMMAND_TIMEOUT
+    ) -> bool:
+        """Mute or unmute the zone and wait for the device to confirm it."""
+        command = "MUT1" if value is True else "MUT0"
+        return await self.async_command(command, timeout, query=True) == "1"
+
     @property
     def input_number(self) -> int:
         """Number of currently active input (read-write)."""
@@ -1405,6 +2289,14 @@ class Zone:
             # Query to make sure it actually changes
             self.query("INP")
 
+    async def async_set_input_number(
+        self, number: int, timeout: float = COMMAND_TIMEOUT
+    ) -> int:
+        """Switch to an input and return the input number confirmed by the device."""
+        if not 1 <= number <= 99:
+            raise ValueError(f"Invalid input number: {number}")
+        return int(await self.async_command(f"INP{number}", timeout, query=True))
+
     @property
     def input_name(self) -> str:
         """Name of currently active input (read-write)."""
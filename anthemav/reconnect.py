@@ -0,0 +1,79 @@
+"""Module containing the reconnection policy of the connections."""
+import asyncio
+import random
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, Optional
+
+__all__ = ["ReconnectPolicy"]
+
+
+class ReconnectPolicy:
+    """Delays between the attempts to reconnect to a device.
+
+    The first retry after a failure is immediate, the next ones wait a random
+    delay between 0 and an exponential backoff capped at cap seconds (full
+    jitter).  Devices and clients that lost their connection at the same
+    time, eg: after a power outage, spread their attempts instead of
+    reconnecting in lockstep.
+
+    A policy can be shared by many connections, concurrency then limits how
+    many of them try to connect at the same time so a fleet comes back in
+    waves.
+    """
+
+    def __init__(
+        self,
+        base: float = 1.0,
+        cap: float = 300.0,
+        factor: float = 1.5,
+        concurrency: Optional[int] = None,
+        rng: random.Random = None,
+    ):
+        """Instantiate the policy.
+
+        :param base:
+            backoff of the second retry in seconds
+        :param cap:
+            maximum backoff in seconds
+        :param factor:
+            growth of the backoff after each failure
+        :param concurrency:
+            maximum number of connection attempts at the same time for the
+            connections sharing this policy (optional, unlimited by default)
+        :param rng:
+            random number generator (optional)
+        """
+        self.base = base
+        self.cap = cap
+        self.factor = factor
+        self.concurrency = concurrency
+        self._random = rng or random.Random()
+        # created in the running loop, Python < 3.10 binds it at creation
+        self._slots: Optional[asyncio.Semaphore] = None
+        self._slots_loop: Optional[asyncio.AbstractEventLoop] = None
+
+    def backoff(self, failures: int) -> float:
+        """Return the maximum delay after a number of consecutive failures."""
+        if failures <= 1:
+            return 0.0
+        # compare exponents to not overflow after many failures
+        if failures - 2 > 64:
+            return self.cap
+        return min(self.cap, self.base * self.factor ** (failures - 2))
+
+    def delay(self, failures: int) -> float:
+        """Return the seconds to wait after a number of consecutive failures."""
+        return self._random.uniform(0, self.backoff(failures))
+
+    @asynccontextmanager
+    async def attempt(self) -> AsyncIterator[None]:
+        """Wait for a free slot to make a connection attempt."""
+        if not self.concurrency:
+            yield
+            return
+        loop = asyncio.get_running_loop()
+        if self._slots_loop is not loop:
+            self._slots = asyncio.Semaphore(self.concurrency)
+            self._slots_loop = loop
+        async with self._slots:
+            yield
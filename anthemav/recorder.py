@@ -0,0 +1,222 @@
+"""Module containing the recorder and replay of the traffic with a device."""
+import asyncio
+import gzip
+import json
+from time import monotonic
+from typing import IO, Any, Iterator, List, NamedTuple, Tuple, Union
+
+__all__ = [
+    "RECEIVED",
+    "SENT",
+    "Record",
+    "TrafficRecorder",
+    "ReplayTransport",
+    "read_recording",
+    "replay",
+]
+
+FORMAT = "anthemav-recording"
+VERSION = 1
+
+# Direction of a record
+RECEIVED = "<"
+SENT = ">"
+
+
+class Record(NamedTuple):
+    """Raw bytes received from or sent to the device."""
+
+    time: float
+    direction: str
+    data: bytes
+
+
+def _open(path: str, mode: str) -> IO[str]:
+    """Open a recording, compressed if the name ends with .gz."""
+    if path.endswith(".gz"):
+        return gzip.open(path, mode + "t", encoding="utf-8")
+    return open(path, mode, encoding="utf-8")
+
+
+class TrafficRecorder:
+    """Save the raw traffic with a device to a file.
+
+    Each line of the file is a JSON list with the seconds since the
+    recording started, the direction (< received, > sent) and the bytes,
+    decoded as latin-1 so any byte survives the round trip.  The first line
+    describes the recording.  Names ending with .gz are compressed.
+
+    Inbound data is saved in the chunks it was read from the network, so a
+    replay cuts the stream exactly like the live session did.
+    """
+
+    def __init__(self, file: Union[str, IO[str]], model: str = ""):
+        """Start a recording.
+
+        :param file:
+            path of the recording, or a text file object
+        :param model:
+            model of the device, saved in the header (optional)
+        """
+        if isinstance(file, str):
+            self._file = _open(file, "w")
+            self._owned = True
+        else:
+            self._file = file
+            self._owned = False
+        self._start = monotonic()
+        self.records = 0
+        header = {"format": FORMAT, "version": VERSION, "model": model}
+        self._file.write(json.dumps(header) + "\n")
+
+    def received(self, data: bytes):
+        """Record the bytes read from the device."""
+        self._write(RECEIVED, data)
+
+    def sent(self, data: bytes):
+        """Record the bytes written to the device."""
+        self._write(SENT, data)
+
+    def _write(self, direction: str, data: bytes):
+        if self._file is None:
+            return
+        self.records += 1
+        line = [round(monotonic() - self._start, 6), direction, data.decode("latin-1")]
+        self._file.write(json.dumps(line, separators=(",", ":")) + "\n")
+
+    def close(self):
+        """Stop recording and close the file if the recorder opened it."""
+        if self._file is None:
+            return
+        if self._owned:
+            self._file.close()
+        else:
+            self._file.flush()
+        self._file = None
+
+
+def read_recording(file: Union[str, IO[str]]) -> Tuple[dict, List[Record]]:
+    """Load a recording, return its header and records."""
+    if isinstance(file, str):
+        with _open(file, "r") as stream:
+            return read_recording(stream)
+
+    lines = iter(file)
+    header = json.loads(next(lines, "{}"))
+    if header.get("format") != FORMAT:
+        raise ValueError("Not an anthemav recording")
+    if header.get("version") != VERSION:
+        raise ValueError(f"Unsupported recording version {header.get('version')}")
+    records = []
+    for line in lines:
+        if line.strip():
+            time, direction, data = json.loads(line)
+            records.append(Record(time, direction, data.encode("latin-1")))
+    return header, records
+
+
+class ReplayTransport(asyncio.Transport):
+    """Transport collecting what the AVR writes during a replay."""
+
+    def __init__(self):
+        """Instantiate the transport."""
+        super().__init__()
+        self.written: List[bytes] = []
+        self.reading = True
+        self._closing = False
+
+    def write(self, data: bytes):
+        """Collect the bytes written by the AVR."""
+        self.written.append(data)
+
+    def writelines(self, list_of_data):
+        """Collect the bytes written by the AVR."""
+        for data in list_of_data:
+            self.write(data)
+
+    def set_write_buffer_limits(self, high: int = None, low: int = None):
+        """Ignore the limits, nothing is ever buffered."""
+
+    def get_write_buffer_limits(self) -> Tuple[int, int]:
+        """Return the limits of the write buffer, nothing is ever buffered."""
+        return (0, 0)
+
+    def get_write_buffer_size(self) -> int:
+        """Return the size of the write buffer, nothing is ever buffered."""
+        return 0
+
+    def get_extra_info(self, name: str, default: Any = None) -> Any:
+        """Return no socket information, there isn't any."""
+        return default
+
+    def pause_reading(self):
+        """Pause the replay of the received data."""
+        self.reading = False
+
+    def resume_reading(self):
+        """Resume the replay of the received data."""
+        self.reading = True
+
+    def is_reading(self) -> bool:
+        """Return True if the replay isn't paused."""
+        return self.reading
+
+    def is_closing(self) -> bool:
+        """Return True once the transport was closed."""
+        return self._closing
+
+    def close(self):
+        """Close the transport."""
+        self._closing = True
+
+    def abort(self):
+        """Close the transport."""
+        self._closing = True
+
+
+def _received(records: List[Record]) -> Iterator[Record]:
+    return (record for record in records if record.direction == RECEIVED)
+
+
+async def replay(
+    file: Union[str, IO[str]],
+    avr: asyncio.Protocol,
+    realtime: bool = False,
+    speed: float = 1.0,
+) -> int:
+    """Feed the data received in a recording to an AVR.
+
+    The chunks are fed to data_received in order and each one is parsed
+    before the next one, so a replay is deterministic.  They are fed as fast
+    as possible, or at their original timing with realtime.  An AVR without
+    a transport gets a ReplayTransport, which collects what it writes.
+    Return the number of chunks fed.
+
+    :param file:
+        path of the recording, or a text file object
+    :param avr:
+        AVR receiving the data, eg: AVR(loop=loop)
+    :param realtime:
+        wait between the chunks like in the recording
+    :param speed:
+        speed up (or slow down) a realtime replay
+    """
+    _, records = read_recording(file)
+    loop = asyncio.get_running_loop()
+    if avr.transport is None:
+        # not connection_made, it would query the device outside the recording
+        avr.transport = ReplayTransport()
+
+    start = loop.time()
+    chunks = 0
+    for record in _received(records):
+        if realtime:
+            delay = start + record.time / speed - loop.time()
+            if delay > 0:
+                await asyncio.sleep(delay)
+        avr.data_received(record.data)
+        chunks += 1
+        # a refresh triggered by the recording waits for the answers, which
+        # are in the next chunks like they were in the live session
+        await avr.wait_until_idle()
+    return chunks
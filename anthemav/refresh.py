@@ -0,0 +1,195 @@
+"""Module containing the refresh of a device after it's powered on."""
+import asyncio
+import logging
+from typing import Awaitable, Callable, List, NamedTuple, Optional, Sequence, Set
+
+__all__ = ["PowerOnRefresh", "RefreshPhase"]
+
+# Seconds to let the device boot before the first queries
+POWERON_DELAY = 1.0
+# Seconds between two attempts to get what is still missing
+POWERON_RETRY_INTERVAL = 5.0
+# Attempts before giving up on an optional phase
+POWERON_ATTEMPTS = 3
+# Attempts before giving up on a required phase
+POWERON_REQUIRED_ATTEMPTS = 10
+
+
+class RefreshPhase(NamedTuple):
+    """A group of items refreshed after power on.
+
+    missing returns the queries for the items not received yet, eg: Z1VOL.
+    A required phase is retried until it's complete, the others give up after
+    a few attempts because some devices never answer some items.  A required
+    phase still gives up eventually so a device that never answers one of
+    its items isn't refreshed forever, the refresh then isn't complete.
+    """
+
+    name: str
+    missing: Callable[[], List[str]]
+    required: bool = False
+
+
+class PowerOnRefresh:
+    """Supervise the refresh of a device after it's powered on.
+
+    Immediately after a power on the device is inconsistent with which items
+    can be successfully queried, input names being the laggiest.  Phases are
+    refreshed in order and each attempt only queries the items the previous
+    ones didn't get, until the required phases are complete.  A single
+    refresh runs at a time and it's cancelled when the device is powered off
+    or the connection is lost.
+    """
+
+    def __init__(
+        self,
+        query: Callable[[List[str]], Awaitable[None]],
+        phases: Sequence[RefreshPhase],
+        loop_getter: Callable[[], asyncio.AbstractEventLoop],
+        retry_interval: float = POWERON_RETRY_INTERVAL,
+        attempts: int = POWERON_ATTEMPTS,
+        required_attempts: int = POWERON_REQUIRED_ATTEMPTS,
+    ):
+        """Instantiate the refresh.
+
+        :param query:
+            coroutine function querying a list of items
+        :param phases:
+            phases in the order they are refreshed
+        :param loop_getter:
+            function returning the asyncio event loop
+        :param retry_interval:
+            maximum number of seconds to wait for the missing items before
+            querying them again
+        :param attempts:
+            number of attempts for the phases that aren't required
+        :param required_attempts:
+            number of attempts for the required phases
+        """
+        self.log = logging.getLogger(__name__)
+        self.phases = phases
+        self.retry_interval = retry_interval
+        self.attempts = attempts
+        self.required_attempts = required_attempts
+        self.phase: Optional[str] = None
+        self.complete = False
+        # a required phase gave up, complete stays False
+        self.gave_up = False
+        self._query = query
+        self._get_loop = loop_getter
+        self._timer: asyncio.TimerHandle = None
+        self._task: asyncio.Task = None
+        self._progress: asyncio.Event = None
+
+    @property
+    def running(self) -> bool:
+        """Return True if a refresh is scheduled or in progress."""
+        return self._timer is not None or (
+            self._task is not None and not self._task.done()
+        )
+
+    def start(self, delay: float = POWERON_DELAY):
+        """Start a refresh after delay unless one is already running."""
+        if self.running:
+            return
+        self.complete = False
+        self.gave_up = False
+        self._timer = self._get_loop().call_later(delay, self._spawn)
+
+    def cancel(self):
+        """Stop the refresh and forget that it was complete."""
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        self.phase = None
+        self.complete = False
+        self.gave_up = False
+
+    def progress(self):
+        """Wake the refresh up to check what is still missing."""
+        if self._progress is not None:
+            self._progress.set()
+
+    async def wait(self):
+        """Wait for the running refresh to stop."""
+        while self._timer is not None:
+            await asyncio.sleep(self._timer.when() - self._get_loop().time())
+        task = self._task
+        if task is None:
+            return
+        try:
+            await asyncio.shield(task)
+        except asyncio.CancelledError:
+            if not task.cancelled():
+                raise
+
+    def _spawn(self):
+        self._timer = None
+        self._task = self._get_loop().create_task(self._run())
+
+    def _missing(self, given_up: Set[str], required: bool = False) -> bool:
+        """Return True if a phase still has missing items."""
+        return any(
+            phase.missing()
+            for phase in self.phases
+            if phase.name not in given_up and (phase.required or not required)
+        )
+
+    def _update_complete(self, given_up: Set[str]):
+        """Set complete once the required phases got every item."""
+        self.complete = not self.gave_up and not self._missing(given_up, required=True)
+
+    async def _run(self):
+        self._progress = asyncio.Event()
+        given_up: Set[str] = set()
+        attempt = 0
+        try:
+            while True:
+                self._update_complete(given_up)
+                pending = False
+                for phase in self.phases:
+                    if phase.name in given_up:
+                        continue
+                    keys = phase.missing()
+                    if not keys:
+                        continue
+                    if not phase.required and attempt >= self.attempts:
+                        self.log.debug("Giving up on %s: %s", phase.name, keys)
+                        given_up.add(phase.name)
+                        continue
+                    if phase.required and attempt >= self.required_attempts:
+                        self.log.warning("Giving up on %s: %s", phase.name, keys)
+                        given_up.add(phase.name)
+                        self.gave_up = True
+                        continue
+                    self.phase = phase.name
+                    self.log.debug("Refreshing %s: %s", phase.name, keys)
+                    await self._query(keys)
+                    pending = True
+                if not pending:
+                    break
+                attempt += 1
+                await self._wait_for_progress(given_up)
+            self._update_complete(given_up)
+            self.log.debug("Power on refresh done after %d attempts", attempt)
+        finally:
+            self.phase = None
+            self._progress = None
+
+    async def _wait_for_progress(self, given_up: Set[str]):
+        """Wait until nothing is missing or the retry interval elapsed."""
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + self.retry_interval
+        while self._missing(given_up):
+            self._update_complete(given_up)
+            remaining = deadline - loop.time()
+            if remaining <= 0:
+                return
+            self._progress.clear()
+            try:
+                await asyncio.wait_for(self._progress.wait(), remaining)
+            except asyncio.TimeoutError:
+                return
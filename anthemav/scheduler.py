@@ -0,0 +1,377 @@
+"""Module containing the scheduler of the commands sent to the device."""
+import asyncio
+import logging
+from collections import deque
+from time import monotonic
+from typing import (
+    Callable,
+    Deque,
+    Dict,
+    Iterable,
+    List,
+    NamedTuple,
+    Optional,
+    Set,
+    Tuple,
+)
+
+__all__ = ["CommandScheduler", "INTERACTIVE", "BACKGROUND", "command_key"]
+
+# Priority classes, in the order they are served
+INTERACTIVE = "interactive"
+BACKGROUND = "background"
+PRIORITIES = (INTERACTIVE, BACKGROUND)
+
+
+def command_key(data: bytes) -> str:
+    """Return the item of a command, eg: Z1VOL for Z1VOL?; and Z1VOL-40;."""
+    return data.decode().rstrip(";?")
+
+
+class InFlight(NamedTuple):
+    """A command written to the device and not acknowledged yet."""
+
+    key: Optional[str]
+    data: bytes
+    priority: str
+    deadline: float
+
+
+class CommandScheduler:
+    """Send the commands of a device in priority order.
+
+    Commands are written as long as fewer than window of them are waiting
+    for the device to acknowledge them.  Interactive commands (a setter, a
+    query from the user) go first and background ones (refresh queries) wait
+    for a free slot, so a command sent during a refresh is at most window
+    commands behind.  After fairness interactive commands in a row, a waiting
+    background command is sent so a refresh keeps progressing while the user
+    is busy.
+
+    The device answers a query or a setter with the value of the item, an
+    error message, or for some setters only a bare ";".  Each answer is
+    matched to the oldest command of its item waiting for one, a bare ";" to
+    the oldest command that isn't a query.  A command that isn't
+    acknowledged within timeout seconds frees its slot.  Messages the device
+    sends on its own don't free anything.
+
+    A query identical to one that is queued or not answered yet is joined to
+    it instead of being sent again, the one answer serves both.  An
+    interactive query joined to a queued background one moves it to the
+    interactive queue.
+
+    Nothing is written while the transport is paused (its buffer is full
+    because the device stopped reading).  At most max_queued commands are
+    kept meanwhile, the oldest background command is dropped first to make
+    room, then the oldest interactive one.
+    """
+
+    def __init__(
+        self,
+        write: Callable[[List[bytes]], None],
+        loop_getter: Callable[[], asyncio.AbstractEventLoop],
+        window: int = 8,
+        fairness: int = 4,
+        timeout: float = 0.5,
+        max_queued: int = 256,
+        key: Callable[[bytes], Optional[str]] = command_key,
+        on_expire: Callable[[bytes], None] = None,
+    ):
+        """Instantiate the scheduler.
+
+        :param write:
+            function writing a list of commands to the transport
+        :param loop_getter:
+            function returning the asyncio event loop
+        :param window:
+            maximum number of commands waiting to be acknowledged
+        :param fairness:
+            interactive commands sent in a row before a background one
+        :param timeout:
+            seconds to wait for the acknowledgement of a command
+        :param max_queued:
+            maximum number of commands waiting to be sent
+        :param key:
+            function returning the item of a command, matched to the items
+            given to acknowledge
+        :param on_expire:
+            called with each command that wasn't acknowledged in time
+            (optional)
+        """
+        self.log = logging.getLogger(__name__)
+        self.window = window
+        self.fairness = fairness
+        self.timeout = timeout
+        self.max_queued = max_queued
+        self.paused = False
+        self.pauses = 0
+        self.paused_time = 0.0
+        self._paused_at = 0.0
+        self._write = write
+        self._get_loop = loop_getter
+        self._key = key
+        self._on_expire = on_expire
+        self._in_flight: Deque[InFlight] = deque()
+        self._drain_waiters: List[asyncio.Future] = []
+        # queries queued (with their priority) or sent and not answered yet
+        self._queued_queries: Dict[bytes, str] = {}
+        self._sent_queries: Set[bytes] = set()
+        self._queues: Dict[str, Deque[Tuple[bytes, float]]] = {
+            priority: deque() for priority in PRIORITIES
+        }
+        self._sent = dict.fromkeys(PRIORITIES, 0)
+        self._wait = dict.fromkeys(PRIORITIES, 0.0)
+        self._max_wait = dict.fromkeys(PRIORITIES, 0.0)
+        self._dropped = dict.fromkeys(PRIORITIES, 0)
+        self._expired = dict.fromkeys(PRIORITIES, 0)
+        self._joined = dict.fromkeys(PRIORITIES, 0)
+        self._streak = 0
+        self._timer: asyncio.TimerHandle = None
+
+    @property
+    def pending(self) -> int:
+        """Number of commands waiting for a slot."""
+        return sum(len(queue) for queue in self._queues.values())
+
+    @property
+    def in_flight(self) -> int:
+        """Number of commands waiting to be acknowledged."""
+        return len(self._in_flight)
+
+    @property
+    def draining(self) -> bool:
+        """Return True if a caller waits for the commands to be acknowledged."""
+        return bool(self._drain_waiters)
+
+    def submit(self, data: bytes, priority: str = INTERACTIVE):
+        """Queue a command and send it if a slot is free."""
+        now = monotonic()
+        # an overdue query is sent again instead of joining the lost one
+        self._release_overdue(now)
+        self._enqueue(data, priority, now)
+        self._pump()
+
+    def submit_many(self, commands: Iterable[bytes], priority: str = BACKGROUND):
+        """Queue commands and send as many as the free slots allow at once."""
+        now = monotonic()
+        self._release_overdue(now)
+        for data in commands:
+            self._enqueue(data, priority, now)
+        self._pump()
+
+    def _enqueue(self, data: bytes, priority: str, now: float):
+        """Queue a command, unless it's a query already waiting for an answer."""
+        if data.endswith(b"?;"):
+            if data in self._sent_queries:
+                self._joined[priority] += 1
+                return
+            queued = self._queued_queries.get(data)
+            if queued is not None:
+                self._joined[priority] += 1
+                if priority == INTERACTIVE and queued != INTERACTIVE:
+                    self._promote(data, queued)
+                return
+            self._make_room(1)
+            self._queued_queries[data] = priority
+        else:
+            self._make_room(1)
+        self._queues[priority].append((data, now))
+
+    def _promote(self, data: bytes, priority: str):
+        """Move a queued query to the interactive queue."""
+        queue = self._queues[priority]
+        for item in queue:
+            if item[0] == data:
+                queue.remove(item)
+                self._queues[INTERACTIVE].append(item)
+                self._queued_queries[data] = INTERACTIVE
+                return
+
+    def set_window(self, window: int, timeout: float = None):
+        """Change the maximum number of commands waiting to be acknowledged."""
+        if window < 1:
+            raise ValueError("The window must be at least 1")
+        self.window = window
+        if timeout is not None:
+            self.timeout = timeout
+        self._pump()
+
+    def pause(self):
+        """Stop writing, the transport buffer is over its high water mark."""
+        if not self.paused:
+            self.paused = True
+            self.pauses += 1
+            self._paused_at = monotonic()
+            self.log.debug("Device isn't reading, pause writing")
+
+    def resume(self):
+        """Write the queued commands again."""
+        if self.paused:
+            self.paused = False
+            self.paused_time += monotonic() - self._paused_at
+            self.log.debug("Resume writing")
+            self._pump()
+
+    def _make_room(self, count: int):
+        """Drop the oldest commands to keep at most max_queued."""
+        while self.pending + count > self.max_queued:
+            background = self._queues[BACKGROUND]
+            priority = BACKGROUND if background else INTERACTIVE
+            data, _ = self._queues[priority].popleft()
+            self._queued_queries.pop(data, None)
+            self._dropped[priority] += 1
+            self.log.warning("Too many queued commands, dropping %s", data)
+            self._wake_drain()
+
+    def acknowledge(self, key: Optional[str]) -> Optional[bytes]:
+        """Free the slot of the command answered by a message of the device.
+
+        key is the item of the message, eg: Z1VOL, or None for a bare ";".
+        Return the command acknowledged, None if the message doesn't answer
+        any command.
+        """
+        return self.acknowledge_many([key])[0]
+
+    def acknowledge_many(self, keys: Iterable[Optional[str]]) -> List[Optional[bytes]]:
+        """Free the slots of the commands answered by messages received at once.
+
+        The freed slots are filled with a single write.  Return the command
+        acknowledged by each message, None if it doesn't answer any.
+        """
+        acknowledged = []
+        for key in keys:
+            for entry in self._in_flight:
+                if key is None:
+                    matched = not entry.data.endswith(b"?;")
+                else:
+                    matched = entry.key == key
+                if matched:
+                    self._in_flight.remove(entry)
+                    self._sent_queries.discard(entry.data)
+                    acknowledged.append(entry.data)
+                    break
+            else:
+                acknowledged.append(None)
+        if any(command is not None for command in acknowledged):
+            self._pump()
+            self._wake_drain()
+        return acknowledged
+
+    async def drain(self, priority: str = BACKGROUND):
+        """Wait until the commands of a priority are acknowledged or timed out."""
+        while self._queues[priority] or any(
+            entry.priority == priority for entry in self._in_flight
+        ):
+            waiter = asyncio.get_running_loop().create_future()
+            self._drain_waiters.append(waiter)
+            self._schedule_expiry()
+            try:
+                await waiter
+            finally:
+                if waiter in self._drain_waiters:
+                    self._drain_waiters.remove(waiter)
+
+    def reset(self):
+        """Forget the queued commands and the commands waiting for an answer."""
+        for queue in self._queues.values():
+            queue.clear()
+        self._in_flight.clear()
+        self._queued_queries.clear()
+        self._sent_queries.clear()
+        self._streak = 0
+        self.resume()
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        self._wake_drain()
+
+    def stats(self) -> Dict[str, Dict[str, float]]:
+        """Return the queue depth and the commands sent, dropped and their wait."""
+        in_flight = dict.fromkeys(PRIORITIES, 0)
+        for entry in self._in_flight:
+            in_flight[entry.priority] += 1
+        return {
+            priority: {
+                "queued": len(self._queues[priority]),
+                "in_flight": in_flight[priority],
+                "sent": self._sent[priority],
+                "dropped": self._dropped[priority],
+                "expired": self._expired[priority],
+                "joined": self._joined[priority],
+                "wait": self._wait[priority],
+                "max_wait": self._max_wait[priority],
+            }
+            for priority in PRIORITIES
+        }
+
+    def _next(self) -> Tuple[Optional[str], Optional[Deque[Tuple[bytes, float]]]]:
+        """Return the queue to serve next, None if they are all empty."""
+        interactive = self._queues[INTERACTIVE]
+        background = self._queues[BACKGROUND]
+        if background and (not interactive or self._streak >= self.fairness):
+            self._streak = 0
+            return BACKGROUND, background
+        if interactive:
+            self._streak = self._streak + 1 if background else 0
+            return INTERACTIVE, interactive
+        return None, None
+
+    def _pump(self):
+        """Send queued commands while slots are free."""
+        batch = []
+        now = monotonic()
+        self._release_overdue(now)
+        while not self.paused and len(self._in_flight) < self.window:
+            priority, queue = self._next()
+            if queue is None:
+                break
+            data, queued_at = queue.popleft()
+            if self._queued_queries.pop(data, None) is not None:
+                self._sent_queries.add(data)
+            wait = now - queued_at
+            self._sent[priority] += 1
+            self._wait[priority] += wait
+            if wait > self._max_wait[priority]:
+                self._max_wait[priority] = wait
+            self._in_flight.append(
+                InFlight(self._key(data), data, priority, now + self.timeout)
+            )
+            batch.append(data)
+        if batch:
+            self._write(batch)
+        # overdue commands are released lazily, a timer is only needed when
+        # something waits for their slots
+        if self.pending or self._drain_waiters:
+            self._schedule_expiry()
+
+    def _schedule_expiry(self):
+        """Wake up when the oldest command waiting to be acknowledged is overdue."""
+        if self._in_flight and self._timer is None:
+            delay = self._in_flight[0].deadline - monotonic()
+            self._timer = self._get_loop().call_later(max(0.0, delay), self._expire)
+
+    def _expire(self):
+        self._timer = None
+        self._pump()
+
+    def _release_overdue(self, now: float):
+        """Free the slots of the commands the device didn't acknowledge in time."""
+        expired = False
+        # commands are sent in order, the oldest deadline is first
+        while self._in_flight and self._in_flight[0].deadline <= now:
+            entry = self._in_flight.popleft()
+            self._sent_queries.discard(entry.data)
+            self._expired[entry.priority] += 1
+            self.log.debug("No acknowledgement for %s", entry.data)
+            if self._on_expire is not None:
+                self._on_expire(entry.data)
+            expired = True
+        if expired:
+            self._wake_drain()
+
+    def _wake_drain(self):
+        """Let the callers of drain check what is left."""
+        waiters, self._drain_waiters = self._drain_waiters, []
+        for waiter in waiters:
+            if not waiter.done():
+                waiter.set_result(None)
@@ -0,0 +1,158 @@
+"""Module containing the compact store of the values reported by a device."""
+from collections.abc import MutableMapping
+from typing import Any, Callable, Dict, Iterator, List, Optional, Sequence
+
+__all__ = [
+    "StateStore",
+    "slot_index",
+    "slot_decoders",
+    "decode_integer",
+    "decode_boolean",
+    "decode_text",
+]
+
+Decoder = Callable[[str], Any]
+
+
+def slot_index(keys) -> Dict[str, int]:
+    """Assign a slot to each known item, computed once and shared by every store."""
+    return {key: slot for slot, key in enumerate(keys)}
+
+
+def slot_decoders(
+    slots: Dict[str, int], decoders: Dict[str, Decoder]
+) -> List[Optional[Decoder]]:
+    """Return the decoder of each slot, None for the items kept as text."""
+    by_slot: List[Optional[Decoder]] = [None] * len(slots)
+    for key, decoder in decoders.items():
+        by_slot[slots[key]] = decoder
+    return by_slot
+
+
+def decode_integer(value: str) -> Optional[int]:
+    """Decode a number, None if the device sent something else."""
+    try:
+        return int(value)
+    except ValueError:
+        return None
+
+
+def decode_boolean(value: str) -> bool:
+    """Decode a 0/1 setting, False if the device sent something else."""
+    try:
+        return bool(int(value))
+    except ValueError:
+        return False
+
+
+def decode_text(table: Dict[str, str]) -> Decoder:
+    """Decode a value listed in a LOOKUP table to its description."""
+    return lambda value: table.get(value, value)
+
+
+class StateStore(MutableMapping):
+    """Values of the items of a device or zone.
+
+    Known items (LOOKUP, ZONELOOKUP) have a fixed slot in a list, so a
+    device costs one pointer per item instead of a dict entry or instance
+    attribute.  Other items, like the per input IS3IN, go to the overflow
+    dict.  An item that was never received has no value.
+
+    Known items with a decoder are also stored decoded (int, bool or text)
+    when they are received, so reading them doesn't convert anything.
+
+    It's a mutable mapping of the items received to their value, like the
+    dicts AVR.values and Zone.values used to be.
+    """
+
+    __slots__ = ("_slots", "_values", "_decoders", "_decoded", "overflow")
+
+    def __init__(
+        self,
+        slots: Dict[str, int],
+        decoders: Optional[Sequence[Optional[Decoder]]] = None,
+    ):
+        """Instantiate an empty store.
+
+        :param slots:
+            slot of each known item, from slot_index()
+        :param decoders:
+            decoder of each slot, from slot_decoders()
+        """
+        self._slots = slots
+        self._values: List[Optional[str]] = [None] * len(slots)
+        self._decoders = decoders
+        self._decoded: List[Any] = [None] * len(slots) if decoders else None
+        self.overflow: Dict[str, str] = {}
+
+    def get(self, key: str, default: Optional[str] = None) -> Optional[str]:
+        """Return the value of an item, default if it was never received."""
+        slot = self._slots.get(key)
+        if slot is None:
+            return self.overflow.get(key, default)
+        value = self._values[slot]
+        return default if value is None else value
+
+    def decoded(self, key: str, default: Any = None) -> Any:
+        """Return the decoded value of an item, default if it was never received.
+
+        Items without a decoder return their text.
+        """
+        slot = self._slots.get(key)
+        if slot is None:
+            return self.overflow.get(key, default)
+        if self._values[slot] is None:
+            return default
+        if self._decoders is None or self._decoders[slot] is None:
+            return self._values[slot]
+        return self._decoded[slot]
+
+    def __getitem__(self, key: str) -> str:
+        value = self.get(key)
+        if value is None:
+            raise KeyError(key)
+        return value
+
+    def __setitem__(self, key: str, value: str):
+        slot = self._slots.get(key)
+        if slot is None:
+            self.overflow[key] = value
+            return
+        self._values[slot] = value
+        if self._decoders is not None:
+            decoder = self._decoders[slot]
+            if decoder is not None:
+                self._decoded[slot] = decoder(value)
+
+    def __delitem__(self, key: str):
+        slot = self._slots.get(key)
+        if slot is None:
+            del self.overflow[key]
+            return
+        if self._values[slot] is None:
+            raise KeyError(key)
+        self._values[slot] = None
+        if self._decoded is not None:
+            self._decoded[slot] = None
+
+    def __contains__(self, key: str) -> bool:
+        return self.get(key) is not None
+
+    def __len__(self) -> int:
+        return len(self.overflow) + sum(v is not None for v in self._values)
+
+    def __iter__(self) -> Iterator[str]:
+        for key, slot in self._slots.items():
+            if self._values[slot] is not None:
+                yield key
+        yield from self.overflow
+
+    def __repr__(self) -> str:
+        return f"StateStore({dict(self.items())!r})"
+
+    def clear(self):
+        """Forget every value."""
+        self._values = [None] * len(self._slots)
+        if self._decoded is not None:
+            self._decoded = [None] * len(self._slots)
+        self.overflow.clear()
@@ -1,11 +1,16 @@
 """Provides a raw console to test module and demonstrate usage."""
 import argparse
 import asyncio
+import cProfile
 import logging
+import pstats
+import time
 
 import anthemav
+from anthemav.emulator import DeviceEmulator
+from anthemav.recorder import RECEIVED, read_recording, replay as replay_recording
 
-__all__ = ("console", "monitor")
+__all__ = ("console", "monitor", "emulator", "replay")
 
 
 async def console(loop, log):
@@ -17,12 +22,15 @@ async def console(loop, log):
         Hostname or IP Address of the device.
     :param port:
         TCP port number of the device.
+    :param record:
+        Save the traffic with the device to a file.
     :param verbose:
         Show debug logging.
     """
     parser = argparse.ArgumentParser(description=console.__doc__)
     parser.add_argument("--host", default="127.0.0.1", help="IP or FQDN of AVR")
     parser.add_argument("--port", default="14999", help="Port of AVR")
+    parser.add_argument("--record", help="Save the traffic to a file (.gz)")
     parser.add_argument("--verbose", "-v", action="count")
 
     args = parser.parse_args()
@@ -46,6 +54,9 @@ async def console(loop, log):
     conn = await anthemav.Connection.create(
         host=host, port=port, loop=loop, update_callback=log_callback
     )
+    if args.record:
+        log.info("Recording the traffic to %s", args.record)
+        conn.protocol.start_recording(args.record)
 
     log.info("Power state is " + str(conn.protocol.power))
     conn.protocol.power = True
@@ -62,3 +73,97 @@ def monitor():
     loop = asyncio.get_event_loop()
     asyncio.ensure_future(console(loop, log))
     loop.run_forever()
+
+
+def emulator():
+    """Run a device emulator until interrupted.
+
+    Pulls the following arguments from the command line:
+
+    :param model:
+        Model name to emulate, eg: MRX 740, MRX 720 or MDX-16.
+    :param host:
+        IP Address to listen on.
+    :param port:
+        TCP port number to listen on.
+    :param latency:
+        Seconds before answering each command.
+    :param verbose:
+        Show debug logging.
+    """
+    parser = argparse.ArgumentParser(description="Emulate an Anthem receiver")
+    parser.add_argument("--model", default="MRX 740", help="Model to emulate")
+    parser.add_argument("--host", default="127.0.0.1", help="IP to listen on")
+    parser.add_argument("--port", default="14999", help="Port to listen on")
+    parser.add_argument("--latency", default="0", help="Response latency (s)")
+    parser.add_argument("--power", action="store_true", help="Start powered on")
+    parser.add_argument("--verbose", "-v", action="count")
+
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.DEBUG if args.verbose else logging.INFO)
+    log = logging.getLogger(__name__)
+
+    device = DeviceEmulator(
+        model=args.model,
+        host=args.host,
+        port=int(args.port),
+        latency=float(args.latency),
+        power=args.power,
+    )
+    loop = asyncio.get_event_loop()
+    loop.run_until_complete(device.start())
+    log.info("Emulating %s on %s:%i", device.model, device.host, device.port)
+    loop.run_forever()
+
+
+def replay():
+    """Replay a recording made with the monitor --record option.
+
+    Pulls the following arguments from the command line:
+
+    :param recording:
+        Path of the recording.
+    :param realtime:
+        Replay at the original timing instead of as fast as possible.
+    :param speed:
+        Speed of a realtime replay.
+    :param profile:
+        Profile the replay and show the slowest functions.
+    :param verbose:
+        Show debug logging.
+    """
+    parser = argparse.ArgumentParser(description="Replay a recorded session")
+    parser.add_argument("recording", help="Path of the recording")
+    parser.add_argument("--realtime", action="store_true", help="Original timing")
+    parser.add_argument("--speed", default="1", help="Speed of a realtime replay")
+    parser.add_argument("--profile", action="store_true", help="Profile the replay")
+    parser.add_argument("--verbose", "-v", action="count")
+
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.DEBUG if args.verbose else logging.WARNING)
+
+    header, records = read_recording(args.recording)
+    messages = sum(r.data.count(b";") for r in records if r.direction == RECEIVED)
+
+    async def run():
+        avr = anthemav.AVR(loop=asyncio.get_running_loop())
+        start = time.perf_counter()
+        chunks = await replay_recording(
+            args.recording, avr, realtime=args.realtime, speed=float(args.speed)
+        )
+        return avr, chunks, time.perf_counter() - start
+
+    profiler = cProfile.Profile() if args.profile else None
+    if profiler is not None:
+        profiler.enable()
+    avr, chunks, elapsed = asyncio.run(run())
+    if profiler is not None:
+        profiler.disable()
+
+    print(f"Recording of {header.get('model') or 'an unknown model'}")
+    print(f"Replayed {chunks} chunks, {messages} messages in {elapsed * 1000:.1f} ms")
+    if elapsed and not args.realtime:
+        print(f"{messages / elapsed:,.0f} msg/s")
+    print(f"Model {avr.model}, {len(avr.zones)} zones, inputs {avr.input_list}")
+    if profiler is not None:
+        pstats.Stats(profiler).sort_stats("cumulative").print_stats(20)
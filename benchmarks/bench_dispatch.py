@@ -0,0 +1,113 @@
+#!/usr/bin/env python3
+"""Measure how fast incoming messages are matched to the command they carry.
+
+Compares the linear scan over LOOKUP and ZONELOOKUP used before the prefix
+indexes with the compiled indexes, then reports the throughput of the whole
+AVR._parse_message for the same message mix.
+
+    python benchmarks/bench_dispatch.py --messages 200000
+"""
+import argparse
+import asyncio
+import logging
+import time
+from unittest.mock import MagicMock
+
+from anthemav import AVR
+from anthemav.parser import parse_message
+from anthemav.protocol import LOOKUP, LOOKUP_INDEX, ZONELOOKUP, ZONELOOKUP_INDEX
+
+SAMPLE = [
+    "Z1POW1",
+    "Z1VOL-42",
+    "Z2PVOL51",
+    "Z1MUT0",
+    "Z1INP3",
+    "Z1AINDolby Atmos",
+    "Z1VIR14",
+    "Z1ALM03",
+    "IS3INBlu-ray",
+    "IS3ARC1",
+    "ISN04Turntable",
+    "IDMMRX 1140",
+    "EMAC00:11:22:33:44:55",
+    "GCTXS1",
+    "!IZ1XYZ",
+]
+
+
+def legacy_match(data):
+    """Replicate the linear scans done before the prefix indexes."""
+    key = None
+    for lookup_key in LOOKUP:
+        if data.startswith(lookup_key):
+            key = lookup_key
+            break
+    if data.startswith("Z"):
+        zone_data = data[2:]
+        for zone_command in ZONELOOKUP:
+            if zone_data.startswith(zone_command):
+                return zone_command
+    if key is None and data.startswith("IS"):
+        return parse_message(data)
+    return key
+
+
+def indexed_match(data):
+    """Match with the compiled prefix indexes."""
+    key = LOOKUP_INDEX.match(data)
+    if data.startswith("Z"):
+        zone_command = ZONELOOKUP_INDEX.match(data[2:])
+        if zone_command is not None:
+            return zone_command
+    if key is None and data.startswith("IS"):
+        return parse_message(data)
+    return key
+
+
+def run_match(name, func, messages):
+    """Time one matching implementation."""
+    start = time.perf_counter()
+    for message in messages:
+        func(message)
+    elapsed = time.perf_counter() - start
+    print(f"  {name:10} {len(messages) / elapsed:12,.0f} msg/s")
+
+
+async def run_parse(messages):
+    """Time AVR._parse_message for the whole mix on a powered on x40."""
+    avr = AVR(loop=asyncio.get_running_loop())
+    avr.transport = MagicMock()
+    await avr._parse_message("IDMMRX 1140")
+    for zone in avr.zones.values():
+        zone.need_refresh = False
+    avr._device_power = True
+    avr._force_refresh = True
+    start = time.perf_counter()
+    for message in messages:
+        await avr._parse_message(message)
+    elapsed = time.perf_counter() - start
+    print(f"  {'parse':10} {len(messages) / elapsed:12,.0f} msg/s")
+
+
+def main():
+    """Run the comparison."""
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument("--messages", type=int, default=100000)
+    args = parser.parse_args()
+    # keep the error messages in the mix from flooding the console
+    logging.disable(logging.CRITICAL)
+
+    messages = [SAMPLE[i % len(SAMPLE)] for i in range(args.messages)]
+    # the parse run must not see input changes, they schedule refresh timers
+    parse_messages = [m for m in messages if not m.startswith("Z1INP")]
+    print(f"{len(LOOKUP)} LOOKUP and {len(ZONELOOKUP)} ZONELOOKUP commands")
+    run_match("linear", legacy_match, messages)
+    run_match("indexed", indexed_match, messages)
+    asyncio.run(run_parse(parse_messages))
+
+
+if __name__ == "__main__":
+    main()
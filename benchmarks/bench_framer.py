@@ -0,0 +1,156 @@
+#!/usr/bin/env python3
+"""Compare the throughput of the datagram framer against the legacy str buffer.
+
+The legacy path decodes every chunk, appends it to a str buffer, spawns a task
+and splits the whole buffer on semicolons, which breaks datagrams straddling
+two chunks.  Both are fed the same stream cut into fixed size chunks, first
+through the framing step alone and then through AVR.data_received with message
+interpretation stubbed out.
+
+    python benchmarks/bench_framer.py --frames 200000
+"""
+import argparse
+import asyncio
+import time
+from unittest.mock import MagicMock
+
+from anthemav import AVR
+from anthemav.framer import DatagramFramer
+
+SAMPLE = [
+    "Z1POW1",
+    "Z1VOL-42",
+    "Z1MUT0",
+    "Z1INP3",
+    "Z1AINDolby Atmos",
+    "Z1VIR14",
+    "IS3INBlu-ray Lecteur Zoé",
+    "IS3ARC1",
+    "ISN04Turntable",
+    "IDMMRX 1140",
+]
+
+
+def legacy_split(chunks):
+    """Replicate the str buffer assembly used before the framer."""
+    count = 0
+    for chunk in chunks:
+        buffer = ""
+        buffer += chunk.decode()
+        for message in buffer.split(";"):
+            if message != "":
+                count += 1
+    return count
+
+
+def framer_split(chunks):
+    """Assemble the same chunks with the DatagramFramer."""
+    framer = DatagramFramer()
+    count = 0
+    for chunk in chunks:
+        for message in framer.feed(chunk):
+            if message != "":
+                count += 1
+    return count
+
+
+class LegacyAVR(AVR):
+    """AVR using the data_received/_assemble_buffer pair replaced by the framer."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.buffer = ""
+
+    def data_received(self, data):
+        self.buffer += data.decode()
+        self.log.debug("Received %d bytes from AVR: %s", len(self.buffer), self.buffer)
+        self._loop.create_task(self._assemble_buffer())
+
+    async def _assemble_buffer(self):
+        self.transport.pause_reading()
+        for message in self.buffer.split(";"):
+            if message != "":
+                self.log.debug("assembled message %s", message)
+                await self._parse_message(message)
+        self.buffer = ""
+        self.transport.resume_reading()
+
+
+def protocol_split(protocol_class):
+    """Return a runner feeding chunks through data_received of protocol_class."""
+
+    def runner(chunks):
+        count = 0
+
+        async def parse(message):
+            nonlocal count
+            count += 1
+
+        async def feed():
+            avr = protocol_class(loop=asyncio.get_running_loop())
+            avr.transport = MagicMock()
+            avr._parse_message = parse
+            for chunk in chunks:
+                avr.data_received(chunk)
+                await asyncio.sleep(0)
+            while len(asyncio.all_tasks()) > 1:
+                await asyncio.sleep(0)
+
+        asyncio.run(feed())
+        return count
+
+    return runner
+
+
+def make_chunks(frames: int, chunk_size: int, aligned: bool):
+    """Build the byte stream, optionally cut on datagram boundaries."""
+    messages = [SAMPLE[i % len(SAMPLE)].encode() + b";" for i in range(frames)]
+    if aligned:
+        chunks, current = [], b""
+        for message in messages:
+            if current and len(current) + len(message) > chunk_size:
+                chunks.append(current)
+                current = b""
+            current += message
+        return chunks + [current]
+    stream = b"".join(messages)
+    return [stream[i : i + chunk_size] for i in range(0, len(stream), chunk_size)]
+
+
+def run(name, func, chunks, frames, prefix=""):
+    """Time one implementation and print its throughput."""
+    start = time.perf_counter()
+    try:
+        count = func(chunks)
+    except UnicodeDecodeError:
+        print(f"  {prefix}{name:8} failed to decode a split multibyte character")
+        return
+    elapsed = time.perf_counter() - start
+    nbytes = sum(len(c) for c in chunks)
+    print(
+        f"  {prefix}{name:8} {frames / elapsed:12,.0f} msg/s {nbytes / elapsed / 1e6:8.1f} MB/s"
+        f"  {count}/{frames} datagrams"
+    )
+
+
+def main():
+    """Run the comparison for a few chunk sizes."""
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument("--frames", type=int, default=100000)
+    args = parser.parse_args()
+
+    for chunk_size in (64, 512, 4096):
+        for aligned in (True, False):
+            chunks = make_chunks(args.frames, chunk_size, aligned)
+            label = "aligned" if aligned else "split"
+            print(f"chunk size {chunk_size} ({label})")
+            run("legacy", legacy_split, chunks, args.frames)
+            run("framer", framer_split, chunks, args.frames)
+            run("legacy", protocol_split(LegacyAVR), chunks, args.frames, "avr ")
+            run("framer", protocol_split(AVR), chunks, args.frames, "avr ")
+
+
+if __name__ == "__main__":
+    main()
@@ -33,6 +33,9 @@ setup(
     entry_points={
         "console_scripts": [
             "anthemav_monitor = anthemav.tools:monitor",
+            "anthemav_emulator = anthemav.tools:emulator",
+            "anthemav_benchmark = anthemav.benchmark:main",
+            "anthemav_replay = anthemav.tools:replay",
         ]
     },
 )
@@ -0,0 +1,47 @@
+"""Run the benchmark suite in quick mode."""
+import copy
+import json
+
+import pytest
+
+from anthemav.benchmark import compare_results, run_benchmarks
+
+
+@pytest.mark.asyncio
+async def test_quick_benchmarks(tmp_path):
+    results = await run_benchmarks(quick=True)
+    benchmarks = {result["benchmark"] for result in results["results"]}
+    assert benchmarks == {"connect", "refresh", "parse", "fleet_start", "fleet_query"}
+    for result in results["results"]:
+        if result["unit"] == "msg/s":
+            assert result["value"] > 0
+        else:
+            assert 0 < result["min"] <= result["median"] <= result["max"]
+
+    output = tmp_path / "results.json"
+    output.write_text(json.dumps(results))
+    assert json.loads(output.read_text())["results"] == results["results"]
+
+
+def test_compare_results():
+    baseline = {
+        "results": [
+            {
+                "benchmark": "connect",
+                "params": {"model": "MRX 740"},
+                "unit": "ms",
+                "median": 10.0,
+            },
+            {
+                "benchmark": "parse",
+                "params": {"chunk_size": 64},
+                "unit": "msg/s",
+                "value": 1000.0,
+            },
+        ]
+    }
+    current = copy.deepcopy(baseline)
+    assert compare_results(baseline, current, 0.2) == []
+    current["results"][0]["median"] = 15.0
+    current["results"][1]["value"] = 700.0
+    assert len(compare_results(baseline, current, 0.2)) == 2
@@ -0,0 +1,144 @@
+"""Test for the warm-start state cache."""
+import asyncio
+import threading
+from unittest.mock import MagicMock
+
+import pytest
+
+from anthemav import AVR, Connection, StateCache
+from anthemav.emulator import DeviceEmulator
+from anthemav.protocol import MODEL_X40
+
+
+async def _wait_for_inputs(avr: AVR, count: int):
+    while len(avr.input_list) < count:
+        await asyncio.sleep(0.01)
+
+
+@pytest.mark.asyncio
+async def test_warm_start(tmp_path):
+    """Restore the state of the device before it answers."""
+    path = str(tmp_path / "state.json")
+    async with DeviceEmulator(power=True) as device:
+        cache = StateCache(path)
+        conn = await Connection.create(port=device.port, cache=cache)
+        await asyncio.wait_for(_wait_for_inputs(conn.protocol, 12), 5)
+        conn.close()
+        await cache.flush()
+
+        cache = StateCache(path)
+        assert cache.lookup(f"localhost:{device.port}")["model_series"] == MODEL_X40
+        conn = await Connection.create(
+            port=device.port, cache=cache, auto_reconnect=False
+        )
+        avr = conn.protocol
+        await avr.wait_for_device_initialised(0.01)
+        assert avr.model == "MRX 740"
+        assert avr.input_list[0] == "Blu-ray"
+        assert len(avr.zones) == 2
+
+        device.history.clear()
+        await conn.reconnect()
+        await asyncio.sleep(0.1)
+        assert avr._restored is False
+        assert "EMAC?" in device.history
+        conn.close()
+
+
+@pytest.mark.asyncio
+async def test_saves_collected(tmp_path, monkeypatch):
+    """Write the file once for the saves requested together, in a thread."""
+    cache = StateCache(str(tmp_path / "state.json"))
+    writes = []
+    write = cache._write
+    monkeypatch.setattr(
+        cache,
+        "_write",
+        lambda text: writes.append(threading.get_ident()) or write(text),
+    )
+    loop = asyncio.get_running_loop()
+    for _ in range(10):
+        cache.save_soon(loop, 0.01)
+    await asyncio.sleep(0.05)
+    assert len(writes) == 1
+    assert writes[0] != threading.get_ident()
+    cache.save_soon(loop)
+    cache.save_soon(loop, 0)
+    await cache.flush()
+    assert len(writes) == 2
+    assert StateCache(cache.path).devices == {}
+
+
+def test_restored_model_replaced():
+    """Discard the restored inputs when another model answers."""
+    avr = AVR()
+    avr.transport = MagicMock()
+    avr.restore_state(
+        {"identity": {"IDM": "MRX 740"}, "zones": 2, "inputs": {"1": "Blu-ray"}}
+    )
+    assert avr.input_list == ["Blu-ray"]
+    avr._loop = MagicMock()
+    asyncio.run(avr._parse_message("IDMMRX 520"))
+    assert avr.input_list == []
+    assert avr._model_series != MODEL_X40
+
+
+@pytest.mark.asyncio
+async def test_learn_unsupported_commands():
+    avr = AVR(loop=asyncio.get_running_loop())
+    avr.transport = MagicMock()
+    await avr._parse_message("!IZ1DYN?")
+    await avr._parse_message("!IZ1VOL-100")
+    assert avr._unsupported_commands == []
+    await avr._parse_message("!IZ1DYN?")
+    assert avr._unsupported_commands == ["Z1DYN"]
+    assert avr.export_state()["unsupported_commands"] == ["Z1DYN"]
+
+
+@pytest.mark.asyncio
+async def test_rejections_ignored_during_power_on():
+    avr = AVR(loop=asyncio.get_running_loop())
+    avr.transport = MagicMock()
+    await avr._parse_message("IDMMRX 740")
+    avr.power_on_device()
+    for _ in range(3):
+        await avr._parse_message("!IZ1DYN?")
+    assert avr._unsupported_commands == []
+    avr._poweron.cancel()
+
+
+def test_unsupported_commands_of_another_firmware():
+    """Restore the unsupported commands only for the firmware that rejected them."""
+    state = {
+        "identity": {"IDM": "MRX 740", "IDS": "1.0"},
+        "zones": 2,
+        "unsupported_commands": ["Z1DYN"],
+        "unsupported_firmware": "1.0",
+    }
+    avr = AVR()
+    avr.restore_state(state)
+    assert avr._unsupported_commands == ["Z1DYN"]
+    avr = AVR()
+    avr.restore_state({**state, "unsupported_firmware": "0.9"})
+    assert avr._unsupported_commands == []
+
+
+def test_restored_mac_replaced():
+    """Discard the restored inputs when the device has another MAC address."""
+    avr = AVR()
+    avr.transport = MagicMock()
+    avr.restore_state(
+        {
+            "identity": {"IDM": "MRX 740", "EMAC": "00:11:22:33:44:55"},
+            "zones": 2,
+            "inputs": {"1": "Blu-ray"},
+            "unsupported_commands": ["Z1DYN"],
+        }
+    )
+    avr._loop = MagicMock()
+    asyncio.run(avr._parse_message("IDMMRX 740"))
+    assert avr.input_list == ["Blu-ray"]
+    asyncio.run(avr._parse_message("EMAC00:11:22:33:44:66"))
+    assert avr.input_list == []
+    assert avr._unsupported_commands == []
+    assert avr.macaddress == "00:11:22:33:44:66"
@@ -0,0 +1,65 @@
+"""Test for the continuous controls coalescer."""
+import asyncio
+from unittest.mock import MagicMock
+
+import pytest
+
+from anthemav import AVR
+from anthemav.protocol import MODEL_X40
+
+
+def create_avr(loop, interval=0.05):
+    avr = AVR(loop=loop)
+    avr.transport = MagicMock()
+    avr._model_series = MODEL_X40
+    avr.set_coalescing(interval)
+    return avr
+
+
+@pytest.mark.asyncio
+async def test_burst_keeps_latest_value():
+    """Send the first value immediately and only the latest after the interval."""
+    avr = create_avr(asyncio.get_running_loop())
+    for value in range(20, 40):
+        avr.zones[1].volume = value
+    avr.transport.write.assert_called_once_with(b"Z1PVOL20;")
+    await asyncio.sleep(0.1)
+    assert avr.transport.write.call_count == 2
+    avr.transport.write.assert_called_with(b"Z1PVOL39;")
+    assert avr._coalescer.coalesced == 18
+
+
+@pytest.mark.asyncio
+async def test_toggle_not_delayed():
+    """Send mute immediately while a volume change is waiting."""
+    avr = create_avr(asyncio.get_running_loop())
+    avr.zones[1].volume = 20
+    avr.zones[1].volume = 30
+    avr.zones[1].mute = True
+    avr.transport.write.assert_any_call(b"Z1MUT1;")
+    assert b"Z1PVOL30;" not in [c.args[0] for c in avr.transport.write.mock_calls]
+
+
+@pytest.mark.asyncio
+async def test_final_value_confirmed():
+    """Resolve every caller once the device reports the final value."""
+    loop = asyncio.get_running_loop()
+    avr = create_avr(loop)
+    first = loop.create_task(avr.zones[1].async_set_volume(20, timeout=1))
+    last = loop.create_task(avr.zones[1].async_set_volume(30, timeout=1))
+    await asyncio.sleep(0)
+    avr.data_received(b"Z1PVOL20;")
+    await asyncio.sleep(0.1)
+    assert not first.done()
+    avr.data_received(b"Z1PVOL30;")
+    await asyncio.wait_for(asyncio.gather(first, last), 1)
+    assert avr.zones[1].volume == 30
+
+
+@pytest.mark.asyncio
+async def test_timed_out_caller_forgotten():
+    loop = asyncio.get_running_loop()
+    avr = create_avr(loop)
+    with pytest.raises(asyncio.TimeoutError):
+        await avr.zones[1].async_set_volume(20, timeout=0.01)
+    assert avr._coalescer._waiters == {}
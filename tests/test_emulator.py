@@ -0,0 +1,131 @@
+"""Test the library against the device emulator."""
+import asyncio
+import time
+
+import pytest
+
+from anthemav import CommandError, Connection
+from anthemav.emulator import DeviceEmulator
+
+
+async def wait_until(condition, timeout=3):
+    """Poll a condition until it is true."""
+
+    async def poll():
+        while not condition():
+            await asyncio.sleep(0.01)
+
+    await asyncio.wait_for(poll(), timeout)
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize(
+    "model,zones,mac_query",
+    [("MRX 720", 2, "IDN?"), ("MRX 1140", 2, "EMAC?"), ("MDX-16", 8, "MAC?")],
+)
+async def test_initialise(model: str, zones: int, mac_query: str):
+    async with DeviceEmulator(model=model) as device:
+        conn = await Connection.create(port=device.port)
+        await conn.protocol.wait_for_device_initialised(1)
+        assert conn.protocol.model == model
+        assert conn.protocol.macaddress == "00:11:22:33:44:55"
+        assert len(conn.protocol.zones) == zones
+        assert mac_query in device.history
+        conn.close()
+
+
+@pytest.mark.asyncio
+async def test_power_on_populates_inputs():
+    async with DeviceEmulator(model="MRX 740", inputs=["Blu-ray", "TV"]) as device:
+        conn = await Connection.create(port=device.port)
+        avr = conn.protocol
+        await avr.wait_for_device_initialised(1)
+        assert await avr.zones[1].async_set_power(True, timeout=1) is True
+        await wait_until(lambda: avr.input_list == ["Blu-ray", "TV"])
+        assert avr.zones[1].volume == 56
+        assert avr.audio_input_name == "Dolby Digital"
+        conn.close()
+
+
+@pytest.mark.asyncio
+async def test_input_rejected_while_booting_retried():
+    """An input item rejected during the power on refresh is queried again."""
+    async with DeviceEmulator(model="MRX 740", inputs=["Blu-ray", "TV"]) as device:
+        del device.state["IS2ARC"]
+        conn = await Connection.create(port=device.port)
+        avr = conn.protocol
+        avr._poweron.retry_interval = 0.1
+        await avr.wait_for_device_initialised(1)
+        assert await avr.zones[1].async_set_power(True, timeout=1) is True
+        await wait_until(lambda: "IS2ARC?" in device.history)
+        await asyncio.sleep(0.05)
+        assert "IS2ARC" not in avr._unsupported_commands
+        assert not avr._poweron_refresh_successful
+        device.state["IS2ARC"] = "1"
+        await wait_until(lambda: avr._poweron_refresh_successful)
+        assert avr.input_list == ["Blu-ray", "TV"]
+        conn.close()
+
+
+@pytest.mark.asyncio
+async def test_zone_refresh_doesnt_delay_answers():
+    """Parse the answer of a command while zones powered on are refreshed."""
+    async with DeviceEmulator(model="MDX-16", latency=0.03) as device:
+        conn = await Connection.create(port=device.port)
+        avr = conn.protocol
+        await avr.wait_for_device_initialised(1)
+        device.push("Z1POW1")
+        await wait_until(lambda: avr.zones[1].power)
+        await wait_until(lambda: not avr._scheduler.draining)
+        for zone in range(2, 9):
+            device.push(f"Z{zone}POW1")
+        await wait_until(lambda: avr._scheduler.draining)
+        start = time.perf_counter()
+        assert await avr.zones[1].async_set_mute(True, timeout=3) is True
+        # each zone refresh takes the device 5 * 30 ms to answer
+        assert time.perf_counter() - start < 0.5
+        conn.close()
+
+
+@pytest.mark.asyncio
+async def test_commands_and_events():
+    async with DeviceEmulator(model="MRX 740", power=True) as device:
+        conn = await Connection.create(port=device.port)
+        avr = conn.protocol
+        await avr.wait_for_device_initialised(1)
+        await avr.zones[2].async_set_volume(30, timeout=1)
+        assert device.state["Z2PVOL"] == "30"
+        assert await avr.zones[2].async_set_mute(True, timeout=1) is True
+        with pytest.raises(CommandError):
+            await avr.async_command("Z1PVOL150", timeout=1)
+        device.push("Z1INP2")
+        await wait_until(lambda: avr.zones[1].input_number == 2)
+        conn.close()
+
+
+@pytest.mark.asyncio
+async def test_zone_powered_off():
+    async with DeviceEmulator(model="MDX-8") as device:
+        conn = await Connection.create(port=device.port)
+        await conn.protocol.wait_for_device_initialised(1)
+        with pytest.raises(CommandError):
+            await conn.protocol.zones[3].async_query("VOL", timeout=1)
+        conn.close()
+
+
+@pytest.mark.asyncio
+async def test_heartbeat_drops_dead_connection():
+    """Reconnect when the device stops answering without closing the socket."""
+    async with DeviceEmulator(model="MRX 740") as device:
+        conn = await Connection.create(
+            port=device.port,
+            heartbeat_interval=0.05,
+            heartbeat_timeout=0.05,
+            keepalive=True,
+        )
+        avr = conn.protocol
+        metrics = avr.enable_metrics()
+        await avr.wait_for_device_initialised(1)
+        device.latency = 10
+        await wait_until(lambda: metrics.connections == 2)
+        conn.close()
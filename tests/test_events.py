@@ -0,0 +1,164 @@
+"""Test for the structured change events."""
+import asyncio
+from unittest.mock import MagicMock
+
+import pytest
+
+from anthemav import AVR, StateChange
+
+
+def create_avr(loop):
+    avr = AVR(loop=loop)
+    avr.transport = MagicMock()
+    return avr
+
+
+@pytest.mark.asyncio
+async def test_changes_batched_per_chunk():
+    """Deliver every change of a chunk in a single call."""
+    avr = create_avr(asyncio.get_running_loop())
+    batches = []
+    avr.subscribe(batches.append)
+    avr.data_received(b"Z1VOL-40;Z1MUT0;Z1VOL-40;IS3INBlu-ray;")
+    await avr._assemble_task
+    assert len(batches) == 1
+    changes = batches[0]
+    assert [(c.zone, c.key, c.old, c.new) for c in changes] == [
+        (1, "Z1VOL", None, "-40"),
+        (1, "Z1MUT", None, "0"),
+        (None, "IS3IN", None, "Blu-ray"),
+    ]
+    assert isinstance(changes[0], StateChange)
+
+    avr.data_received(b"Z1VOL-41;")
+    await avr._assemble_task
+    assert batches[1][0].old == "-40"
+
+
+@pytest.mark.asyncio
+async def test_changes_batched_per_interval():
+    avr = create_avr(asyncio.get_running_loop())
+    batches = []
+    unsubscribe = avr.subscribe(batches.append, interval=0.05)
+    for volume in range(40, 45):
+        avr.data_received(f"Z1VOL-{volume};".encode())
+        await avr._assemble_task
+    assert batches == []
+    await asyncio.sleep(0.1)
+    assert len(batches) == 1
+    assert len(batches[0]) == 5
+
+    unsubscribe()
+    avr.data_received(b"Z1VOL-30;")
+    await avr._assemble_task
+    await asyncio.sleep(0.1)
+    assert len(batches) == 1
+
+
+@pytest.mark.asyncio
+async def test_failing_subscriber_isolated():
+    avr = create_avr(asyncio.get_running_loop())
+    received = []
+    avr.subscribe(MagicMock(side_effect=ValueError))
+    avr.subscribe(received.extend)
+    avr.data_received(b"Z1MUT1;")
+    await avr._assemble_task
+    assert received[0].new == "1"
+
+
+async def _feed(avr, data: bytes):
+    avr.data_received(data)
+    await avr._assemble_task
+
+
+@pytest.mark.asyncio
+async def test_changes_filtered_by_zone_and_key():
+    avr = create_avr(asyncio.get_running_loop())
+    received = []
+
+    async def consume():
+        async with avr.changes(keys=["VOL"], zone=2) as changes:
+            async for change in changes:
+                received.append(change.new)
+                if len(received) == 2:
+                    break
+
+    avr.set_zones("MRX 740")
+    task = asyncio.ensure_future(consume())
+    await asyncio.sleep(0)
+    await _feed(avr, b"Z2MUT1;Z1VOL-40;Z2VOL-30;")
+    await _feed(avr, b"Z2VOL-31;")
+    await asyncio.wait_for(task, 1)
+    assert received == ["-30", "-31"]
+    assert not avr._events
+
+
+@pytest.mark.asyncio
+async def test_changes_drop_oldest():
+    avr = create_avr(asyncio.get_running_loop())
+    changes = avr.changes(maxsize=2)
+    await _feed(avr, b"Z1VOL-40;Z1MUT1;Z1INP3;")
+    assert changes.dropped == 1
+    assert (await changes.__anext__()).key == "Z1MUT"
+    changes.close()
+    assert (await changes.__anext__()).key == "Z1INP"
+    with pytest.raises(StopAsyncIteration):
+        await changes.__anext__()
+
+
+@pytest.mark.asyncio
+async def test_changes_coalesce():
+    avr = create_avr(asyncio.get_running_loop())
+    changes = avr.changes(overflow="coalesce")
+    for volume in range(40, 50):
+        await _feed(avr, f"Z1VOL-{volume};".encode())
+    change = await changes.__anext__()
+    assert (change.old, change.new) == (None, "-49")
+    assert len(changes) == 0
+
+
+@pytest.mark.asyncio
+async def test_changes_block_pauses_reading():
+    """Pause reading while a blocking consumer is full, others keep receiving."""
+    avr = create_avr(asyncio.get_running_loop())
+    blocking = avr.changes(maxsize=2, overflow="block")
+    other = avr.changes(maxsize=1)
+    await _feed(avr, b"Z1VOL-40;Z1VOL-41;Z1VOL-42;")
+    avr.transport.pause_reading.assert_called_once()
+    assert len(blocking) == 3
+    assert (await other.__anext__()).new == "-42"
+    await blocking.__anext__()
+    await blocking.__anext__()
+    avr.transport.resume_reading.assert_called_once()
+
+
+def test_changes_invalid_policy():
+    with pytest.raises(ValueError):
+        AVR().changes(overflow="wait")
+
+
+@pytest.mark.asyncio
+async def test_on_change_routed_by_key():
+    avr = create_avr(asyncio.get_running_loop())
+    volumes, inputs = [], []
+    avr.zones[1].on_change("VOL", volumes.append)
+    unsubscribe = avr.on_change("Z1INP", inputs.append)
+    await _feed(avr, b"Z1VOL-40;Z1MUT1;Z1VOL-41;")
+    assert [c.new for c in volumes] == ["-40", "-41"]
+    assert inputs == []
+
+    unsubscribe()
+    assert "Z1INP" not in avr._events._by_key
+    await _feed(avr, b"Z1INP3;")
+    assert inputs == []
+
+
+@pytest.mark.asyncio
+async def test_changes_for_keys_use_index():
+    avr = create_avr(asyncio.get_running_loop())
+    changes = avr.changes(keys=["Z1MUT"])
+    assert not avr._events._subscribers
+    await _feed(avr, b"Z1VOL-40;Z1MUT1;")
+    assert (await changes.__anext__()).key == "Z1MUT"
+    changes.close()
+    assert not avr._events
@@ -0,0 +1,54 @@
+"""Test for the Prometheus exporter."""
+import asyncio
+
+import pytest
+
+from anthemav import Connection
+from anthemav.emulator import DeviceEmulator
+from anthemav.exporter import MetricsExporter, render_metrics
+
+
+@pytest.mark.asyncio
+async def test_render_connections():
+    """Render one sample per device and HELP/TYPE once per family."""
+    async with DeviceEmulator() as device:
+        first = await Connection.create(port=device.port)
+        second = await Connection.create(port=device.port, auto_reconnect=False)
+        first.protocol.enable_metrics()
+        await first.protocol.async_query("Z1POW")
+        text = await render_metrics({"living": first, "bedroom": second})
+        first.close()
+
+    assert text.count("# TYPE anthemav_connection_state gauge") == 1
+    assert 'anthemav_connection_state{device="living",state="connected"} 1' in text
+    assert 'anthemav_connection_state{device="bedroom",state="disconnected"} 1' in text
+    assert 'anthemav_reconnect_interval_seconds{device="living"} 0' in text
+    assert (
+        'anthemav_command_round_trip_seconds_bucket{device="living",item="Z1POW",le="+Inf"} 1'
+        in text
+    )
+    assert 'anthemav_frames_sent_total{device="bedroom"}' not in text
+    assert 'anthemav_pending_requests{device="living"} 0' in text
+    assert 'anthemav_write_paused{device="living"} 0' in text
+    assert 'anthemav_queued_commands{device="living",priority="interactive"} 0' in text
+
+
+@pytest.mark.asyncio
+async def test_http_endpoint():
+    async with DeviceEmulator() as device:
+        conn = await Connection.create(port=device.port)
+        async with MetricsExporter({"avr": conn}, host="127.0.0.1", port=0) as exporter:
+            reader, writer = await asyncio.open_connection("127.0.0.1", exporter.port)
+            writer.write(b"GET /metrics HTTP/1.1\r\nHost: localhost\r\n\r\n")
+            response = await reader.read()
+            writer.close()
+
+            reader, writer = await asyncio.open_connection("127.0.0.1", exporter.port)
+            writer.write(b"GET / HTTP/1.1\r\n\r\n")
+            missing = await reader.read()
+            writer.close()
+        conn.close()
+
+    assert response.startswith(b"HTTP/1.1 200 OK\r\n")
+    assert b'anthemav_device_info{device="avr"' in response
+    assert missing.startswith(b"HTTP/1.1 404")
@@ -0,0 +1,89 @@
+"""Test for the manager of many devices."""
+import asyncio
+import socket
+
+import pytest
+
+from anthemav import AVRFleet, CommandError, StateChange
+from anthemav.emulator import DeviceEmulator
+
+from .test_emulator import wait_until
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+@pytest.mark.asyncio
+async def test_fleet_fan_out():
+    async with DeviceEmulator(model="MRX 740", power=True) as living, DeviceEmulator(
+        model="MDX-8"
+    ) as office:
+        fleet = AVRFleet(concurrency=1)
+        fleet.add("living", "127.0.0.1", living.port)
+        fleet.add("office", "127.0.0.1", office.port)
+        assert await fleet.start(timeout=5) == []
+        assert fleet.summary() == {"connected": 2}
+        status = fleet.status()
+        assert status["office"]["model"] == "MDX-8"
+        assert status["living"]["power"][1] is True
+
+        assert await fleet.query("Z1POW") == {"living": "1", "office": "0"}
+        results = await fleet.command("Z1PVOL150", timeout=1, names=["living"])
+        assert isinstance(results["living"], CommandError)
+
+        received = []
+        unsubscribe = fleet.subscribe(lambda name, changes: received.append(name))
+        async with fleet.changes() as changes:
+            office.push("Z2MUT1")
+            device, change = await asyncio.wait_for(changes.__anext__(), 1)
+        assert device == "office"
+        assert change.key == "Z2MUT"
+        assert received == ["office"]
+        unsubscribe()
+        fleet.close()
+
+
+@pytest.mark.asyncio
+async def test_fleet_unreachable_device():
+    """A device that doesn't answer doesn't hold the others back."""
+    async with DeviceEmulator(model="MRX 520") as device:
+        fleet = AVRFleet()
+        fleet.add("up", "127.0.0.1", device.port)
+        fleet.add("down", "127.0.0.1", free_port())
+        assert await fleet.start(timeout=0.5) == ["down"]
+        assert fleet.states() == {"up": "connected", "down": "connecting"}
+        results = await fleet.query("Z1POW")
+        assert results["up"] == "0"
+        assert isinstance(results["down"], ConnectionError)
+        fleet.remove("down")
+        assert len(fleet) == 1
+        fleet.close()
+        await wait_until(lambda: device.clients == 0)
+
+
+@pytest.mark.asyncio
+async def test_fleet_change_stream():
+    """Filter and coalesce the changes of each device separately."""
+    fleet = AVRFleet()
+    with pytest.raises(ValueError):
+        fleet.changes(overflow="block")
+    changes = fleet.changes(keys=["VOL"], zone=1, maxsize=2, overflow="coalesce")
+    fleet._dispatch("living", [StateChange(1, "Z1VOL", "-40", "-35", 0)])
+    fleet._dispatch("office", [StateChange(1, "Z1VOL", "-50", "-45", 0)])
+    fleet._dispatch(
+        "living",
+        [
+            StateChange(1, "Z1VOL", "-35", "-30", 1),
+            StateChange(1, "Z1MUT", "0", "1", 1),
+        ],
+    )
+    assert len(changes) == 2
+    device, change = await changes.__anext__()
+    assert device == "living"
+    assert (change.old, change.new) == ("-40", "-30")
+    changes.close()
+    assert [device async for device, _ in changes] == ["office"]
+    assert fleet._streams == []
@@ -0,0 +1,55 @@
+"""Test for datagram framer."""
+from anthemav.framer import DatagramFramer
+
+
+def test_complete_datagrams():
+    """Split a chunk holding several datagrams."""
+    framer = DatagramFramer()
+    assert framer.feed(b"Z1POW1;Z1VOL-42;") == ["Z1POW1", "Z1VOL-42"]
+    assert framer.pending == 0
+
+
+def test_partial_datagram_kept():
+    """Keep the start of a datagram until its delimiter arrives."""
+    framer = DatagramFramer()
+    assert framer.feed(b"Z1POW1;Z1V") == ["Z1POW1"]
+    assert framer.feed(b"OL-4") == []
+    assert framer.feed(b"2;Z1MUT0;") == ["Z1VOL-42", "Z1MUT0"]
+
+
+def test_split_multibyte_character():
+    """Decode a character whose bytes arrive in two chunks."""
+    framer = DatagramFramer()
+    data = "IS1INZoé;".encode()
+    assert framer.feed(data[:8]) == []
+    assert framer.feed(data[8:]) == ["IS1INZoé"]
+
+
+def test_bare_delimiter():
+    """Return an empty datagram for a bare acknowledgement."""
+    framer = DatagramFramer()
+    assert framer.feed(b";") == [""]
+    assert framer.feed(b"Z1MUT1;;") == ["Z1MUT1", ""]
+
+
+def test_oversized_datagram_dropped():
+    """Drop a datagram larger than the limit and resync on the next delimiter."""
+    framer = DatagramFramer(max_frame_size=8)
+    assert framer.feed(b"Z1POW1;IS1INVery") == ["Z1POW1"]
+    assert framer.feed(b" long name") == []
+    assert framer.feed(b" indeed;Z1MUT0;") == ["Z1MUT0"]
+    assert framer.discarded_frames == 1
+    assert framer.pending == 0
+
+
+def test_oversized_complete_datagram_dropped():
+    """Drop a datagram larger than the limit that arrives with its delimiter."""
+    framer = DatagramFramer(max_frame_size=8)
+    assert framer.feed(b"Z1POW1;IS1INVery long;Z1MUT0;") == ["Z1POW1", "Z1MUT0"]
+    assert framer.feed(b"IS1IN") == []
+    assert framer.feed(b"Long name;Z1MUT1;") == ["Z1MUT1"]
+    assert framer.discarded_frames == 2
+    # the limit is in bytes, not characters
+    data = "IS1Télé;IS2Éé;".encode()
+    assert framer.feed(data) == ["IS2Éé"]
+    assert framer.discarded_frames == 3
@@ -0,0 +1,92 @@
+"""Test for the protocol instrumentation."""
+import asyncio
+from unittest.mock import MagicMock
+
+import pytest
+
+from anthemav import AVR, Connection
+from anthemav.emulator import DeviceEmulator
+from anthemav.metrics import Histogram
+
+
+def test_histogram_cumulative_buckets():
+    histogram = Histogram(buckets=(0.1, 1.0, float("inf")))
+    for value in (0.05, 0.5, 0.5, 3):
+        histogram.observe(value)
+    snapshot = histogram.snapshot()
+    assert snapshot["buckets"] == {0.1: 1, 1.0: 3, float("inf"): 4}
+    assert snapshot["count"] == 4
+    assert snapshot["sum"] == pytest.approx(4.05)
+
+
+def test_metrics_disabled_by_default():
+    avr = AVR()
+    avr.transport = MagicMock()
+    avr.command("Z1VOL-40")
+    assert avr.metrics is None
+
+
+@pytest.mark.asyncio
+async def test_round_trip_and_counters():
+    """Measure the command until the device reports the same item."""
+    avr = AVR(loop=asyncio.get_running_loop())
+    avr.transport = MagicMock()
+    metrics = avr.enable_metrics()
+    avr.query("Z1VOL")
+    avr.data_received(b"Z1VOL-40;!IZ1FOO;")
+    await avr._assemble_task
+    snapshot = metrics.snapshot()
+    assert snapshot["frames_out"] == 1
+    assert snapshot["bytes_out"] == len(b"Z1VOL?;")
+    assert snapshot["frames_in"] == 2
+    assert snapshot["bytes_in"] == len(b"Z1VOL-40;!IZ1FOO;")
+    assert snapshot["error_frames"] == {"!I": 1}
+    assert snapshot["round_trip"]["Z1VOL"]["count"] == 1
+    assert snapshot["parse_duration"]["count"] == 2
+    assert snapshot["in_flight"] == 0
+
+
+@pytest.mark.asyncio
+async def test_callback_duration():
+    avr = AVR(loop=asyncio.get_running_loop(), update_callback=MagicMock())
+    avr.enable_metrics()
+    await avr._parse_message("Z1VOL-40")
+    await asyncio.sleep(0)
+    avr._update_callback.assert_called_once_with("Z1VOL-40")
+    assert avr.metrics.callback_duration.count == 1
+
+
+@pytest.mark.asyncio
+async def test_connection_metrics():
+    """Count connections and time until the device is initialised."""
+    async with DeviceEmulator() as device:
+        conn = await Connection.create(port=device.port, auto_reconnect=False)
+        metrics = conn.protocol.enable_metrics()
+        await conn.reconnect()
+        await conn.protocol.wait_for_device_initialised(5)
+        snapshot = metrics.snapshot()
+        assert snapshot["reconnect_attempts"] == 1
+        assert snapshot["connections"] == 1
+        assert snapshot["time_to_initialised"] > 0
+        conn.close()
+
+
+@pytest.mark.asyncio
+async def test_round_trip_closed_on_error_and_timeout():
+    """Forget commands the device rejects or never answers."""
+    avr = AVR(loop=asyncio.get_running_loop())
+    avr.transport = MagicMock()
+    avr.set_command_window(timeout=0.05)
+    metrics = avr.enable_metrics()
+    avr.query("Z1FOO")
+    avr.data_received(b"!IZ1FOO;")
+    await avr._assemble_task
+    assert metrics.in_flight == 0
+    avr.query("Z1VOL")
+    await asyncio.sleep(0.1)
+    # the scheduler releases overdue commands when it sends the next one
+    avr.query("Z1MUT")
+    assert metrics.in_flight == 1
+    avr.data_received(b"Z1VOL-40;")
+    await avr._assemble_task
+    assert metrics.snapshot()["round_trip"] == {}
@@ -1,5 +1,5 @@
 """Test for parser."""
-from anthemav.parser import parse_message
+from anthemav.parser import PrefixIndex, parse_message, parse_x40_input_message
 
 
 def test_parse_x40_arc():
@@ -8,3 +8,46 @@ def test_parse_x40_arc():
     assert parsed_message.command == "IS2ARC"
     assert parsed_message.input_number == 2
     assert parsed_message.value == "1"
+
+
+def test_parse_x40_input_name():
+    """Parse x40 model input name with a two digits input number."""
+    parsed_message = parse_message("IS12INBlu-ray")
+    assert parsed_message.command == "IS12IN"
+    assert parsed_message.input_command == "IN"
+    assert parsed_message.input_number == 12
+    assert parsed_message.value == "Blu-ray"
+
+
+def test_parse_x40_input_message():
+    """Parse a specific x40 input command, kept for compatibility."""
+    parsed_message = parse_x40_input_message("IS3INTurntable", "IN")
+    assert parsed_message.command == "IS3IN"
+    assert parsed_message.value == "Turntable"
+    assert parse_x40_input_message("IS3INTurntable", "ARC") is None
+
+
+def test_parse_x20_input_name():
+    """Parse x20 and MDX model input name."""
+    parsed_message = parse_message("ISN04Turntable")
+    assert parsed_message.command == "ISN04"
+    assert parsed_message.input_command == "ISN"
+    assert parsed_message.input_number == 4
+    assert parsed_message.value == "Turntable"
+
+
+def test_parse_unknown_input_command():
+    """Ignore messages that aren't known input commands."""
+    assert parse_message("IS2XYZ1") is None
+    assert parse_message("IS2ARC") is None
+    assert parse_message("Z1POW1") is None
+
+
+def test_prefix_index_longest_match():
+    """Prefer the longest command when one command is a prefix of another."""
+    index = PrefixIndex(["VOL", "PVOL", "IDM", "IDMX"])
+    assert index.match("PVOL51") == "PVOL"
+    assert index.match("VOL-40") == "VOL"
+    assert index.match("IDMX1") == "IDMX"
+    assert index.match("IDMMRX 740") == "IDM"
+    assert index.match("ZZZ") is None
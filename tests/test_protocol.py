@@ -1,7 +1,8 @@
+import asyncio
 import pytest
-from anthemav.protocol import LOOKUP, MODEL_X20, ALM_NUMBER_x20
-from anthemav import AVR
-from unittest.mock import call, patch
+from anthemav.protocol import LOOKUP, MODEL_X20, MODEL_X40, ALM_NUMBER_x20
+from anthemav import AVR, CommandError
+from unittest.mock import MagicMock, call, patch
 
 
 @pytest.mark.asyncio
@@ -154,16 +155,18 @@ class TestProtocol:
             assert avr.zones[2].volume == 51
 
     async def test_zone2_power(self):
-        avr = AVR()
+        avr = AVR(loop=asyncio.get_running_loop())
         with patch.object(avr, "refresh_zone") as refreshmock, patch.object(
-            avr, "_loop"
+            avr, "query"
         ):
             await avr._parse_message("IDMMRX 740")
             assert avr.zones[2].power is False
             await avr._parse_message("Z2POW1")
+            await asyncio.sleep(0)
             refreshmock.assert_called_with(2)
             assert avr.zones[2].power is True
             assert avr._device_power is True
+            avr._poweron.cancel()
 
     async def test_attenuation(self):
         avr = AVR()
@@ -240,12 +243,13 @@ class TestProtocol:
             assert call("Z2PVOL") not in mock.mock_calls
 
     async def test_device_power_off(self):
-        avr = AVR()
+        avr = AVR(loop=asyncio.get_running_loop())
         with patch.object(avr, "refresh_zone") as refreshmock, patch.object(
-            avr, "_loop"
+            avr, "query"
         ):
             await avr._parse_message("IDMMRX 740")
             await avr._parse_message("Z2POW1")
+            await asyncio.sleep(0)
             refreshmock.assert_called_with(2)
             assert avr._device_power is True
             await avr._parse_message("Z1POW1")
@@ -302,3 +306,150 @@ class TestProtocol:
             avr.set_zones(model)
             assert avr.zones[1].support_attenuation == expected
             assert avr.zones[2].support_attenuation == expected
+
+    async def test_datagram_split_across_chunks(self):
+        avr = AVR(loop=asyncio.get_running_loop())
+        avr.transport = MagicMock()
+        with patch.object(avr, "query"):
+            avr.data_received(b"IDMMRX 740;Z2PV")
+            avr.data_received(b"OL51;")
+            await avr._assemble_task
+            assert avr.model == "MRX 740"
+            assert avr.zones[2].volume == 51
+
+    async def test_unregistered_zone_ignored(self):
+        avr = AVR()
+        with patch.object(avr, "query"):
+            await avr._parse_message("IDMMRX 740")
+            assert await avr.parse_zone_command("Z9POW1") is False
+            assert 9 not in avr.zones
+
+    async def test_query_commands_batched(self):
+        avr = AVR(loop=asyncio.get_running_loop())
+        avr.transport = MagicMock()
+        with patch.object(avr, "query"):
+            await avr._parse_message("IDMMRX 740")
+        avr.set_command_window(timeout=0.01)
+        await avr.refresh_zone(2)
+        avr.transport.writelines.assert_called_once_with(
+            [b"Z2POW?;", b"Z2VOL?;", b"Z2INP?;", b"Z2MUT?;", b"Z2PVOL?;"]
+        )
+
+    async def test_refresh_paced_by_responses(self):
+        loop = asyncio.get_running_loop()
+        avr = AVR(loop=loop)
+        avr.transport = MagicMock()
+        avr.set_model_command("MRX 520")
+        avr.transport.reset_mock()
+        avr._scheduler.reset()
+
+        def answer(batch):
+            loop.call_soon(avr.data_received, b"".join(b"!I" + q for q in batch))
+
+        avr.transport.writelines.side_effect = answer
+        avr.transport.write.side_effect = lambda query: answer([query])
+        avr.set_command_window(timeout=5)
+        await asyncio.wait_for(avr.refresh_all(), 1)
+        sent = [
+            q
+            for c in avr.transport.mock_calls
+            if c[0] in ("write", "writelines")
+            for q in (c.args[0] if c[0] == "writelines" else [c.args[0]])
+            if q.endswith(b"?;")
+        ]
+        assert sent == [
+            f"{key}?;".encode() for key in LOOKUP if key not in avr._ignored_commands
+        ]
+        assert avr.transport.writelines.call_count > 1
+
+    async def test_refresh_stale_only(self):
+        avr = AVR(loop=MagicMock())
+        avr.transport = MagicMock()
+        await avr._parse_message("IDMMRX 520")
+        await avr._parse_message("Z1VIR14")
+        await avr._parse_message("Z1AIC4")
+        await avr._parse_message("Z2VOL-40")
+        avr._last_seen["Z1AIC"] -= 1000
+        with patch.object(avr, "query") as mock:
+            await avr.refresh_all(stale_only=True)
+            await avr.refresh_zone(2, stale_only=True)
+        queried = [c.args[0] for c in mock.mock_calls]
+        assert "IDS" in queried
+        assert "IDM" not in queried
+        assert "Z1VIR" not in queried
+        assert "Z2VOL" not in queried
+        assert "Z1AIC" in queried
+        assert "Z2POW" in queried
+        assert avr.attribute_age("Z1VIR") < 1
+
+    async def test_attributes_expire_on_reconnect(self):
+        avr = AVR(loop=MagicMock())
+        avr.transport = MagicMock()
+        avr.transport.get_write_buffer_limits.return_value = (0, 0)
+        await avr._parse_message("IDMMRX 520")
+        await avr._parse_message("Z1VIR14")
+        with patch.object(avr, "refresh_core"), patch(
+            "anthemav.protocol.asyncio.run_coroutine_threadsafe"
+        ):
+            avr.connection_made(avr.transport)
+        assert avr.attribute_age("Z1VIR") is None
+        assert avr.attribute_age("IDM") is not None
+
+    async def test_async_query(self):
+        loop = asyncio.get_running_loop()
+        avr = AVR(loop=loop)
+        avr.transport = MagicMock()
+        loop.call_soon(avr.data_received, b"Z1MUT0;Z1VOL-40;")
+        assert await avr.async_query("Z1VOL", timeout=1) == "-40"
+        avr.transport.write.assert_called_once_with(b"Z1VOL?;")
+        assert avr._pending == {}
+
+    async def test_async_command_rejected(self):
+        loop = asyncio.get_running_loop()
+        avr = AVR(loop=loop)
+        avr.transport = MagicMock()
+        loop.call_soon(avr.data_received, b"!RZ1VOL5;")
+        with pytest.raises(CommandError):
+            await avr.zones[1].async_set_attenuation(-85, timeout=1)
+
+    async def test_async_query_timeout(self):
+        avr = AVR(loop=asyncio.get_running_loop())
+        avr.transport = MagicMock()
+        with pytest.raises(asyncio.TimeoutError):
+            await avr.async_query("Z1VOL", timeout=0.01)
+        assert avr._pending == {}
+
+    async def test_async_query_connection_lost(self):
+        loop = asyncio.get_running_loop()
+        avr = AVR(loop=loop)
+        avr.transport = MagicMock()
+        loop.call_soon(avr.connection_lost, None)
+        with pytest.raises(ConnectionError):
+            await avr.async_query("IDM", timeout=1)
+
+    async def test_async_set_volume_x40(self):
+        loop = asyncio.get_running_loop()
+        avr = AVR(loop=loop)
+        avr.transport = MagicMock()
+        avr._model_series = MODEL_X40
+        avr.set_zones("MRX 740")
+        loop.call_soon(avr.data_received, b"Z2PVOL53;")
+        await avr.zones[2].async_set_volume(53, timeout=1)
+        avr.transport.write.assert_called_once_with(b"Z2PVOL53;")
+        assert avr.zones[2].volume == 53
+
+    async def test_wait_until_idle(self):
+        avr = AVR(loop=asyncio.get_running_loop())
+        avr.transport = MagicMock()
+        await avr.wait_until_idle()
+        avr.data_received(b"Z1VOL-40;Z1MUT1;")
+        await avr.wait_until_idle()
+        assert avr.zones[1].mute is True
+        # the refresh of a zone powered on waits for the device in a task
+        avr.data_received(b"IDMMRX 520;Z1POW1;")
+        await asyncio.wait_for(avr.wait_until_idle(), 0.1)
+        assert avr.zones[1].power is True
+        await asyncio.sleep(0)
+        assert avr._scheduler.draining
+        avr.connection_lost(None)
+        assert not avr._scheduler.draining
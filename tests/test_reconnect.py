@@ -0,0 +1,70 @@
+"""Test for the reconnection policy."""
+import asyncio
+import random
+
+import pytest
+
+from anthemav import Connection, ReconnectPolicy
+from anthemav.emulator import DeviceEmulator
+
+
+def test_full_jitter_backoff():
+    policy = ReconnectPolicy(base=1, cap=10, factor=2, rng=random.Random(1))
+    assert policy.delay(1) == 0
+    assert [policy.backoff(failures) for failures in range(1, 7)] == [0, 1, 2, 4, 8, 10]
+    assert policy.backoff(10000) == 10
+    delays = [policy.delay(6) for _ in range(100)]
+    assert all(0 <= delay <= 10 for delay in delays)
+    assert len(set(delays)) == 100
+
+
+@pytest.mark.asyncio
+async def test_shared_concurrency_limit():
+    policy = ReconnectPolicy(concurrency=2)
+    active = []
+    peak = 0
+
+    async def connect():
+        nonlocal peak
+        async with policy.attempt():
+            active.append(None)
+            peak = max(peak, len(active))
+            await asyncio.sleep(0.01)
+            active.pop()
+
+    await asyncio.gather(*(connect() for _ in range(6)))
+    assert peak == 2
+
+
+def test_policy_created_outside_loop():
+    """Limit the attempts in any loop running after the policy is created."""
+    policy = ReconnectPolicy(concurrency=1)
+
+    async def connect():
+        async with policy.attempt():
+            await asyncio.sleep(0.01)
+
+    async def connect_many():
+        await asyncio.gather(*(connect() for _ in range(3)))
+
+    asyncio.run(connect_many())
+    asyncio.run(connect_many())
+
+
+@pytest.mark.asyncio
+async def test_resume_reconnects_immediately():
+    """A halted connection reconnects as soon as it's resumed."""
+    async with DeviceEmulator() as device:
+        conn = await Connection.create(port=device.port)
+        metrics = conn.protocol.enable_metrics()
+        conn.halt()
+        await asyncio.sleep(0.05)
+        assert conn.state == "halted"
+        conn.resume()
+        for _ in range(50):
+            if conn.state == "connected":
+                break
+            await asyncio.sleep(0.01)
+        assert conn.state == "connected"
+        assert metrics.connections == 2
+        conn.close()
@@ -0,0 +1,62 @@
+"""Test for the traffic recorder and replay."""
+import asyncio
+import io
+
+import pytest
+
+from anthemav import AVR, Connection
+from anthemav.emulator import DeviceEmulator
+from anthemav.recorder import (
+    RECEIVED,
+    SENT,
+    TrafficRecorder,
+    read_recording,
+    replay,
+)
+
+
+def test_round_trip(tmp_path):
+    """Any byte survives a compressed recording."""
+    path = str(tmp_path / "session.jsonl.gz")
+    recorder = TrafficRecorder(path, model="MRX 740")
+    recorder.sent(b"Z1VOL?;")
+    recorder.received(b"Z1VOL-40;IS1IN\xe9t\xe9\x00;")
+    recorder.close()
+
+    header, records = read_recording(path)
+    assert header["model"] == "MRX 740"
+    assert [(r.direction, r.data) for r in records] == [
+        (SENT, b"Z1VOL?;"),
+        (RECEIVED, b"Z1VOL-40;IS1IN\xe9t\xe9\x00;"),
+    ]
+    assert records[0].time <= records[1].time
+
+    with pytest.raises(ValueError):
+        read_recording(io.StringIO('{"format": "other"}\n'))
+
+
+@pytest.mark.asyncio
+async def test_replay_session():
+    """Replaying a session rebuilds the state of the device without it."""
+    recording = io.StringIO()
+    async with DeviceEmulator(model="MRX 740", inputs=["Blu-ray", "TV"]) as device:
+        conn = await Connection.create(port=device.port, auto_reconnect=False)
+        live = conn.protocol
+        live.start_recording(recording)
+        await conn.reconnect()
+        await live.wait_for_device_initialised(1)
+        await live.zones[1].async_set_power(True, timeout=1)
+        while live.input_list != ["Blu-ray", "TV"]:
+            await asyncio.sleep(0.01)
+        live.stop_recording()
+        conn.close()
+
+    recording.seek(0)
+    avr = AVR(loop=asyncio.get_running_loop())
+    assert await replay(recording, avr) > 0
+    assert avr.model == "MRX 740"
+    assert avr.zones[1].power is True
+    assert avr.zones[1].volume == live.zones[1].volume
+    assert avr.input_list == ["Blu-ray", "TV"]
+    assert b"Z1VOL?;" in b"".join(avr.transport.written)
+    avr._poweron.cancel()
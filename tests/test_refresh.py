@@ -0,0 +1,97 @@
+"""Test for the power on refresh."""
+import asyncio
+from unittest.mock import MagicMock
+
+import pytest
+
+from anthemav import AVR
+from anthemav.refresh import PowerOnRefresh, RefreshPhase
+
+
+@pytest.mark.asyncio
+async def test_retry_only_missing():
+    """Query the missing items again and give up on optional phases."""
+    received = set()
+    sent = []
+
+    async def query(keys):
+        sent.append(keys)
+        # the device only answers the first query of each attempt
+        received.add(keys[0])
+
+    def missing(keys):
+        return lambda: [key for key in keys if key not in received]
+
+    refresh = PowerOnRefresh(
+        query,
+        [
+            RefreshPhase("core", missing(["ECH", "SIP", "FPB"]), required=True),
+            RefreshPhase("extras", missing(["Z1AIC", "Z1BRT", "Z1SRT"])),
+        ],
+        asyncio.get_running_loop,
+        retry_interval=0.01,
+        attempts=2,
+    )
+    refresh.start(0)
+    assert refresh.running
+    await refresh.wait()
+    assert not refresh.running
+    assert refresh.complete
+    assert sent == [
+        ["ECH", "SIP", "FPB"],
+        ["Z1AIC", "Z1BRT", "Z1SRT"],
+        ["SIP", "FPB"],
+        ["Z1BRT", "Z1SRT"],
+        ["FPB"],
+    ]
+
+
+@pytest.mark.asyncio
+async def test_power_off_cancels_refresh():
+    avr = AVR(loop=asyncio.get_running_loop())
+    avr.transport = MagicMock()
+    await avr._parse_message("IDMMRX 740")
+    await avr._parse_message("Z1POW1")
+    assert avr._poweron.running
+    await avr._parse_message("Z1POW0")
+    assert not avr._poweron.running
+    assert avr._poweron_refresh_successful is False
+
+
+@pytest.mark.asyncio
+async def test_inputs_complete_refresh():
+    avr = AVR(loop=asyncio.get_running_loop())
+    avr.transport = MagicMock()
+    await avr._parse_message("IDMMRX 740")
+    avr.power_on_device()
+    assert avr._missing_input_queries() == ["ICN"]
+    await avr._parse_message("ICN2")
+    await avr._parse_message("IS1INBlu-ray")
+    await avr._parse_message("IS1ARC1")
+    assert avr._missing_input_queries() == ["IS2IN", "IS2ARC"]
+    await avr._parse_message("IS2INTV")
+    await avr._parse_message("IS2ARC0")
+    assert avr._missing_input_queries() == []
+    avr._poweron.cancel()
+
+
+@pytest.mark.asyncio
+async def test_required_phase_gives_up():
+    """Stop retrying an item the device never answers."""
+    sent = []
+
+    async def query(keys):
+        sent.append(keys)
+
+    refresh = PowerOnRefresh(
+        query,
+        [RefreshPhase("inputs", lambda: ["IS2ARC"], required=True)],
+        asyncio.get_running_loop,
+        retry_interval=0.01,
+        required_attempts=3,
+    )
+    refresh.start(0)
+    await refresh.wait()
+    assert sent == [["IS2ARC"]] * 3
+    assert refresh.gave_up
+    assert not refresh.complete
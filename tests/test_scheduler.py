@@ -0,0 +1,207 @@
+"""Test for the outbound command scheduler."""
+import asyncio
+from unittest.mock import MagicMock
+
+import pytest
+
+from anthemav import AVR
+from anthemav.scheduler import BACKGROUND, INTERACTIVE, CommandScheduler, command_key
+
+
+def create_scheduler(window=2, fairness=2):
+    written = []
+    scheduler = CommandScheduler(
+        written.extend, MagicMock, window=window, fairness=fairness
+    )
+    return scheduler, written
+
+
+def test_interactive_jumps_ahead():
+    scheduler, written = create_scheduler()
+    scheduler.submit_many([b"Z1VOL?;", b"Z1INP?;", b"Z1MUT?;"], BACKGROUND)
+    scheduler.submit(b"Z1MUT1;", INTERACTIVE)
+    assert written == [b"Z1VOL?;", b"Z1INP?;"]
+    scheduler.acknowledge("Z1VOL")
+    assert written[2:] == [b"Z1MUT1;"]
+    scheduler.acknowledge_many(["Z1INP", None])
+    assert written[3:] == [b"Z1MUT?;"]
+    stats = scheduler.stats()
+    assert stats[BACKGROUND]["sent"] == 3
+    assert stats[INTERACTIVE]["sent"] == 1
+    assert stats[BACKGROUND]["queued"] == 0
+
+
+def test_background_not_starved():
+    """A waiting background command is sent after fairness interactive ones."""
+    scheduler, written = create_scheduler(window=1)
+    scheduler.submit(b"Z1VOL-40;")
+    scheduler.submit_many([b"ICN?;"], BACKGROUND)
+    for volume in range(41, 45):
+        scheduler.submit(f"Z1VOL-{volume};".encode())
+    for _ in range(5):
+        scheduler.acknowledge(command_key(written[-1]))
+    assert written == [
+        b"Z1VOL-40;",
+        b"Z1VOL-41;",
+        b"Z1VOL-42;",
+        b"ICN?;",
+        b"Z1VOL-43;",
+        b"Z1VOL-44;",
+    ]
+
+
+@pytest.mark.asyncio
+async def test_slots_freed_without_answer():
+    written = []
+    scheduler = CommandScheduler(
+        written.extend, asyncio.get_running_loop, window=1, timeout=0.01
+    )
+    scheduler.submit(b"Z1MUT1;")
+    scheduler.submit(b"Z1MUT0;")
+    assert written == [b"Z1MUT1;"]
+    await asyncio.sleep(0.05)
+    assert written == [b"Z1MUT1;", b"Z1MUT0;"]
+
+
+@pytest.mark.asyncio
+async def test_setter_preempts_refresh():
+    """A setter isn't queued behind the input names requested after ICN."""
+    avr = AVR(loop=asyncio.get_running_loop())
+    avr.transport = MagicMock()
+    await avr._parse_message("IDMMRX 740")
+    avr.transport.reset_mock()
+    avr._scheduler.reset()
+    avr._populate_inputs(12)
+    avr.zones[1].mute = True
+    avr.transport.writelines.assert_called_once()
+    # the mute command and the query of the mute state
+    assert avr._scheduler.pending == 24 - 8 + 2
+    avr.data_received(b"IS1INBlu-ray;")
+    avr.transport.write.assert_called_once_with(b"Z1MUT1;")
+    assert avr._scheduler.pending == 24 - 8 + 1
+    avr._scheduler.reset()
+    await avr._assemble_task
+
+
+def test_acknowledgements_matched():
+    """Each answer frees the slot of the command it answers, and only that one."""
+    scheduler, written = create_scheduler(window=3)
+    scheduler.submit_many([b"Z1VOL?;", b"Z1MUT1;", b"Z1FOO?;", b"ICN?;"], BACKGROUND)
+    assert scheduler.acknowledge("Z2VOL") is None
+    assert scheduler.in_flight == 3
+    # a bare ; confirms the oldest command that isn't a query
+    assert scheduler.acknowledge(None) == b"Z1MUT1;"
+    assert written[3:] == [b"ICN?;"]
+    assert scheduler.acknowledge("Z1FOO") == b"Z1FOO?;"
+    assert scheduler.acknowledge(None) is None
+    assert scheduler.in_flight == 2
+
+
+@pytest.mark.asyncio
+async def test_drain_waits_for_acknowledgements():
+    written = []
+    scheduler = CommandScheduler(
+        written.extend, asyncio.get_running_loop, window=2, timeout=0.05
+    )
+    scheduler.submit_many([b"Z1VOL?;", b"Z1MUT?;", b"Z1INP?;"], BACKGROUND)
+    drain = asyncio.create_task(scheduler.drain())
+    await asyncio.sleep(0)
+    scheduler.acknowledge_many(["Z1VOL", "Z1MUT"])
+    assert written[2:] == [b"Z1INP?;"]
+    await asyncio.sleep(0)
+    assert not drain.done()
+    # Z1INP is never answered and frees its slot after the timeout
+    await asyncio.wait_for(drain, 1)
+    assert scheduler.stats()[BACKGROUND]["expired"] == 1
+
+
+@pytest.mark.asyncio
+async def test_avr_confirmed_commands():
+    """Every command confirmed by a bare ; is applied, not only the last one."""
+    avr = AVR(loop=asyncio.get_running_loop())
+    avr.transport = MagicMock()
+    await avr._parse_message("IDMMRX 740")
+    avr._scheduler.reset()
+    avr.command("Z1PVOL40")
+    avr.command("Z1MUT1")
+    avr.data_received(b";;")
+    await avr._assemble_task
+    assert avr.zones[1].volume == 40
+    assert avr.zones[1].mute is True
+    assert avr._scheduler.in_flight == 0
+
+
+def test_identical_queries_joined():
+    scheduler, written = create_scheduler(window=1)
+    scheduler.submit_many([b"Z1POW?;", b"Z2POW?;", b"Z1POW?;"], BACKGROUND)
+    scheduler.submit(b"Z1POW?;")
+    # joined to the background query waiting for a slot, which jumps ahead
+    scheduler.submit(b"Z2POW?;")
+    assert scheduler.stats()[INTERACTIVE]["queued"] == 1
+    scheduler.acknowledge("Z1POW")
+    assert written == [b"Z1POW?;", b"Z2POW?;"]
+    scheduler.submit(b"Z2POW?;")
+    scheduler.acknowledge("Z2POW")
+    assert written == [b"Z1POW?;", b"Z2POW?;"]
+    stats = scheduler.stats()
+    assert stats[BACKGROUND]["joined"] == 1
+    assert stats[INTERACTIVE]["joined"] == 3
+    # setters are never joined
+    scheduler.submit(b"Z1MUT1;")
+    scheduler.acknowledge(None)
+    scheduler.submit(b"Z1MUT1;")
+    assert written[2:] == [b"Z1MUT1;", b"Z1MUT1;"]
+
+
+@pytest.mark.asyncio
+async def test_overdue_query_sent_again():
+    """A query whose answer was lost is sent again, not joined."""
+    written = []
+    scheduler = CommandScheduler(written.extend, MagicMock, timeout=0.05)
+    scheduler.submit(b"Z1VOL?;")
+    await asyncio.sleep(0.1)
+    scheduler.submit(b"Z1VOL?;")
+    assert written == [b"Z1VOL?;", b"Z1VOL?;"]
+    stats = scheduler.stats()[INTERACTIVE]
+    assert stats["expired"] == 1
+    assert stats["joined"] == 0
+
+
+@pytest.mark.asyncio
+async def test_avr_concurrent_queries_share_answer():
+    avr = AVR(loop=asyncio.get_running_loop())
+    avr.transport = MagicMock()
+    queries = asyncio.gather(avr.async_query("Z1VOL"), avr.async_query("Z1VOL"))
+    await asyncio.sleep(0)
+    avr.transport.write.assert_called_once_with(b"Z1VOL?;")
+    avr.data_received(b"Z1VOL-40;")
+    assert await asyncio.wait_for(queries, 1) == ["-40", "-40"]
+
+
+def test_paused_queue_is_bounded():
+    """Hold the commands while paused and drop the oldest refresh queries."""
+    written = []
+    scheduler = CommandScheduler(written.extend, MagicMock, window=8, max_queued=3)
+    scheduler.pause()
+    scheduler.submit_many([b"Z1VOL?;", b"Z1INP?;", b"Z1MUT?;"], BACKGROUND)
+    scheduler.submit(b"Z1MUT1;")
+    scheduler.submit(b"Z1VOL-40;")
+    assert written == []
+    stats = scheduler.stats()
+    assert stats[BACKGROUND]["dropped"] == 2
+    assert stats[INTERACTIVE]["dropped"] == 0
+    scheduler.resume()
+    assert written == [b"Z1MUT1;", b"Z1VOL-40;", b"Z1MUT?;"]
+    assert scheduler.pauses == 1
+
+
+@pytest.mark.asyncio
+async def test_avr_respects_transport_backpressure():
+    avr = AVR(loop=asyncio.get_running_loop())
+    avr.transport = MagicMock()
+    avr.pause_writing()
+    avr.zones[1].mute = True
+    avr.transport.write.assert_not_called()
+    avr.resume_writing()
+    avr.transport.writelines.assert_called_once_with([b"Z1MUT1;", b"Z1MUT?;"])
+    avr._scheduler.reset()
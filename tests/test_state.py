@@ -0,0 +1,79 @@
+"""Test for the state store."""
+from unittest.mock import MagicMock
+
+import pytest
+
+from anthemav import AVR
+from anthemav.state import StateStore, slot_decoders, slot_index
+
+
+def test_slots_and_overflow():
+    store = StateStore(slot_index(["IDM", "Z1VOL"]))
+    assert store.get("IDM") is None
+    assert "IDM" not in store
+    store["IDM"] = "MRX 740"
+    store["IS3IN"] = "Blu-ray"
+    assert store["IDM"] == "MRX 740"
+    assert store.overflow == {"IS3IN": "Blu-ray"}
+    assert dict(store.items()) == {"IDM": "MRX 740", "IS3IN": "Blu-ray"}
+    assert len(store) == 2
+    with pytest.raises(KeyError):
+        store["Z1VOL"]
+
+
+def test_dict_compatible():
+    """Zone.values and AVR.values can still be used like the dicts they were."""
+    store = StateStore(slot_index(["IDM", "Z1VOL"]))
+    store.update({"IDM": "MRX 740", "IS3IN": "Blu-ray"})
+    assert store == {"IDM": "MRX 740", "IS3IN": "Blu-ray"}
+    assert list(store.keys()) == ["IDM", "IS3IN"]
+    assert list(store.values()) == ["MRX 740", "Blu-ray"]
+    assert store.pop("IDM") == "MRX 740"
+    assert store.pop("IDM", None) is None
+    assert store.setdefault("Z1VOL", "-40") == "-40"
+    del store["IS3IN"]
+    assert store == {"Z1VOL": "-40"}
+
+
+@pytest.mark.asyncio
+async def test_properties_read_from_store():
+    avr = AVR(loop=MagicMock())
+    assert avr.model == "Unknown Model"
+    await avr._parse_message("Z1BRT640")
+    await avr._parse_message("Z1ALM03")
+    assert avr.audio_input_bitrate == 640
+    assert avr.audio_listening_mode_text == "PLII Movie"
+    assert avr.dolby_dialog_normalization is None
+    with pytest.raises(AttributeError):
+        avr.zones[1].extra = True
+
+
+def test_values_decoded_when_received():
+    decoded = []
+
+    def decode(value):
+        decoded.append(value)
+        return int(value)
+
+    slots = slot_index(["VOL", "INP"])
+    store = StateStore(slots, slot_decoders(slots, {"VOL": decode}))
+    store["VOL"] = "-40"
+    store["INP"] = "3"
+    assert store.decoded("VOL") == -40
+    assert store.decoded("VOL") == -40
+    assert decoded == ["-40"]
+    assert store.decoded("INP") == "3"
+    assert store.decoded("MUT", False) is False
+
+
+@pytest.mark.asyncio
+async def test_zone_typed_values():
+    avr = AVR(loop=MagicMock())
+    avr.set_zones("MRX 740")
+    await avr._parse_message("Z2MUT1")
+    await avr._parse_message("Z2VOL-35")
+    await avr._parse_message("Z2INPx")
+    assert avr.zones[2].mute is True
+    assert avr.zones[2].attenuation == -35
+    assert avr.zones[2].input_number == 0
+    assert avr.zones[2].power is False